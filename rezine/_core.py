@@ -11,6 +11,7 @@
 
 import os
 from thread import allocate_lock
+from threading import Thread, local
 from time import time, sleep
 
 _setup_lock = allocate_lock()
@@ -21,6 +22,22 @@ _application = None
 #: true if the setup failed last time
 _setup_failed = False
 
+#: the requests currently dispatched by `get_wsgi_app` mapped to the
+#: application that handles them.  Only atomic dict operations are used
+#: on this, so no lock is needed.
+_in_flight = {}
+
+#: the application built by a background reload.  Only the thread that
+#: builds it sees it, all other threads keep using `_application`.
+_building = local()
+
+#: true while a background reload is running
+_reload_pending = False
+
+#: true if the last background reload failed.  The next request then does
+#: a regular reload so that the error shows up.
+_reload_failed = False
+
 
 class InstanceNotInitialized(RuntimeError):
     """Raised if an application was created for a not yet initialized
@@ -83,15 +100,83 @@ def _create_rezine(instance_folder, timeout=5, in_reloader=True):
         _setup_lock.release()
 
 
+def _reload_rezine(instance_folder):
+    """Build a new application for the instance folder, warm it up and swap
+    it in for the current one.  This is called in a background thread by
+    the dispatcher, the old application keeps serving requests until the
+    new one is ready.  Unlike a regular reload the rezine modules are not
+    unloaded, so this only picks up configuration changes.
+    """
+    global _application, _reload_pending, _reload_failed
+    old_app = _application
+    try:
+        from rezine.application import Rezine
+        app = object.__new__(Rezine)
+        _building.application = app
+        try:
+            app.__init__(instance_folder)
+            app.check_if_upgrade_required()
+            app.warm_up()
+        finally:
+            _building.application = None
+            from rezine.utils import local_manager
+            from rezine.database import cleanup_session
+            cleanup_session()
+            local_manager.cleanup()
+    except:
+        # upgrades and errors are handled by a regular reload on the
+        # next request, that one shows the error to the user.
+        _reload_failed = True
+        _reload_pending = False
+        return
+
+    _setup_lock.acquire()
+    try:
+        _application = app
+        _reload_pending = False
+    finally:
+        _setup_lock.release()
+    _start_tasks(app)
+
+    # requests that are still running against the old application use
+    # its database engine, so wait for them before closing the pool.
+    _drain_requests(old_app)
+    _stop_tasks(old_app)
+    old_app.database_engine.dispose()
+
+
+def _start_tasks(app):
+    """Start the task workers of an application that serves requests.  This
+    is only done by the WSGI dispatcher, scripts that set up rezine do not
+    run tasks in the background.
+    """
+    from rezine.application import Rezine
+    if isinstance(app, Rezine):
+        app.tasks.start()
+
+
+def _stop_tasks(app):
+    """Stop the task workers of an application that is unloaded or was
+    replaced.  The web setup and upgrade applications have no workers.
+    """
+    tasks = getattr(app, 'tasks', None)
+    if tasks is not None:
+        tasks.shutdown()
+
+
 def _unload_rezine():
     """Unload all rezine libraries."""
-    global _application, _setup_failed
+    global _application, _setup_failed, _reload_failed
     import sys
 
     _setup_lock.acquire()
     try:
+        # the workers must not run tasks against unloaded modules
+        if _application is not None:
+            _stop_tasks(_application)
         _application = None
         _setup_failed = False
+        _reload_failed = False
 
         for name, module in sys.modules.items():
             # in the main module delete everything but the stuff
@@ -141,11 +226,54 @@ def get_rezine():
     return _application
 
 
-def get_wsgi_app(instance_folder):
+def _drain_requests(app, timeout=10):
+    """Wait until all requests that were dispatched to `app` finished or
+    `timeout` seconds passed.  This is called before the rezine modules are
+    unloaded so that in-flight requests are not ripped apart.
+    """
+    started = time()
+    while app in _in_flight.values():
+        if time() > started + timeout:
+            break
+        sleep(0.01)
+
+
+class _TrackedResponse(object):
+    """Wraps the application iterator of a dispatched request and removes
+    the request from the in-flight registry once the server closes it.
+    """
+
+    def __init__(self, app_iter, token):
+        self._app_iter = app_iter
+        self._token = token
+
+    def __iter__(self):
+        return iter(self._app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self._app_iter, 'close'):
+                self._app_iter.close()
+        finally:
+            _in_flight.pop(self._token, None)
+
+
+def get_wsgi_app(instance_folder, background_reload=None):
     """This function returns a proxy WSGI application that dispatches to
     Rezine or the web setup.  It is however not possible to use this function
     to set up multiple instances of rezine in the same python interpreter.
 
+    The dispatcher does not lock as long as the application is set up and
+    does not want to be reloaded.  Only setups and reloads are serialized,
+    and a reload waits for the requests that are still running against the
+    old application before the rezine modules are unloaded.
+
+    If `background_reload` is true (it defaults to the ``ZINE_BACKGROUND_
+    RELOAD`` environment variable, see :func:`override_environ_config`)
+    configuration changes do not block requests.  The new application is
+    built and warmed up in a separate thread while the old one keeps
+    serving requests, and is swapped in once it's ready.
+
     This function MUST NOT BE CALLED for environments where anything but
     the WSGI server or rezine itself work with the rezine API.  The reloading
     process depends that only rezine controls stuff outside of the internal
@@ -155,13 +283,31 @@ def get_wsgi_app(instance_folder):
     # imports properly before we create our proxy application.
     import rezine.application
 
+    if background_reload is None:
+        background_reload = os.environ.get('ZINE_BACKGROUND_RELOAD') == '1'
     _dispatch_lock = allocate_lock()
-    def application(environ, start_response):
+
+    def get_app(token):
+        global _reload_pending
+        # slow path.  Another thread could have finished the setup or
+        # reload while we were waiting for the lock, so check again.
         _dispatch_lock.acquire()
         try:
             app = _application
+            if background_reload and app is not None and \
+               app.wants_reload and not (_setup_failed or _reload_failed):
+                if not _reload_pending:
+                    _reload_pending = True
+                    thread = Thread(target=_reload_rezine,
+                                    args=(instance_folder,))
+                    thread.setDaemon(True)
+                    thread.start()
+                _in_flight[token] = app
+                return app
             if app is not None and app.wants_reload or \
                _setup_failed:
+                if app is not None:
+                    _drain_requests(app)
                 _unload_rezine()
                 app = None
             if app is None:
@@ -170,20 +316,48 @@ def get_wsgi_app(instance_folder):
                 except InstanceNotInitialized:
                     from rezine.websetup import WebSetup
                     app = WebSetup(instance_folder)
+                else:
+                    _start_tasks(app)
+            # reloads happen while holding the lock, so the application
+            # cannot be unloaded before the request is registered.
+            _in_flight[token] = app
         finally:
             _dispatch_lock.release()
-        return app(environ, start_response)
+        return app
+
+    def application(environ, start_response):
+        # fast path: one reference read of the current application.  The
+        # lock is only taken if a setup or reload is required.  The request
+        # is registered before the application is checked again, so a
+        # reload either waits for the request or the request sees that the
+        # application was replaced and takes the slow path.
+        token = object()
+        app = _application
+        if app is not None:
+            _in_flight[token] = app
+            if app is not _application or _setup_failed or \
+               (app.wants_reload and not _reload_pending):
+                _in_flight.pop(token, None)
+                app = None
+        if app is None:
+            app = get_app(token)
+        try:
+            return _TrackedResponse(app(environ, start_response), token)
+        except:
+            _in_flight.pop(token, None)
+            raise
     return application
 
 
 def override_environ_config(pool_size=None, pool_recycle=None,
-                            pool_timeout=None, behind_proxy=None):
+                            pool_timeout=None, behind_proxy=None,
+                            background_reload=None):
     """Some configuration parameters are not stored in the rezine.ini but
     in the os environment.  These are process wide configuration settings
     used for different deployments.
     """
     for key, value in locals().items():
         if value is not None:
-            if key == 'behind_proxy':
+            if key in ('behind_proxy', 'background_reload'):
                 value = int(bool(value))
             os.environ['ZINE_' + key.upper()] = str(value)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+    rezine.aggregates
+    ~~~~~~~~~~~~~~~~~
+
+    The number of published posts per tag and per year, month and day.
+    The tag cloud and the archive summary are shown on nearly every page.
+    Instead of grouping the posts table for them on every request the
+    counts are loaded once per process and updated with the committed
+    posts.
+
+    Posts with a publication date in the future are counted once that date
+    is reached.  Every process that commits posts or tags replaces a
+    version in the shared cache.  The other processes notice the new
+    version and load the counts again.  Without a shared cache the
+    processes cannot notice each other, so they load the counts again
+    after a while.
+
+    :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import date, datetime
+from heapq import heappush, heappop
+from threading import Lock
+from time import time
+
+from werkzeug.contrib.cache import NullCache
+
+from rezine.database import db, posts, tags, post_tags
+from rezine.utils.crypto import gen_random_identifier
+
+
+#: the number of seconds the counts are trusted before the shared cache is
+#: asked if other processes committed posts.
+AGGREGATES_CHECK_INTERVAL = 5
+
+#: the number of seconds the counts are trusted if there is no shared cache.
+#: After that they are loaded from the database again.
+AGGREGATES_RELOAD_INTERVAL = 60
+
+#: the key of the version of the counts in the shared cache
+VERSION_KEY = 'post_aggregates/version'
+
+
+def update_post_aggregates(instances, deleted=()):
+    """Update the counts for the committed posts and tags.  This is
+    connected to the `after-models-committed` event.
+    """
+    from rezine.application import get_application
+    from rezine.models import Post, SummarizedPost, Tag, STATUS_PUBLISHED
+    aggregates = get_application().post_aggregates
+    deleted = set(map(id, deleted))
+    changed_posts = []
+    changed_tags = []
+    for instance in instances:
+        if isinstance(instance, (Post, SummarizedPost)):
+            if id(instance) in deleted or \
+               instance.status != STATUS_PUBLISHED:
+                changed_posts.append((instance.id, None))
+            else:
+                changed_posts.append((instance.id, (instance.pub_date,
+                    instance.content_type, [x.id for x in instance.tags])))
+        elif isinstance(instance, Tag):
+            if id(instance) in deleted:
+                # the links of the posts to the tag are gone as well
+                aggregates.reset()
+                return
+            changed_tags.append((instance.id, instance.slug, instance.name))
+    if changed_posts or changed_tags:
+        aggregates.update(changed_posts, changed_tags)
+
+
+class PostAggregates(object):
+    """Counts the published posts.  Besides the counts the publication
+    date, content type and tag ids of every published post are kept in
+    memory, in every process.  The posts themselves are loaded from the
+    database as usual.
+    """
+
+    #: the number of seconds between two checks of the shared version
+    check_interval = AGGREGATES_CHECK_INTERVAL
+
+    #: the number of seconds after that the counts are loaded again if
+    #: there is no shared cache
+    reload_interval = AGGREGATES_RELOAD_INTERVAL
+
+    def __init__(self, app):
+        self.app = app
+        self.shared = not isinstance(app.cache, NullCache)
+        self._lock = Lock()
+        self._loaded = False
+
+    def _clear(self):
+        # post_id -> (pub_date, content_type, tag_ids) of published posts
+        self._posts = {}
+        # the ids of the posts that are published already and counted
+        self._counted = set()
+        # (pub_date, post_id) of the posts published in the future
+        self._pending = []
+        self._tags = {}
+        self._tag_counts = {}
+        self._date_counts = {'years': {}, 'months': {}, 'days': {}}
+
+    def _get_cache(self):
+        # the local tier of a two tier cache would hide new versions
+        return getattr(self.app.cache, 'shared', self.app.cache)
+
+    def _get_version(self):
+        """Return the shared version.  It's created if there is none."""
+        from rezine.cache import TAG_VERSION_TIMEOUT
+        cache = self._get_cache()
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, gen_random_identifier(),
+                      TAG_VERSION_TIMEOUT)
+            version = cache.get(VERSION_KEY)
+        return version
+
+    def _replace_version(self):
+        """Replace the shared version after this process changed the counts.
+        Returns `False` if another process replaced the version since this
+        process loaded or replaced it.
+        """
+        from rezine.cache import TAG_VERSION_TIMEOUT
+        cache = self._get_cache()
+        unchanged = cache.get(VERSION_KEY) == self._version
+        self._version = gen_random_identifier()
+        cache.set(VERSION_KEY, self._version, TAG_VERSION_TIMEOUT)
+        self._checked = time()
+        return unchanged
+
+    def _load(self):
+        """Load the counts from the database."""
+        from rezine.models import STATUS_PUBLISHED
+        self._clear()
+        self._version = self.shared and self._get_version() or None
+        self._checked = time()
+        engine = self.app.database_engine
+        self._tags = dict((row.tag_id, (row.slug, row.name)) for row in
+                          engine.execute(tags.select()))
+        post_tag_ids = {}
+        for row in engine.execute(db.select([post_tags.c.post_id,
+                                             post_tags.c.tag_id])):
+            post_tag_ids.setdefault(row.post_id, []).append(row.tag_id)
+        for row in engine.execute(db.select([posts.c.post_id,
+                posts.c.pub_date, posts.c.content_type],
+                posts.c.status == STATUS_PUBLISHED)):
+            self._add(row.post_id, row.pub_date, row.content_type,
+                      post_tag_ids.get(row.post_id, ()))
+        self._loaded = True
+
+    def _ensure_current(self):
+        """Load the counts if necessary and count the posts that were
+        published since the last call.
+        """
+        now = time()
+        if not self._loaded:
+            self._load()
+        elif self.shared and self._checked + self.check_interval < now:
+            self._checked = now
+            if self._get_version() != self._version:
+                self._load()
+        elif not self.shared and self._checked + self.reload_interval < now:
+            self._load()
+        utcnow = datetime.utcnow()
+        while self._pending and self._pending[0][0] <= utcnow:
+            pub_date, post_id = heappop(self._pending)
+            post = self._posts.get(post_id)
+            # the post might have been changed in the meantime
+            if post is not None and post[0] == pub_date and \
+               post_id not in self._counted:
+                self._count(post_id, 1)
+
+    def _add(self, post_id, pub_date, content_type, tag_ids):
+        self._posts[post_id] = (pub_date, content_type, tuple(tag_ids))
+        if pub_date is None:
+            return
+        if pub_date <= datetime.utcnow():
+            self._count(post_id, 1)
+        else:
+            heappush(self._pending, (pub_date, post_id))
+
+    def _remove(self, post_id):
+        if post_id in self._counted:
+            self._count(post_id, -1)
+        self._posts.pop(post_id, None)
+
+    def _count(self, post_id, delta):
+        pub_date, content_type, tag_ids = self._posts[post_id]
+        if delta > 0:
+            self._counted.add(post_id)
+        else:
+            self._counted.discard(post_id)
+        counts = [(self._tag_counts, tag_id) for tag_id in tag_ids]
+        if content_type in self.app.cfg['index_content_types']:
+            day = pub_date.date()
+            counts.extend([
+                (self._date_counts['years'], date(day.year, 1, 1)),
+                (self._date_counts['months'], date(day.year, day.month, 1)),
+                (self._date_counts['days'], day)
+            ])
+        for mapping, key in counts:
+            value = mapping.get(key, 0) + delta
+            if value > 0:
+                mapping[key] = value
+            else:
+                mapping.pop(key, None)
+
+    def update(self, changed_posts=(), changed_tags=()):
+        """Update the counts.  `changed_posts` is a list of ``(post_id,
+        values)`` tuples where values is `None` for posts that are not
+        published (anymore) or a ``(pub_date, content_type, tag_ids)``
+        tuple.  `changed_tags` is a list of ``(tag_id, slug, name)`` tuples.
+        """
+        self._lock.acquire()
+        try:
+            if not self._loaded:
+                return
+            for post_id, values in changed_posts:
+                self._remove(post_id)
+                if values is not None:
+                    self._add(post_id, *values)
+            for tag_id, slug, name in changed_tags:
+                self._tags[tag_id] = (slug, name)
+            # the counts of this process are up to date unless another
+            # process committed posts or tags in the meantime
+            if self.shared and not self._replace_version():
+                self._loaded = False
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Load the counts again on the next access, in all processes."""
+        self._lock.acquire()
+        try:
+            self._loaded = False
+            if self.shared:
+                self._version = None
+                self._replace_version()
+        finally:
+            self._lock.release()
+
+    def get_tag_counts(self):
+        """Return a list of ``(tag_id, slug, name, count)`` tuples for the
+        tags of the published posts.
+        """
+        self._lock.acquire()
+        try:
+            self._ensure_current()
+            return [(tag_id, self._tags[tag_id][0], self._tags[tag_id][1],
+                     count) for tag_id, count in self._tag_counts.iteritems()
+                    if tag_id in self._tags]
+        finally:
+            self._lock.release()
+
+    def get_archive_counts(self, detail='months'):
+        """Return a list of ``(date, count)`` tuples for the years, months
+        or days with published posts, the newest first.  Only the content
+        types shown on the index are counted.
+        """
+        if detail not in ('years', 'months', 'days'):
+            raise ValueError('detail must be years, months, or days')
+        self._lock.acquire()
+        try:
+            self._ensure_current()
+            return sorted(self._date_counts[detail].iteritems(),
+                          reverse=True)
+        finally:
+            self._lock.release()
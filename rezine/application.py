@@ -11,7 +11,9 @@
     :license: BSD, see LICENSE for more details.
 """
 import sys
-from os import path, remove, makedirs, walk, environ
+from os import path, remove, makedirs, walk, environ, access, listdir, \
+     rename, stat, getpid, W_OK
+from hashlib import md5
 from time import time
 from urlparse import urlparse
 from collections import deque
@@ -21,26 +23,30 @@ from StringIO import StringIO
 
 from babel import Locale
 
-from jinja2 import Environment, BaseLoader, TemplateNotFound
+from jinja2 import Environment, BaseLoader, TemplateNotFound, \
+     FileSystemBytecodeCache
 
 from sqlalchemy.exceptions import SQLAlchemyError
 
 from werkzeug import Request as RequestBase, Response as ResponseBase, \
      SharedDataMiddleware, url_quote, routing, redirect as _redirect, \
-     escape, cached_property, url_encode
+     escape, cached_property, url_encode, import_string
 from werkzeug.exceptions import HTTPException, Forbidden, \
      NotFound
 from werkzeug.contrib.securecookie import SecureCookie
 
 from rezine import _core
 from rezine.environment import SHARED_DATA, BUILTIN_TEMPLATE_PATH, \
-     BUILTIN_PLUGIN_FOLDER
+     BUILTIN_PLUGIN_FOLDER, UPGRADE_REPOSITORY_PATH
 from rezine.database import db, cleanup_session
-from rezine.cache import get_cache
+from rezine.cache import get_cache, invalidate_models
+from rezine.search import get_search_index, update_search_index
+from rezine.tasks import TaskQueue, wake_workers
 from rezine.utils import ClosingIterator, local, local_manager, dump_json, \
      htmlhelpers
 from rezine.utils.datastructures import ReadOnlyMultiMapping
 from rezine.utils.exceptions import UserException
+from rezine.utils.profiling import StartupProfile
 
 
 #: the default theme settings
@@ -96,6 +102,21 @@ DEFAULT_THEME_SETTINGS = {
     'sql.tag.deferred':             frozenset()
 }
 
+#: the templates that are compiled by :meth:`Rezine.warm_up`
+WARM_UP_TEMPLATES = ['layout.html', '_widgets.html', 'index.html',
+                     'show_entry.html', 'page.html', '404.html']
+
+#: the number of characters a streamed page collects before they are sent
+#: to the client (see :func:`render_template`).
+STREAM_BUFFER_SIZE = 8192
+
+#: the builtin importers.  They are imported when the importers are used
+#: for the first time, not during the application setup.
+BUILTIN_IMPORTERS = [
+    ('wordpress',   'rezine.importers.wordpress:WordPressImporter'),
+    ('feed',        'rezine.importers.feed:FeedImporter')
+]
+
 
 def get_request():
     """Return the current request.  If no request is available this function
@@ -108,7 +129,8 @@ def get_application():
     """Get the application instance.  If the application was not yet set up
     the return value is `None`
     """
-    return _core._application
+    return getattr(_core._building, 'application', None) or \
+           _core._application
 
 
 def url_for(endpoint, **args):
@@ -215,8 +237,10 @@ def select_template(templates):
 def render_template(template_name, _stream=False, **context):
     """Renders a template. If `_stream` is ``True`` the return value will be
     a Jinja template stream and not an unicode object.
-    This is used by `render_response`.  If the `template_name` is a list of
-    strings the first template that exists is selected.
+    This is used by `render_response`.  If `_stream` is a number the return
+    value is an iterator that yields the output in chunks of at least that
+    many characters.  If the `template_name` is a list of strings the first
+    template that exists is selected.
     """
     if not isinstance(template_name, basestring):
         tmpl = select_template(template_name)
@@ -228,21 +252,50 @@ def render_template(template_name, _stream=False, **context):
     #! ignored but the context can be modified in place.
     emit_event('before-render-template', template_name, _stream, context)
 
-    if _stream:
+    if _stream is True:
         return tmpl.stream(context)
+    elif _stream:
+        return _buffer_stream(tmpl.generate(context), _stream)
     return tmpl.render(context)
 
 
+def _buffer_stream(iterable, size):
+    """Join the strings from the iterable to chunks of at least `size`
+    characters.
+    """
+    buffer = []
+    length = 0
+    for item in iterable:
+        buffer.append(item)
+        length += len(item)
+        if length >= size:
+            yield u''.join(buffer)
+            del buffer[:]
+            length = 0
+    if buffer:
+        yield u''.join(buffer)
+
+
 def render_response(template_name, **context):
     """Like render_template but returns a response. If `_stream` is ``True``
     the response returned uses the Jinja stream processing. This is useful
     for pages with lazy generated content or huge output where you don't
     want the users to wait until the calculation ended. Use streaming only
     in those situations because it's usually slower than bunch processing.
+    If `_stream` is a number the output is sent in chunks of at least that
+    many characters, :func:`get_stream_buffer_size` returns the value for
+    large pages.
     """
     return Response(render_template(template_name, **context))
 
 
+def get_stream_buffer_size():
+    """Return the `_stream` value for large pages and feeds.  This is the
+    `STREAM_BUFFER_SIZE` or `False` if streaming is disabled.
+    """
+    return get_application().cfg['stream_responses'] and STREAM_BUFFER_SIZE
+
+
 class InternalError(UserException):
     """Subclasses of this exception are used to signal internal errors that
     should not happen, but may do if the configuration is garbage.  If an
@@ -266,22 +319,41 @@ class Request(RequestBase):
 
         engine = self.app.database_engine
 
-        # get the session and try to get the user object for this request.
-        from rezine.models import User
-        user = None
+        # get the session and the identity of the user for this request.
+        # The user object itself is loaded on first access.
+        from rezine.identity import ANONYMOUS
+        identity = None
         cookie_name = app.cfg['session_cookie_name']
         session = SecureCookie.load_cookie(self, cookie_name,
                                            app.secret_key)
         user_id = session.get('uid')
         if user_id:
-            user = User.query.options(db.eagerload('groups'),
-                                      db.eagerload('groups', '_privileges')) \
-                             .get(user_id)
-        if user is None:
-            user = User.query.get_nobody()
-        self.user = user
+            identity = app.identities.get(user_id)
+        self.identity = identity or ANONYMOUS
+        self._user = None
         self.session = session
 
+    def _get_user(self):
+        if self._user is None:
+            from rezine.models import User
+            user = None
+            if self.identity.is_somebody:
+                user = User.query.get(self.identity.id)
+            if user is None:
+                user = User.query.get_nobody()
+            self._user = user
+        return self._user
+
+    def _set_user(self, user):
+        from rezine.identity import get_identity
+        self._user = user
+        self.identity = get_identity(user)
+
+    user = property(_get_user, _set_user, doc="""
+        The user object of the current user.  For privilege checks use
+        the cached `identity` instead.""")
+    del _get_user, _set_user
+
     @property
     def is_behind_proxy(self):
         """Are we behind a proxy?"""
@@ -402,6 +474,8 @@ class Theme(object):
         self.metadata = metadata or {}
         self._settings = settings or {}
         self.configuration_page = configuration_page
+        self._template_index = None
+        self._overlay_stamp = None
 
     @property
     def configurable(self):
@@ -506,17 +580,93 @@ class Theme(object):
         raise TypeError('can\'t link to unconfigurable theme')
 
     def get_source(self, name):
-        parts = [x for x in name.split('/') if not x == '..']
-        for fn in self.get_searchpath():
-            fn = path.join(fn, *parts)
-            if path.exists(fn):
-                f = file(fn)
-                try:
-                    contents = f.read().decode('utf-8')
-                finally:
-                    f.close()
-                mtime = path.getmtime(fn)
-                return contents, fn, lambda: mtime == path.getmtime(fn)
+        name = '/'.join(x for x in name.split('/') if x not in ('', '..'))
+        auto_reload = self.app.cfg['template_auto_reload']
+        fn = self.get_template_index().get(name)
+        if fn is None and auto_reload:
+            # templates added during development are not indexed yet
+            for p in self.get_searchpath():
+                p = path.join(p, *name.split('/'))
+                if path.exists(p):
+                    fn = p
+                    break
+        if fn is None:
+            return
+        f = file(fn)
+        try:
+            contents = f.read().decode('utf-8')
+        finally:
+            f.close()
+        if not auto_reload:
+            return contents, fn, lambda: True
+        mtime = path.getmtime(fn)
+        return contents, fn, lambda: mtime == path.getmtime(fn)
+
+    def get_template_index(self):
+        """Return a dict that maps the template names to the files that
+        are used for them.  The searchpath is walked only once per
+        application, later changes are only noticed for overlays set with
+        :meth:`set_overlay` (in any process) or if `template_auto_reload` is
+        enabled.
+        """
+        self.check_overlays()
+        index = self._template_index
+        if index is None:
+            index = {}
+            # lower priorities first, the others override them
+            for p in reversed(self.get_searchpath()):
+                for dirpath, dirnames, filenames in walk(p):
+                    prefix = dirpath[len(p) + 1:]
+                    if prefix.startswith('.'):
+                        continue
+                    for filename in filenames:
+                        if not filename.startswith('.'):
+                            fn = path.join(prefix, filename)
+                            index[fn.replace(path.sep, '/')] = \
+                                path.join(dirpath, filename)
+            self._template_index = index
+        return index
+
+    def _get_overlay_stamp_path(self):
+        return path.join(self.app.instance_folder, 'overlays', '.stamp')
+
+    def _get_overlay_stamp(self):
+        try:
+            result = stat(self._get_overlay_stamp_path())
+        except OSError:
+            return None
+        return result.st_ino, result.st_mtime
+
+    def _forget_templates(self):
+        self._template_index = None
+        if self.is_current and self.app.template_env.cache is not None:
+            self.app.template_env.cache.clear()
+
+    def check_overlays(self):
+        """Forget the resolved templates and the compiled ones if another
+        process changed an overlay.  The processes notice that through a
+        stamp file in the overlay folder that is replaced on every change.
+        This is called once per request and costs a single `stat`.
+        """
+        stamp = self._get_overlay_stamp()
+        if stamp != self._overlay_stamp:
+            self._overlay_stamp = stamp
+            self._forget_templates()
+
+    def _overlay_changed(self):
+        """Forget the resolved templates and the compiled ones and replace
+        the stamp file so that the other processes do the same.
+        """
+        filename = self._get_overlay_stamp_path()
+        tmp_filename = '%s.%d' % (filename, getpid())
+        try:
+            f = file(tmp_filename, 'w')
+            f.close()
+            rename(tmp_filename, filename)
+        except (IOError, OSError):
+            pass
+        self._overlay_stamp = self._get_overlay_stamp()
+        self._forget_templates()
 
     def get_overlay_path(self, template):
         """Return the path to an overlay for a template."""
@@ -551,6 +701,7 @@ class Theme(object):
             f.write(data.encode('utf-8'))
         finally:
             f.close()
+        self._overlay_changed()
 
     def remove_overlay(self, template, silent=False):
         """Remove an overlay."""
@@ -559,6 +710,7 @@ class Theme(object):
         except OSError:
             if not silent:
                 raise
+        self._overlay_changed()
 
     def get_searchpath(self):
         """Get the searchpath for this theme including plugins and
@@ -659,9 +811,14 @@ class Rezine(object):
             raise TypeError('cannot create %r instances. use the '
                             'rezine._core.setup() factory function.' %
                             self.__class__.__name__)
+        self.startup_profile = profile = StartupProfile()
+        profile.phase('configuration')
         self.instance_folder = path.abspath(instance_folder)
         self.upgrade_lockfile = path.join(instance_folder,
                                           '.upgrade_in_progress')
+        self.upgrade_checkfile = path.join(instance_folder,
+                                           '.upgrade_checked')
+        self.upgrade_repositories = {}
 
         # create the event manager, this is the first thing we have to
         # do because it could happen that events are sent during setup
@@ -681,6 +838,7 @@ class Rezine(object):
 
         if not self.cfg.exists:
             raise _core.InstanceNotInitialized()
+        profile.count_objects = self.cfg['profile_startup']
 
         # and hook in the logger
         self.log = log.Logger(path.join(instance_folder, self.cfg['log_file']),
@@ -692,14 +850,42 @@ class Rezine(object):
             self.iid = '%x' % id(self)
 
         # connect to the database
+        profile.phase('database')
         self.database_engine = db.create_engine(self.cfg['database_uri'],
                                                 self.instance_folder,
                                                 self.cfg['database_debug'])
 
-        # now setup the cache system
+        # now setup the cache system and drop cached responses that
+        # depend on changed models
+        profile.phase('caches')
         self.cache = get_cache(self)
+        self.connect_event('after-models-committed', invalidate_models)
+
+        # the full-text search index is updated for committed posts
+        self.search_index = get_search_index(self)
+        self.connect_event('after-models-committed', update_search_index)
+
+        # notifications and pingbacks are sent by the task queue
+        self.tasks = TaskQueue(self)
+        self.connect_event('after-models-committed', wake_workers)
+
+        # snapshots of the users for the requests
+        from rezine.identity import IdentityCache, invalidate_identities
+        self.identities = IdentityCache(self)
+        self.connect_event('after-models-committed', invalidate_identities)
+
+        # the post counts for the tag cloud and the archive
+        from rezine.aggregates import PostAggregates, update_post_aggregates
+        self.post_aggregates = PostAggregates(self)
+        self.connect_event('after-models-committed', update_post_aggregates)
+
+        # the data of the sidebar widgets
+        from rezine.widgets import WidgetDataStore, invalidate_widget_data
+        self.widget_data = WidgetDataStore(self)
+        self.connect_event('after-models-committed', invalidate_widget_data)
 
         # setup core package urls and shared stuff
+        profile.phase('views and urls')
         import rezine
         from rezine.urls import make_urls
         from rezine.views import all_views, content_type_handlers, \
@@ -720,11 +906,29 @@ class Rezine(object):
         self._template_tests = {}
         self._template_searchpath = []
 
-        # initialize i18n/l10n system
+        # find the plugins
+        profile.phase('plugin discovery')
+        from rezine.pluginsystem import find_plugins, set_plugin_searchpath
+        self.plugin_folder = path.join(instance_folder, 'plugins')
+        self.plugin_searchpath = [self.plugin_folder]
+        for folder in self.cfg['plugin_searchpath']:
+            folder = folder.strip()
+            if folder:
+                self.plugin_searchpath.append(
+                    path.join(self.instance_folder, folder))
+        self.plugin_searchpath.append(BUILTIN_PLUGIN_FOLDER)
+        set_plugin_searchpath(self.plugin_searchpath)
+        plugins = find_plugins(self)
+
+        # initialize i18n/l10n system with the translations of the core
+        # and the active plugins
+        profile.phase('translations')
         self.locale = Locale(self.cfg['language'])
-        self.translations = i18n.load_core_translations(self.locale)
+        self.translations = i18n.load_translations(self,
+            [plugin for plugin in plugins if plugin.active])
 
         # init themes
+        profile.phase('core services')
         _ = i18n.gettext
         default_theme = Theme('default', BUILTIN_TEMPLATE_PATH, {
             'name':         _(u'Default Theme'),
@@ -736,8 +940,8 @@ class Rezine(object):
         self.themes = {'default': default_theme}
 
         self.apis = {}
-        self.importers = {}
-        self.feed_importer_extensions = []
+        self._importers = {}
+        self._feed_importer_extensions = []
 
         # the notification manager
         from rezine.notifications import NotificationManager, \
@@ -754,15 +958,11 @@ class Rezine(object):
         self.pingback_endpoints = pingback.endpoints.copy()
         self.pingback_url_handlers = pingback.url_handlers[:]
 
-        # register our builtin importers
-        from rezine.importers import importers
-        for importer in importers:
-            self.add_importer(importer)
-
-        # and the feed importer extensions
-        from rezine.importers.feed import extensions
-        for extension in extensions:
-            self.add_feed_importer_extension(extension)
+        # register our builtin importers.  Only their URLs are registered,
+        # the importers and the feed importer extensions are imported on
+        # first use.
+        for name, import_name in BUILTIN_IMPORTERS:
+            self.add_importer(import_name, name)
 
         # register the default privileges
         from rezine.privileges import DEFAULT_PRIVILEGES, CONTENT_TYPE_PRIVILEGES
@@ -773,27 +973,16 @@ class Rezine(object):
         from rezine.widgets import all_widgets
         self.widgets = dict((x.name, x) for x in all_widgets)
 
-        # load plugins
-        from rezine.pluginsystem import find_plugins, set_plugin_searchpath
-        self.plugin_folder = path.join(instance_folder, 'plugins')
-        self.plugin_searchpath = [self.plugin_folder]
-        for folder in self.cfg['plugin_searchpath']:
-            folder = folder.strip()
-            if folder:
-                self.plugin_searchpath.append(
-                    path.join(self.instance_folder, folder))
-        self.plugin_searchpath.append(BUILTIN_PLUGIN_FOLDER)
-        set_plugin_searchpath(self.plugin_searchpath)
-
         # load the plugins
         self.plugins = {}
-        for plugin in find_plugins(self):
+        for plugin in plugins:
             if plugin.active:
+                profile.phase('plugin ' + plugin.name)
                 plugin.setup()
-                self.translations.merge(plugin.translations)
             self.plugins[plugin.name] = plugin
 
         # set the active theme based on the config.
+        profile.phase('templates')
         theme = self.cfg['theme']
         if theme not in self.themes:
             log.warning(_(u'Theme “%s” is no longer available, falling back '
@@ -805,7 +994,9 @@ class Rezine(object):
         # init the template system with the core stuff
         from rezine import models
         env = Environment(loader=ThemeLoader(self),
-                          extensions=['jinja2.ext.i18n'])
+                          extensions=['jinja2.ext.i18n'],
+                          auto_reload=self.cfg['template_auto_reload'],
+                          bytecode_cache=self._get_bytecode_cache())
         env.globals.update(
             cfg=self.cfg,
             theme=self.theme,
@@ -843,6 +1034,7 @@ class Rezine(object):
         self.template_env = env
 
         # now add the middleware for static file serving
+        profile.phase('url map')
         self.add_shared_exports('core', SHARED_DATA)
         self.add_middleware(SharedDataMiddleware, self._shared_exports)
 
@@ -866,29 +1058,41 @@ class Rezine(object):
             self.list_parsers()
 
         # register Rezine's upgrade repository
-        from rezine.upgrades import REPOSITORY_PATH
-        self.register_upgrade_repository('Rezine', REPOSITORY_PATH)
+        profile.phase('upgrade repositories')
+        self.register_upgrade_repository('Rezine', UPGRADE_REPOSITORY_PATH)
         # allow plugins to register their upgrade repositories
         emit_event('register-upgrade-repository')
 
         self.initialized = True
 
         #! called after the application and all plugins are initialized
+        profile.phase('setup done event')
         emit_event('application-setup-done')
 
+        profile.finish()
+        if profile.count_objects:
+            self.log.log('notice', unicode(profile.get_report()), 'core')
+
     def register_upgrade_repository(self, repo_id, repo_path):
         """This function is responsible for adding upgrade repositories to the
-        database.
+        database.  The repositories registered during the setup are added by
+        :meth:`check_if_upgrade_required`.
 
         repo_id can be either a string or a Plugin instance, in which case the
         plugin name is used as the repository ID.
         """
-        from rezine.models import SchemaVersion
         from rezine.pluginsystem import Plugin
-        from rezine.upgrades.customisation import Repository
         if isinstance(repo_id, Plugin):
             repo_id = repo_id.metadata.get('name')
         repo_path = path.abspath(repo_path)
+        self.upgrade_repositories[repo_id] = repo_path
+        if self.initialized:
+            self._add_upgrade_repository(repo_id, repo_path)
+
+    def _add_upgrade_repository(self, repo_id, repo_path):
+        """Add the schema version of a repository if it is missing."""
+        from rezine.models import SchemaVersion
+        from rezine.upgrades.customisation import Repository
         try:
             sv = SchemaVersion.query.filter_by(repository_id=repo_id).first()
             if not sv:
@@ -905,15 +1109,64 @@ class Rezine(object):
             db.session.add(SchemaVersion(Repository(repo_path, repo_id)))
             db.session.commit()
 
+    def _get_upgrade_check_key(self):
+        """Return a key for the database, the registered repositories and
+        their upgrade scripts.  Unless it changed, the upgrade check does not
+        have to load the repositories again.
+        """
+        items = [self.cfg['database_uri']]
+        for repo_id, repo_path in sorted(self.upgrade_repositories.items()):
+            items.append((repo_id, repo_path))
+            versions = path.join(repo_path, 'versions')
+            if path.isdir(versions):
+                items.extend(sorted(filename for filename in listdir(versions)
+                                    if filename.endswith('.py')))
+        return md5(repr(items)).hexdigest()
+
+    def _get_schema_versions(self):
+        """Return a sorted list of the ``(repository_id, version)`` tuples
+        in the database or `None` if they cannot be read.
+        """
+        from rezine.database import schema_versions
+        try:
+            return sorted((row.repository_id, row.version) for row in
+                          self.database_engine.execute(db.select(
+                [schema_versions.c.repository_id, schema_versions.c.version])))
+        except SQLAlchemyError:
+            return None
+
     def check_if_upgrade_required(self):
         """Check if all registered schema versions are the latest.
 
         If an upgrade is required, this will raise
         rezine._core.InstanceUpgradeRequired.
+
+        The result and the schema versions of the database are remembered
+        in the instance folder.  Unless the database, the registered
+        repositories or their upgrade scripts changed, only the schema
+        versions are read from the database and compared with the
+        remembered ones.  The repositories are loaded if they differ, for
+        example because an older database was restored.
         """
+        key = self._get_upgrade_check_key()
+        versions = self._get_schema_versions()
+        if versions is not None and not path.isfile(self.upgrade_lockfile):
+            try:
+                f = file(self.upgrade_checkfile)
+                try:
+                    if f.read() == '%s\n%r\n' % (key, versions):
+                        return
+                finally:
+                    f.close()
+            except IOError:
+                pass
+
         from rezine.models import SchemaVersion
         from rezine.upgrades.customisation import Repository
 
+        for repo_id, repo_path in self.upgrade_repositories.iteritems():
+            self._add_upgrade_repository(repo_id, repo_path)
+
         to_upgrade = []
 
         for sv in SchemaVersion.query.all():
@@ -934,6 +1187,15 @@ class Rezine(object):
         if path.isfile(self.upgrade_lockfile):
             remove(self.upgrade_lockfile)
 
+        try:
+            f = file(self.upgrade_checkfile, 'w')
+            try:
+                f.write('%s\n%r\n' % (key, self._get_schema_versions()))
+            finally:
+                f.close()
+        except IOError:
+            pass
+
     def repository_has_upgrade(self, repository, schema_version):
         """Check for available upgrades in one repository."""
         from rezine.models import SchemaVersion
@@ -954,6 +1216,35 @@ class Rezine(object):
             db.session.commit()
             raise _core.InstanceUpgradeRequired()
 
+    def _get_bytecode_cache(self):
+        """Return the cache for the compiled templates in the instance
+        folder.  If the folder is not writable templates are compiled by
+        every process.
+        """
+        directory = path.join(self.instance_folder,
+                              self.cfg['template_cache_path'])
+        try:
+            if not path.isdir(directory):
+                makedirs(directory)
+        except OSError:
+            return None
+        if access(directory, W_OK):
+            return FileSystemBytecodeCache(directory)
+
+    def warm_up(self):
+        """Prepare the application for its first request.  This is called
+        by background reloads before the application is swapped in, so that
+        the first requests do not have to compile the URL map, the common
+        templates or the JavaScript translations.
+        """
+        self.url_map.update()
+        for template_name in WARM_UP_TEMPLATES:
+            try:
+                self.template_env.get_template(template_name)
+            except TemplateNotFound:
+                pass
+        i18n.get_js_translations(self)
+
     @property
     def wants_reload(self):
         """True if the application requires a reload.  This is `True` if
@@ -1011,16 +1302,31 @@ class Rezine(object):
         return url
 
     @setuponly
-    def add_importer(self, importer):
+    def add_importer(self, importer, name=None):
         """Register an importer.  For more information about importers
         see the :mod:`rezine.importers`.
+
+        `importer` is the importer class or its import name, in which case
+        the name of the importer has to be passed as well.  Importers are
+        created when :attr:`importers` is accessed for the first time.
         """
-        importer = importer(self)
-        endpoint = 'import/' + importer.name
-        self.importers[importer.name] = importer
-        self.add_url_rule('/maintenance/import/' + importer.name,
+        if name is None:
+            name = importer.name
+        endpoint = 'import/' + name
+        self._importers[name] = importer
+        self.add_url_rule('/maintenance/import/' + name,
                           prefix='admin', endpoint=endpoint)
-        self.add_view(endpoint, importer)
+        self.add_view(endpoint, lambda request: self.importers[name](request))
+
+    @cached_property
+    def importers(self):
+        """The registered importers by name."""
+        importers = {}
+        for name, importer in self._importers.iteritems():
+            if isinstance(importer, basestring):
+                importer = import_string(importer)
+            importers[name] = importer(self)
+        return importers
 
     @setuponly
     def add_feed_importer_extension(self, extension):
@@ -1030,7 +1336,13 @@ class Rezine(object):
         All blogs that provide feeds that extend Atom (and in the future
         RSS) should be imported by registering an importer here.
         """
-        self.feed_importer_extensions.append(extension)
+        self._feed_importer_extensions.append(extension)
+
+    @cached_property
+    def feed_importer_extensions(self):
+        """The builtin and the registered feed importer extensions."""
+        from rezine.importers.feed import extensions
+        return extensions + self._feed_importer_extensions
 
     @setuponly
     def add_pingback_endpoint(self, endpoint, callback):
@@ -1278,7 +1590,7 @@ class Rezine(object):
                              type='application/rsd+xml', title='RSD'),
             htmlhelpers.script(url_for('core/shared', filename='js/jQuery.js')),
             htmlhelpers.script(url_for('core/shared', filename='js/Rezine.js')),
-            htmlhelpers.script(url_for('blog/serve_translations'))
+            htmlhelpers.script(i18n.get_js_translations_url(self))
         ]
 
         # the url information.  Only expose the admin url for admin users
@@ -1290,7 +1602,7 @@ class Rezine(object):
             'Rezine.BLOG_URL = %s' % dump_json(base_url +
                                              self.cfg['blog_url_prefix'])
         ]
-        if request is None or request.user.is_manager:
+        if request is None or request.identity.is_manager:
             javascript.append('Rezine.ADMIN_URL = %s' %
                               dump_json(base_url +
                                         self.cfg['admin_url_prefix']))
@@ -1349,7 +1661,7 @@ class Rezine(object):
 
     def handle_internal_error(self, request, error, suppress_log=True):
         """Called if internal errors are caught."""
-        if request.user.is_admin:
+        if request.identity.is_admin:
             response = render_response('internal_error.html', error=error)
             response.status_code = 500
             return response
@@ -1374,7 +1686,7 @@ class Rezine(object):
             except NotFound, e:
                 response = self.handle_not_found(request, e)
             except Forbidden, e:
-                if request.user.is_somebody:
+                if request.identity.is_somebody:
                     response = render_response('403.html')
                     response.status_code = 403
                 else:
@@ -1412,6 +1724,9 @@ class Rezine(object):
         local.request_locals = {}
         request.__init__(environ, self)
 
+        # pick up the overlays other processes changed
+        self.theme.check_overlays()
+
         # check if the blog is in maintenance_mode and the user is
         # not an administrator. in that case just show a message that
         # the user is not privileged to view the blog right now. Exception:
@@ -1425,7 +1740,7 @@ class Rezine(object):
            request.path not in (account_prefix, admin_prefix, js_translations) \
            and not (request.path.startswith(admin_prefix + '/') or
                     request.path.startswith(account_prefix + '/')):
-            if not request.user.has_privilege(
+            if not request.identity.has_privilege(
                                         self.privileges['ENTER_ADMIN_PANEL']):
                 response = render_response('maintenance.html')
                 response.status_code = 503
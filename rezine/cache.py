@@ -6,16 +6,46 @@
     This module implements the Rezine caching system.  This is essentially
     a binding to memcached.
 
+    Complete responses can be cached with :func:`response`.  Such responses
+    are tagged (for example with ``post:42`` or ``comments:42``) and dropped
+    from the cache once a model instance that maps to one of these tags is
+    committed to the database.
+
 
     :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 import os
+from time import time, sleep
+from datetime import datetime, date, time as dt_time
+from threading import Lock, Thread
+from cPickle import loads, dumps, HIGHEST_PROTOCOL
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from werkzeug.contrib.cache import BaseCache, NullCache, SimpleCache, \
+     FileSystemCache, MemcachedCache
+
+from rezine.utils import local, local_manager
+from rezine.utils.crypto import gen_random_identifier
+from rezine.utils.datastructures import LRUDict
 
-from werkzeug.contrib.cache import NullCache, SimpleCache, FileSystemCache, \
-     MemcachedCache
 
-from rezine.utils import local
+#: how long the versions of the response cache tags are kept.  If a
+#: version drops out of the cache all responses tagged with it are
+#: treated as invalid.
+TAG_VERSION_TIMEOUT = 60 * 60 * 24 * 7
+
+#: part of every function argument key (see `make_arguments_key`).  Increase
+#: this if the encoding of the arguments changes.
+CACHE_KEY_VERSION = 1
+
+#: the number of seconds a worker may take to recompute a cached result
+#: before another worker takes over.  Expired results are kept for this
+#: long so that they can be served while the new value is computed.
+RECOMPUTE_TIMEOUT = 10
 
 
 def get_cache(app):
@@ -37,7 +67,7 @@ def get_cache_context(vary, eager_caching=False, request=None):
         # doesn't do anything anyways but if one tests for caching to
         # disable some more expensive caculations in the function we can
         # tell him to not perform anything if the cache won't hold the data
-        request.app.cache is NullCache or
+        isinstance(request.app.cache, NullCache) or
 
         # if this is an eager caching method and eager caching is disabled
         # we don't do anything here
@@ -54,7 +84,7 @@ def get_cache_context(vary, eager_caching=False, request=None):
 
 
 def result(cache_key, vary=(), eager_caching=False, timeout=None,
-           admix_arguments=True, skip_posargs=0):
+           admix_arguments=True, skip_posargs=0, stale_timeout=None):
     """Cache the result of the function for a given timeout.  The `vary`
     argument can be used to keep different caches or limit the cache.
     Currently the following `vary` modifiers are available:
@@ -66,25 +96,29 @@ def result(cache_key, vary=(), eager_caching=False, timeout=None,
         cache only if the current request is a GET or HEAD request.
 
     if `admix_arguments` is set to `True` the arguments passed to the function
-    will be hashed and added to the cache key.  If you set `eager_caching` to
+    will be hashed and added to the cache key (see :func:`make_arguments_key`
+    for the supported argument types).  If you set `eager_caching` to
     `True` this method won't do anything if eager caching is disabled.
+
+    Only one worker recomputes an expired result, the others are served
+    the expired value meanwhile or wait for the new one if nothing is
+    cached.  If `stale_timeout` is given the expired value is served for
+    up to that many seconds and the function is called in a background
+    thread to refresh it.  Use this only for functions that do not depend
+    on the current request.
     """
     def decorator(f):
         def oncall(*args, **kwargs):
             request, want_cache = get_cache_context(vary, eager_caching)
+            if not want_cache:
+                return f(*args, **kwargs)
 
-            if want_cache:
-                key = cache_key
-                if admix_arguments:
-                    key += ':%d' % hash((args[skip_posargs:],
-                                        frozenset(kwargs.iteritems())))
-                result = request.app.cache.get(key)
-                if result is not None:
-                    return result
-            result = f(*args, **kwargs)
-            if want_cache:
-                request.app.cache.set(key, result, timeout)
-            return result
+            key = cache_key
+            if admix_arguments:
+                key += ':' + make_arguments_key(request.app,
+                                                args[skip_posargs:], kwargs)
+            return get_result(request.app, key, lambda: f(*args, **kwargs),
+                              timeout, stale_timeout)
 
         try:
             oncall.__name__ = f.__name__
@@ -96,12 +130,272 @@ def result(cache_key, vary=(), eager_caching=False, timeout=None,
     return decorator
 
 
+def make_arguments_key(app, args, kwargs):
+    """Return a key for the arguments of a function call that is the same
+    in every process and interpreter run.  It's a hash over the instance
+    id of the application, the `CACHE_KEY_VERSION` and the arguments.
+
+    Supported are ``None``, booleans, numbers, strings, dates, times,
+    tuples, lists, dicts, sets, database model instances (by primary key)
+    and objects with a `__cache_key__` method that returns one of these.
+    For other objects a `TypeError` is raised.
+    """
+    parts = [app.iid, str(CACHE_KEY_VERSION), encode_key_part(tuple(args)),
+             encode_key_part(kwargs)]
+    return md5('\0'.join(parts)).hexdigest()
+
+
+def encode_key_part(obj):
+    """Encode an object for :func:`make_arguments_key`.  Every value is
+    prefixed with its type and strings with their length so that different
+    arguments never have the same encoding:
+
+    >>> encode_key_part((1, u'foo', None, True))
+    '(i1,u3:foo,n,b1,)'
+    >>> encode_key_part({'b': [1.5], 'a': 2L})
+    '{s1:a=i2,s1:b=[f1.5,],}'
+    >>> from datetime import datetime
+    >>> encode_key_part(datetime(2010, 5, 1, 12, 30))
+    'T2010-05-01T12:30:00'
+    >>> encode_key_part(object())
+    Traceback (most recent call last):
+      ...
+    TypeError: cannot create a cache key for object objects
+    """
+    if obj is None:
+        return 'n'
+    elif isinstance(obj, bool):
+        return 'b%d' % obj
+    elif isinstance(obj, (int, long)):
+        return 'i%d' % obj
+    elif isinstance(obj, float):
+        return 'f' + repr(obj)
+    elif isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+        return 'u%d:%s' % (len(obj), obj)
+    elif isinstance(obj, str):
+        return 's%d:%s' % (len(obj), obj)
+    elif isinstance(obj, datetime):
+        return 'T' + obj.isoformat()
+    elif isinstance(obj, date):
+        return 'D' + obj.isoformat()
+    elif isinstance(obj, dt_time):
+        return 't' + obj.isoformat()
+    elif isinstance(obj, tuple):
+        return '(%s)' % ''.join(encode_key_part(x) + ',' for x in obj)
+    elif isinstance(obj, list):
+        return '[%s]' % ''.join(encode_key_part(x) + ',' for x in obj)
+    elif isinstance(obj, (set, frozenset)):
+        return '<%s>' % ''.join(sorted(encode_key_part(x) + ','
+                                       for x in obj))
+    elif isinstance(obj, dict):
+        return '{%s}' % ''.join(sorted('%s=%s,' % (encode_key_part(key),
+                                                   encode_key_part(value))
+                                       for key, value in obj.iteritems()))
+    elif hasattr(obj, '__cache_key__'):
+        return 'k' + encode_key_part(obj.__cache_key__())
+    elif hasattr(obj, '_sa_instance_state'):
+        from rezine.database import db
+        mapper = db.object_mapper(obj)
+        return 'm%s.%s%s' % (mapper.class_.__module__,
+                             mapper.class_.__name__, encode_key_part(
+                             tuple(mapper.primary_key_from_instance(obj))))
+    raise TypeError('cannot create a cache key for %s objects' %
+                    type(obj).__name__)
+
+
+def get_result(app, key, compute, timeout=None, stale_timeout=None):
+    """Return the cached result for `key` or call `compute` to create it.
+    This implements the locking and stale handling of :func:`result`.
+    """
+    cache = app.cache
+    if timeout is None:
+        timeout = app.cfg['cache_timeout']
+    item = cache.get(key)
+    if isinstance(item, tuple) and len(item) == 2:
+        fresh_until, value = item
+        if fresh_until > time():
+            return value
+        # the value expired.  The worker that gets the lock refreshes it,
+        # everybody else is served the expired value until then.
+        if _acquire_recompute_lock(cache, key):
+            if not stale_timeout:
+                return _store_result(cache, key, compute(), timeout,
+                                     stale_timeout)
+            thread = Thread(target=_refresh_result,
+                            args=(app, key, compute, timeout, stale_timeout))
+            thread.setDaemon(True)
+            thread.start()
+        return value
+
+    # nothing cached.  If another worker computes the value already wait
+    # for it, if it takes too long compute it ourselves.
+    if not _acquire_recompute_lock(cache, key):
+        started = time()
+        while time() < started + RECOMPUTE_TIMEOUT:
+            sleep(0.05)
+            item = cache.get(key)
+            if isinstance(item, tuple) and len(item) == 2:
+                return item[1]
+    return _store_result(cache, key, compute(), timeout, stale_timeout)
+
+
+def _acquire_recompute_lock(cache, key):
+    """Try to get the lock for recomputing `key`.  The lock is released
+    once the new value is stored, if the worker dies it expires after
+    `RECOMPUTE_TIMEOUT` seconds.
+    """
+    # locks have to go to the shared tier of a two tier cache directly,
+    # the local tier would hide the locks of the other processes.
+    cache = getattr(cache, 'shared', cache)
+    lock_key = 'recompute_lock/' + key
+    token = gen_random_identifier()
+    cache.add(lock_key, token, RECOMPUTE_TIMEOUT)
+    return cache.get(lock_key) == token
+
+
+def _release_recompute_lock(cache, key):
+    getattr(cache, 'shared', cache).delete('recompute_lock/' + key)
+
+
+def _store_result(cache, key, value, timeout, stale_timeout):
+    cache.set(key, (time() + timeout, value),
+              timeout + (stale_timeout or RECOMPUTE_TIMEOUT))
+    _release_recompute_lock(cache, key)
+    return value
+
+
+def _refresh_result(app, key, compute, timeout, stale_timeout):
+    """Recompute a result in a background thread."""
+    from rezine.database import cleanup_session
+    from rezine.utils import log
+    try:
+        try:
+            _store_result(app.cache, key, compute(), timeout, stale_timeout)
+        except:
+            log.exception('Could not refresh the cached result %r' % key,
+                          'cache')
+    finally:
+        cleanup_session()
+        local_manager.cleanup()
+
+
+def tag(*tags):
+    """Tag the response of the current request.  If the response is cached
+    by :func:`response` it is removed from the cache as soon as one of the
+    tags is invalidated with :func:`invalidate_tags`.  Outside of requests
+    this function does nothing.
+
+    Call it before the data is loaded.  The versions of the tags are read
+    when the tags are added, so a response that is rendered while one of
+    the tags is invalidated is not cached under the new version.
+    """
+    request_locals = getattr(local, 'request_locals', None)
+    if request_locals is not None:
+        request_locals.setdefault('cache_tags', set()).update(tags)
+        versions = request_locals.get('cache_tag_versions')
+        if versions is not None:
+            missing = [name for name in tags if name not in versions]
+            if missing:
+                from rezine.application import get_application
+                versions.update(_get_tag_versions(get_application().cache,
+                                                  missing, True))
+
+
+def get_model_tags(obj):
+    """Return the cache tags that have to be invalidated if the given model
+    instance changed.
+    """
+    from rezine.models import Post, SummarizedPost, Comment, Category, \
+         Tag, User
+    if isinstance(obj, (Post, SummarizedPost)):
+        return ['post:%d' % obj.id, 'posts']
+    elif isinstance(obj, Comment):
+        return ['comments:%d' % obj.post_id, 'comments']
+    elif isinstance(obj, Category):
+        return ['category:%d' % obj.id, 'categories', 'posts']
+    elif isinstance(obj, Tag):
+        return ['tag:%d' % obj.id, 'tags', 'posts']
+    elif isinstance(obj, User):
+        return ['author:%d' % obj.id]
+    return []
+
+
+def get_post_tags(post):
+    """Return the tags for a page that shows `post` and its comments."""
+    return ['post:%d' % post.id, 'comments:%d' % post.id,
+            'author:%d' % post.author_id, 'categories', 'tags']
+
+
+def invalidate_tags(app, tags):
+    """Invalidate all cached responses tagged with one of the tags."""
+    # the versions are deleted instead of replaced, a missing version does
+    # never match a stored one and deletes reach the local tiers of all
+    # processes if the two tier cache is used.
+    app.cache.delete_many(*map(_tag_version_key, tags))
+
+
+def invalidate_models(instances, deleted=()):
+    """Invalidate the cached responses that depend on the model instances.
+    This is connected to the `after-models-committed` event.
+    """
+    from rezine.application import get_application
+    tags = set()
+    for instance in instances:
+        tags.update(get_model_tags(instance))
+    if tags:
+        invalidate_tags(get_application(), tags)
+
+
+def _tag_version_key(tag):
+    return 'tag_version/' + tag.encode('utf-8')
+
+
+def get_tag_versions(app, tags, create=False):
+    """Return a dict with the current versions of the tags.  Data that
+    was stored with these versions is out of date as soon as one of the
+    versions changes.  If `create` is true, missing versions are created.
+    """
+    return _get_tag_versions(app.cache, tags, create)
+
+
+def _get_tag_versions(cache, tags, create=False):
+    """Return a dict with the current versions of the tags.  If `create`
+    is true, versions for tags that do not have one yet are created.
+    """
+    tags = list(tags)
+    versions = dict(zip(tags, cache.get_many(*map(_tag_version_key, tags))))
+    if create:
+        for name, version in versions.items():
+            if version is None:
+                versions[name] = version = gen_random_identifier()
+                cache.set(_tag_version_key(name), version,
+                          TAG_VERSION_TIMEOUT)
+    return versions
+
+
+def make_response_key(key, request):
+    """Return the cache key for the response of `request`.  Path, query
+    string, theme and language are part of the key.  The result is hashed
+    to stay within the key length limit of memcached.
+    """
+    app = request.app
+    parts = [key, request.path.encode('utf-8'),
+             request.environ.get('QUERY_STRING', ''),
+             app.theme.name.encode('utf-8'), str(app.locale)]
+    return 'response/' + md5('\0'.join(parts)).hexdigest()
+
+
 def response(vary=(), timeout=None, cache_key=None):
     """Cache a complete view function for a number of seconds.  This is a
-    little bit different from `result` because it freezes the response
-    properly and sets etags.  The current request path is added to the cache
-    key to keep them cached properly.  If the response is not 200 no caching
-    is performed.
+    little bit different from `result` because it stores the status, headers
+    and body of the response and sets etags.  The request path, query string
+    and the active theme are added to the cache key to keep the pages cached
+    properly.  If the response is not 200 no caching is performed.
+
+    Cached responses are invalidated by the tags added with :func:`tag`
+    while the view function runs.  The models are mapped to tags by
+    :func:`get_model_tags` and invalidated automatically after a commit.
 
     This method doesn't do anything if eager caching is disabled (by default).
     """
@@ -113,21 +407,41 @@ def response(vary=(), timeout=None, cache_key=None):
         key = cache_key or 'view_func/%s.%s' % (f.__module__, f.__name__)
         def oncall(request, *args, **kwargs):
             use_cache = get_cache_context(vary, True, request)[1]
-            response = None
             if use_cache:
-                cache_key = key + request.path.encode('utf-8')
-                response = request.app.cache.get(cache_key)
+                cache = request.app.cache
+                response_key = make_response_key(key, request)
+                item = cache.get(response_key)
+                tag_versions = {}
+                if item is not None:
+                    status, headers, body, tag_versions = item
+                    if _get_tag_versions(cache, tag_versions) == tag_versions:
+                        response = Response(body, status, headers)
+                        response.make_conditional(request)
+                        return response
+                # the versions of the tags the view had last time are read
+                # before it runs, the others when the view adds the tags.
+                local.request_locals['cache_tag_versions'] = \
+                    _get_tag_versions(cache, tag_versions, True)
 
-            if response is None:
-                response = f(request, *args, **kwargs)
+            response = f(request, *args, **kwargs)
 
             # make sure it's one of our request objects so that we
             # have the `make_conditional` method on it.
-            Response.force_type(response)
+            response = Response.force_type(response)
 
-            if use_cache and response.status_code == 200:
-                response.freeze()
-                request.app.cache.set(key, response, timeout)
+            if use_cache and response.status_code == 200 and \
+               'set-cookie' not in response.headers:
+                response.add_etag()
+                tags = local.request_locals.get('cache_tags', ())
+                versions = local.request_locals['cache_tag_versions']
+                # tags added before the view was called have no version yet
+                versions.update(_get_tag_versions(cache, [name for name in
+                                tags if name not in versions], True))
+                tag_versions = dict((name, versions[name]) for name in tags)
+                cache.set(response_key, (response.status_code,
+                                         list(response.headers),
+                                         response.data, tag_versions),
+                          timeout)
                 response.make_conditional(request)
             return response
         oncall.__name__ = f.__name__
@@ -137,6 +451,194 @@ def response(vary=(), timeout=None, cache_key=None):
     return decorator
 
 
+class TwoTierCache(BaseCache):
+    """Puts a bounded in-process cache in front of a shared cache such as
+    memcached or the filesystem cache.  Values are kept pickled in the
+    local tier, so `max_size` limits the number of bytes and cached objects
+    are never shared between threads.  Local items expire after at most
+    `local_timeout` seconds.
+
+    The keys are grouped into namespaces by the part before the first
+    slash (``tag_version``, ``response`` etc.), keys without a slash such
+    as the ones of :func:`result` share one namespace.  Deleting an item changes
+    the generation of its namespace in the shared cache, clearing the cache
+    changes a global generation.  Every process checks the generations at
+    most every `check_interval` seconds and drops the local items stored
+    under an old one, so invalidating tags does not drop the cached
+    responses or widget data of other processes:
+
+    >>> shared = SimpleCache()
+    >>> first = TwoTierCache(shared, check_interval=0)
+    >>> second = TwoTierCache(shared, check_interval=0)
+    >>> first.set('tag_version/posts', 'a')
+    >>> first.set('response/index', 'page')
+    >>> second.delete('tag_version/posts')
+    >>> first.get('tag_version/posts') is None
+    True
+    >>> first.get('response/index'), first.local_hits
+    ('page', 1)
+    >>> first.set('d41d8cd98f00b204e9800998ecf8427e', 42)
+    >>> sorted(first._generations)
+    ['_', 'response', 'tag_version']
+    >>> second.clear()
+    >>> first.get('response/index') is None
+    True
+    """
+
+    generation_key = 'two_tier/generation'
+
+    def __init__(self, shared, max_size=16 * 1024 * 1024, local_timeout=60,
+                 check_interval=1, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.shared = shared
+        self.local_timeout = local_timeout
+        self.check_interval = check_interval
+        self._local = LRUDict(max_size, sizeof=lambda item: len(item[1]))
+        self._lock = Lock()
+        self._generation = None
+        # the generations of the namespaces seen by this process
+        self._generations = {}
+        self._generation_checked = 0
+        self.local_hits = self.shared_hits = self.misses = 0
+
+    def _get_namespace(self, key):
+        # keys without a slash would all be namespaces of their own
+        if '/' not in key:
+            return '_'
+        return key.split('/', 1)[0]
+
+    def _get_generation_key(self, namespace):
+        return self.generation_key + '/' + namespace
+
+    def _check_generation(self):
+        now = time()
+        if now - self._generation_checked < self.check_interval:
+            return
+        self._generation_checked = now
+        namespaces = self._generations.keys()
+        generations = self.shared.get_many(self.generation_key,
+            *map(self._get_generation_key, namespaces))
+        if generations[0] != self._generation:
+            self._clear_local()
+            self._generation = generations[0]
+        # local items stored under an old generation of their namespace
+        # are dropped when they are looked up
+        self._generations.update(zip(namespaces, generations[1:]))
+
+    def _next_generation(self, keys):
+        namespaces = set(map(self._get_namespace, keys))
+        for namespace in namespaces:
+            generation = gen_random_identifier()
+            self.shared.set(self._get_generation_key(namespace), generation,
+                            TAG_VERSION_TIMEOUT)
+            self._generations[namespace] = generation
+
+    def _clear_local(self):
+        self._lock.acquire()
+        try:
+            self._local.clear()
+        finally:
+            self._lock.release()
+
+    def _set_local(self, key, value, timeout):
+        timeout = min(timeout or self.default_timeout, self.local_timeout)
+        item = (time() + timeout, dumps(value, HIGHEST_PROTOCOL),
+                self._generations.setdefault(self._get_namespace(key), None))
+        self._lock.acquire()
+        try:
+            self._local[key] = item
+        finally:
+            self._lock.release()
+
+    def _pop_local(self, key):
+        self._lock.acquire()
+        try:
+            return self._local.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        self._check_generation()
+        self._lock.acquire()
+        try:
+            item = self._local.get(key)
+        finally:
+            self._lock.release()
+        if item is not None:
+            expires, data, generation = item
+            if expires > time() and generation == \
+               self._generations.get(self._get_namespace(key)):
+                self.local_hits += 1
+                return loads(data)
+            self._pop_local(key)
+        value = self.shared.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.shared_hits += 1
+        self._set_local(key, value, self.local_timeout)
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.shared.set(key, value, timeout)
+        self._set_local(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        self._pop_local(key)
+        self.shared.add(key, value, timeout)
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self._pop_local(key)
+        self._next_generation([key])
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.shared.delete(key)
+            self._pop_local(key)
+        self._next_generation(keys)
+
+    def clear(self):
+        self.shared.clear()
+        self._generation = gen_random_identifier()
+        self.shared.set(self.generation_key, self._generation,
+                        TAG_VERSION_TIMEOUT)
+        self._clear_local()
+
+    def inc(self, key, delta=1):
+        self._pop_local(key)
+        return self.shared.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self._pop_local(key)
+        return self.shared.dec(key, delta)
+
+    def get_stats(self):
+        """Return a list of ``(label, value)`` tuples with the counters
+        of this process.
+        """
+        from rezine.i18n import _
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return [
+            (_(u'Local hits'), self.local_hits),
+            (_(u'Shared hits'), self.shared_hits),
+            (_(u'Misses'), self.misses),
+            (_(u'Hit ratio'), u'%.1f%%' % (lookups and 100.0 *
+                (self.local_hits + self.shared_hits) / lookups)),
+            (_(u'Local items'), len(self._local)),
+            (_(u'Local size'), u'%d / %d KB' % (self._local.size // 1024,
+                                                self._local.max_size // 1024)),
+            (_(u'Evictions'), self._local.evictions)
+        ]
+
+
+def _make_two_tier_cache(app):
+    shared = systems[app.cfg['two_tier_shared_system']](app)
+    return TwoTierCache(shared, app.cfg['local_cache_size'] * 1024,
+                        app.cfg['local_cache_timeout'],
+                        default_timeout=app.cfg['cache_timeout'])
+
+
 #: the cache system factories.
 systems = {
     'null':         lambda app: NullCache(),
@@ -147,5 +649,6 @@ systems = {
     'filesystem':   lambda app: FileSystemCache(
                         os.path.join(app.instance_folder,
                                      app.cfg['filesystem_cache_path']), 500,
-                        app.cfg['cache_timeout'])
+                        app.cfg['cache_timeout']),
+    'two_tier':     _make_two_tier_cache
 }
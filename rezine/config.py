@@ -93,6 +93,15 @@ DEFAULT_VARS = {
         help_text=l_(u'If this is set to true, errors in Rezine '
         u'are not caught so that debuggers can catch it instead.  This is '
         u'useful for plugin and core development.')),
+    'template_auto_reload':     BooleanField(default=_dev_mode,
+        help_text=l_(u'If this is set to true, templates are checked for '
+        u'changes on the file system every time they are rendered.  Leave '
+        u'it disabled on production systems, overlays edited in the admin '
+        u'panel are picked up anyway.')),
+    'profile_startup':          BooleanField(default=False,
+        help_text=l_(u'If this is set to true, the time every part of the '
+        u'application setup and every plugin takes and the number of '
+        u'objects they create is written to the log.')),
 
     # url settings
     'blog_url_prefix':          TextField(default=u'',
@@ -126,12 +135,43 @@ DEFAULT_VARS = {
         (u'null', l_(u'No Cache')),
         (u'simple', l_(u'Simple Cache')),
         (u'memcached', l_(u'memcached')),
-        (u'filesystem', l_(u'Filesystem'))
+        (u'filesystem', l_(u'Filesystem')),
+        (u'two_tier', l_(u'Two-Tier Cache'))
     ], default=u'null'),
+    'two_tier_shared_system':   ChoiceField(choices=[
+        (u'memcached', l_(u'memcached')),
+        (u'filesystem', l_(u'Filesystem'))
+    ], default=u'memcached'),
+    'local_cache_size':         IntegerField(default=16384, min_value=64),
+    'local_cache_timeout':      IntegerField(default=60, min_value=1),
+    'identity_cache_timeout':   IntegerField(default=30, min_value=1, help_text=l_(
+        u'The number of seconds a process caches the privileges of a user.  '
+        u'Changes made by other processes take this long to show up.')),
+    'widget_data_timeout':      IntegerField(default=300, min_value=1, help_text=l_(
+        u'The number of seconds the data of the sidebar widgets is kept.  '
+        u'Posts that are published with a date in the future show up in '
+        u'the widgets after at most this time.')),
     'memcached_servers':        CommaSeparated(TextField(
                                                     validators=[is_netaddr()]),
                                                default=list),
     'filesystem_cache_path':    TextField(default=u'cache'),
+    'template_cache_path':      TextField(default=u'template_cache'),
+
+    # full-text search
+    'search_system':            ChoiceField(choices=[
+        (u'python', l_(u'Python index in the instance folder')),
+        (u'sqlite', l_(u'SQLite full-text search')),
+        (u'postgres', l_(u'PostgreSQL full-text search'))
+    ], default=u'python'),
+    'search_index_path':        TextField(default=u'search_index'),
+
+    # background tasks
+    'task_workers':             IntegerField(default=2, min_value=0,
+                                             help_text=l_(
+        u'The number of threads per process that run background tasks.  If '
+        u'set to zero the tasks have to be run with "rezine-manage '
+        u'run_tasks", for example from a cron job.')),
+    'task_max_attempts':        IntegerField(default=8, min_value=1),
 
     # the default markup parser. Don't ever change the default value! The
     # htmlprocessor module bypasses this test when falling back to
@@ -151,6 +191,11 @@ DEFAULT_VARS = {
         u'The number of days commenting is possible.  If set to zero, comments '
         u'will be open forever.')),
     'pings_enabled':            BooleanField(default=True),
+    'pingback_threads':         IntegerField(default=8, min_value=1, help_text=l_(
+        u'The number of pingbacks that are sent at the same time.')),
+    'pingback_host_limit':      IntegerField(default=2, min_value=1, help_text=l_(
+        u'The number of pingbacks that are sent to one host at the same '
+        u'time.')),
     'plaintext_parser_nolinks': BooleanField(default=False, help_text=l_(
         u'If set to true, the plaintext parser will not create links '
         u'automatically.')),
@@ -162,6 +207,10 @@ DEFAULT_VARS = {
     'use_flat_comments':        BooleanField(default=False),
     'index_content_types':      CommaSeparated(TextField(),
                                                default=lambda: [u'entry']),
+    'stream_responses':         BooleanField(default=True, help_text=l_(
+        u'Send the archive pages and the feeds while they are rendered.  '
+        u'Errors that happen during rendering cannot be shown as error '
+        u'page then.')),
 
     # pages
     'show_page_title':          BooleanField(default=True),
@@ -173,6 +222,9 @@ DEFAULT_VARS = {
     'smtp_user':                TextField(default=u''),
     'smtp_password':            TextField(default=u''),
     'smtp_use_tls':             BooleanField(default=False),
+    'smtp_pool_size':           IntegerField(default=2, min_value=0, help_text=l_(
+        u'The number of SMTP connections per process that are kept open '
+        u'and reused for further mails.')),
 
     # network settings
     'default_network_timeout':  IntegerField(default=5, help_text=l_(
@@ -180,6 +232,13 @@ DEFAULT_VARS = {
         u'The default should be fine for most environments but if you have a '
         u'very bad network connection during development you should increase '
         u'it.')),
+    'http_pool_size':           IntegerField(default=4, min_value=0, help_text=l_(
+        u'The number of idle HTTP connections per host that are kept open '
+        u'for further requests.  Set to zero to close connections after '
+        u'every request.')),
+    'http_pool_idle_timeout':   IntegerField(default=30, min_value=1, help_text=l_(
+        u'The number of seconds after which idle HTTP connections are '
+        u'closed.')),
 
     # plugin settings
     'plugin_guard':             BooleanField(default=not _dev_mode),
@@ -333,7 +392,7 @@ class Configuration(object):
     def __getitem__(self, key):
         """Return the value for a key."""
         if key.startswith('rezine/'):
-            key = key[5:]
+            key = key[7:]
         try:
             return self._converted_values[key]
         except KeyError:
@@ -375,7 +434,7 @@ class Configuration(object):
     def __contains__(self, key):
         """Check if a given key exists."""
         if key.startswith('rezine/'):
-            key = key[5:]
+            key = key[7:]
         return key in self.config_vars
 
     def itervalues(self):
@@ -522,7 +581,7 @@ class ConfigTransaction(object):
             return
 
         if key.startswith('rezine/'):
-            key = key[5:]
+            key = key[7:]
         if key not in self.cfg.config_vars:
             raise KeyError(key)
         if isinstance(value, str):
@@ -544,7 +603,7 @@ class ConfigTransaction(object):
         """Set the value for a key from a string."""
         self._assert_uncommitted()
         if key.startswith('rezine/'):
-            key = key[5:]
+            key = key[7:]
         field = self.cfg.config_vars[key]
         new = from_string(value, field)
         old = self._converted_values.get(key, None) or self.cfg[key]
@@ -554,8 +613,8 @@ class ConfigTransaction(object):
     def revert_to_default(self, key):
         """Revert a key to the default value."""
         self._assert_uncommitted()
-        if key.startswith('rezine'):
-            key = key[5:]
+        if key.startswith('rezine/'):
+            key = key[7:]
         self._remove.append(key)
 
     def update(self, *args, **kwargs):
@@ -23,7 +23,7 @@ from copy import deepcopy
 import sqlalchemy
 from sqlalchemy import orm
 from sqlalchemy.interfaces import ConnectionProxy
-from sqlalchemy.orm.interfaces import AttributeExtension
+from sqlalchemy.orm.interfaces import AttributeExtension, SessionExtension
 from sqlalchemy.exc import ArgumentError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import make_url, URL
@@ -160,7 +160,8 @@ class ZEMLParserData(TypeDecorator):
     def process_result_value(self, value, dialect):
         from rezine.utils.zeml import load_parser_data
         try:
-            return load_parser_data(value)
+            # the values are decoded on first access, not here
+            return load_parser_data(value, lazy=True)
         except ValueError: # Parser data invalid. Database corruption?
             from rezine.i18n import _
             from rezine.utils import log
@@ -200,8 +201,43 @@ class Query(orm.Query):
         return rv
 
 
+class ChangeTrackingExtension(SessionExtension):
+    """Remembers the model instances that were added, changed or deleted
+    in a transaction and emits the `after-models-committed` event with them
+    once the transaction was committed successfully.
+    """
+
+    def after_flush(self, session, flush_context):
+        # the session is still in the pre-flush state here, so new, dirty
+        # and deleted contain the instances affected by this flush.
+        changes = session.__dict__.setdefault('_rezine_changes', {})
+        deleted = session.__dict__.setdefault('_rezine_deleted', {})
+        for state in session.new, session.dirty, session.deleted:
+            for instance in state:
+                changes[id(instance)] = instance
+        for instance in session.deleted:
+            deleted[id(instance)] = instance
+
+    def after_commit(self, session):
+        changes = session.__dict__.pop('_rezine_changes', None)
+        deleted = session.__dict__.pop('_rezine_deleted', None) or {}
+        if changes:
+            from rezine.application import emit_event, get_application
+            if get_application() is not None:
+                #! called after a transaction was committed with a list
+                #! of the model instances that were added, changed or
+                #! deleted in it and a list of the deleted ones.
+                emit_event('after-models-committed', changes.values(),
+                           deleted.values())
+
+    def after_rollback(self, session):
+        session.__dict__.pop('_rezine_changes', None)
+        session.__dict__.pop('_rezine_deleted', None)
+
+
 session = orm.scoped_session(lambda: orm.create_session(get_engine(),
-                             autoflush=True, autocommit=False),
+                             autoflush=True, autocommit=False,
+                             extension=ChangeTrackingExtension()),
                              local_manager.get_ident)
 
 
@@ -396,6 +432,18 @@ notification_subscriptions = db.Table('notification_subscriptions', metadata,
     db.UniqueConstraint('user_id', 'notification_system', 'notification_id')
 )
 
+tasks = db.Table('tasks', metadata,
+    db.Column('task_id', db.Integer, primary_key=True),
+    db.Column('name', db.String(100)),
+    db.Column('arguments', db.PickleType),
+    db.Column('status', db.Integer, nullable=False),
+    db.Column('attempts', db.Integer, nullable=False),
+    db.Column('created', db.DateTime),
+    db.Column('run_at', db.DateTime, index=True),
+    db.Column('locked_until', db.DateTime),
+    db.Column('last_error', db.Text)
+)
+
 
 def init_database(engine):
     """This is called from the websetup which explains why it takes an engine
@@ -61,6 +61,10 @@ LOCALE_DOMAIN = 'messages'
 # translations from non-core plugins
 USE_GETTEXT_LOOKUP = False
 
+# the upgrade repository of the core (the rezine.upgrades package).  The
+# application registers it without importing the package.
+UPGRADE_REPOSITORY_PATH = join(PACKAGE_CONTENTS, 'upgrades')
+
 # check development mode first.  If there is a shared folder we must be
 # in development mode.
 SHARED_DATA = join(PACKAGE_CONTENTS, 'shared')
@@ -207,16 +207,36 @@ class SyndicationFeed(object):
         }
         self.feed.update(kwargs)
         self.items = []
+        self.lazy_items = []
+        self.lazy_pubdates = []
 
-    def add_item(self, title, link, description, author_email=None,
-        author_name=None, author_link=None, pubdate=None, comments=None,
-        unique_id=None, enclosure=None, categories=(), item_copyright=None,
-        ttl=None, **kwargs):
+    def add_item(self, *args, **kwargs):
         """
         Adds an item to the feed. All args are expected to be Python Unicode
         objects except pubdate, which is a datetime.datetime object, and
         enclosure, which is an instance of the Enclosure class.
         """
+        self.items.append(self.make_item(*args, **kwargs))
+
+    def add_items(self, items, latest_pubdate=None):
+        """
+        Adds the items from an iterable of (args, kwargs) tuples with the
+        arguments of add_item(). The iterable is only consumed while the
+        feed is written, so the items can be created lazily. The feed date
+        is written before the items, so the latest pubdate of the items has
+        to be passed as latest_pubdate.
+        """
+        self.lazy_items.append(items)
+        if latest_pubdate is not None:
+            self.lazy_pubdates.append(latest_pubdate)
+
+    def make_item(self, title, link, description, author_email=None,
+        author_name=None, author_link=None, pubdate=None, comments=None,
+        unique_id=None, enclosure=None, categories=(), item_copyright=None,
+        ttl=None, **kwargs):
+        """
+        Returns the dict for an item. Takes the same arguments as add_item().
+        """
         to_unicode = lambda s: force_unicode(s, strings_only=True)
         if categories:
             categories = [to_unicode(c) for c in categories]
@@ -239,7 +259,17 @@ class SyndicationFeed(object):
             'ttl': ttl,
         }
         item.update(kwargs)
-        self.items.append(item)
+        return item
+
+    def iter_items(self):
+        """
+        Iterates over all items, the lazy ones are created now.
+        """
+        for item in self.items:
+            yield item
+        for items in self.lazy_items:
+            for args, kwargs in items:
+                yield self.make_item(*args, **kwargs)
 
     def num_items(self):
         return len(self.items)
@@ -273,7 +303,15 @@ class SyndicationFeed(object):
     def write(self, outfile, encoding):
         """
         Outputs the feed in the given encoding to outfile, which is a file-like
-        object. Subclasses should override this.
+        object.
+        """
+        for part in self.write_parts(SimplerXMLGenerator(outfile, encoding)):
+            pass
+
+    def write_parts(self, handler):
+        """
+        Writes the feed to the XML generator and yields after the header and
+        after every item. Subclasses should override this.
         """
         raise NotImplementedError
 
@@ -286,12 +324,28 @@ class SyndicationFeed(object):
         self.write(s, encoding)
         return s.getvalue()
 
+    def generate(self, encoding, buffer_size=8192):
+        """
+        Returns an iterator over the feed in the given encoding. The items
+        are written while the iterator is consumed, the output is yielded in
+        chunks of at least buffer_size bytes.
+        """
+        from StringIO import StringIO
+        s = StringIO()
+        for part in self.write_parts(SimplerXMLGenerator(s, encoding)):
+            if s.tell() >= buffer_size:
+                yield s.getvalue()
+                s.seek(0)
+                s.truncate()
+        yield s.getvalue()
+
     def latest_post_date(self):
         """
         Returns the latest item's pubdate. If none of them have a pubdate,
         this returns the current date/time.
         """
         updates = [i['pubdate'] for i in self.items if i['pubdate'] is not None]
+        updates.extend(self.lazy_pubdates)
         if len(updates) > 0:
             updates.sort()
             return updates[-1]
@@ -307,13 +361,15 @@ class Enclosure(object):
 
 class RssFeed(SyndicationFeed):
     mime_type = 'application/rss+xml'
-    def write(self, outfile, encoding):
-        handler = SimplerXMLGenerator(outfile, encoding)
+    def write_parts(self, handler):
         handler.startDocument()
         handler.startElement(u"rss", self.rss_attributes())
         handler.startElement(u"channel", self.root_attributes())
         self.add_root_elements(handler)
-        self.write_items(handler)
+        yield None
+        for item in self.iter_items():
+            self.write_item(handler, item)
+            yield None
         self.endChannelElement(handler)
         handler.endElement(u"rss")
 
@@ -322,10 +378,13 @@ class RssFeed(SyndicationFeed):
                 u"xmlns:atom": u"http://www.w3.org/2005/Atom"}
 
     def write_items(self, handler):
-        for item in self.items:
-            handler.startElement(u'item', self.item_attributes(item))
-            self.add_item_elements(handler, item)
-            handler.endElement(u"item")
+        for item in self.iter_items():
+            self.write_item(handler, item)
+
+    def write_item(self, handler, item):
+        handler.startElement(u'item', self.item_attributes(item))
+        self.add_item_elements(handler, item)
+        handler.endElement(u"item")
 
     def add_root_elements(self, handler):
         handler.addQuickElement(u"title", self.feed['title'])
@@ -395,12 +454,14 @@ class Atom1Feed(SyndicationFeed):
     mime_type = 'application/atom+xml'
     ns = u"http://www.w3.org/2005/Atom"
 
-    def write(self, outfile, encoding):
-        handler = SimplerXMLGenerator(outfile, encoding)
+    def write_parts(self, handler):
         handler.startDocument()
         handler.startElement(u'feed', self.root_attributes())
         self.add_root_elements(handler)
-        self.write_items(handler)
+        yield None
+        for item in self.iter_items():
+            self.write_item(handler, item)
+            yield None
         handler.endElement(u"feed")
 
     def root_attributes(self):
@@ -432,10 +493,13 @@ class Atom1Feed(SyndicationFeed):
             handler.addQuickElement(u"rights", self.feed['feed_copyright'])
 
     def write_items(self, handler):
-        for item in self.items:
-            handler.startElement(u"entry", self.item_attributes(item))
-            self.add_item_elements(handler, item)
-            handler.endElement(u"entry")
+        for item in self.iter_items():
+            self.write_item(handler, item)
+
+    def write_item(self, handler, item):
+        handler.startElement(u"entry", self.item_attributes(item))
+        self.add_item_elements(handler, item)
+        handler.endElement(u"entry")
 
     def add_item_elements(self, handler, item):
         handler.addQuickElement(u"title", item['title'])
@@ -22,8 +22,7 @@ from rezine.models import User, Group, Comment, Post, Category, Tag, \
      COMMENT_BLOCKED_USER, COMMENT_BLOCKED_SPAM, COMMENT_DELETED
 from rezine.parsers import render_preview
 from rezine.privileges import bind_privileges
-from rezine.notifications import send_notification_template, NEW_COMMENT, \
-     COMMENT_REQUIRES_MODERATION
+from rezine.notifications import notify_new_comment
 from rezine.utils import forms, log, dump_json
 from rezine.utils.http import redirect_to
 from rezine.utils.validators import ValidationError, is_valid_email, \
@@ -187,16 +186,11 @@ class NewCommentForm(forms.Form):
         # Commit so that make_visible_for_request can access the comment id.
         db.commit()
 
-        # send out a notification if the comment is not spam.  Nobody is
-        # interested in notifications on spam...
-        if not comment.is_spam:
-            if comment.blocked:
-                notification_type = COMMENT_REQUIRES_MODERATION
-            else:
-                notification_type = NEW_COMMENT
-            send_notification_template(notification_type,
-                'notifications/on_new_comment.zeml',
-                user=req.user, comment=comment)
+        # send out a notification if the comment is not spam, unless a
+        # plugin sends it once it decided about the comment
+        if not comment.is_spam and not comment.defer_notification:
+            notify_new_comment(comment, req.user)
+            db.commit()
 
         # Still allow the user to see his comment if it's blocked
         if comment.blocked:
@@ -1155,8 +1149,16 @@ class CacheOptionsForm(_ConfigForm):
                                         help_text=lazy_gettext(u'Enable'))
     memcached_servers = config_field('memcached_servers')
     filesystem_cache_path = config_field('filesystem_cache_path')
+    two_tier_shared_system = config_field('two_tier_shared_system',
+                                          lazy_gettext(u'Shared cache'))
+    local_cache_size = config_field('local_cache_size',
+                                    lazy_gettext(u'Local cache size (KB)'))
+    local_cache_timeout = config_field('local_cache_timeout',
+                                       lazy_gettext(u'Local cache timeout'))
 
     def context_validate(self, data):
+        if data['cache_system'] == 'two_tier':
+            data = dict(data, cache_system=data['two_tier_shared_system'])
         if data['cache_system'] == 'memcached':
             if not data['memcached_servers']:
                 raise ValidationError(_(u'You have to provide at least one '
@@ -1171,6 +1173,10 @@ class MaintenanceModeForm(forms.Form):
     """yet a dummy form, but could be extended later."""
 
 
+class TaskQueueForm(forms.Form):
+    """The form to retry or delete background tasks."""
+
+
 class WordPressImportForm(forms.Form):
     """This form is used in the WordPress importer."""
     download_url = forms.TextField(lazy_gettext(u'Dump Download URL'),
@@ -47,6 +47,12 @@
     To compile the translations into the pickled catalog files just use
     `compile-translations`.
 
+    The application merges the catalogs of the core and the active plugins
+    and stores the result in the instance folder together with the
+    JavaScript translations (see :func:`load_translations`), so the
+    catalogs are only parsed again if one of them or the set of active
+    plugins changes.
+
     New languages are added with `add-translation`.
 
     :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
@@ -54,11 +60,12 @@
 """
 import os
 import cPickle as pickle
+import marshal
 import struct
-from gettext import NullTranslations
-from datetime import datetime
+from gettext import NullTranslations, c2py
+from datetime import datetime, timedelta
+from hashlib import md5
 from time import strptime
-from weakref import WeakKeyDictionary
 
 from babel import Locale, dates, UnknownLocaleError
 from babel.support import Translations as TranslationsBase
@@ -78,7 +85,15 @@ DATE_FORMATS = ['%m/%d/%Y', '%d/%m/%Y', '%Y%m%d', '%d. %m. %Y',
 TIME_FORMATS = ['%H:%M', '%H:%M:%S', '%I:%M %p', '%I:%M:%S %p']
 
 
-_js_translations = WeakKeyDictionary()
+#: the folder in the instance folder with the compiled catalogs
+CATALOG_CACHE_FOLDER = 'translation_cache'
+
+#: the version of the format of the compiled catalogs
+CATALOG_CACHE_VERSION = 1
+
+#: the number of seconds browsers may cache the JavaScript translations if
+#: the URL contains their hash
+JS_TRANSLATIONS_MAX_AGE = 365 * 24 * 60 * 60
 
 
 def load_core_translations(locale):
@@ -97,15 +112,111 @@ def load_core_translations(locale):
                                  USE_GETTEXT_LOOKUP)
 
 
+def load_translations(app, plugins):
+    """Load the translations of the core and the given plugins for the
+    locale of the application merged into one translations object.
+
+    The merged catalog is compiled into the translation cache folder in
+    the instance folder.  The name of the compiled catalog is made from the
+    locale and the paths, sizes and modification times of the catalogs, so
+    a new one is compiled if a catalog or the set of plugins changes.
+    """
+    locale = app.locale
+    catalogs = [find_catalog(LOCALE_PATH, LOCALE_DOMAIN, locale,
+                             USE_GETTEXT_LOOKUP)]
+    for plugin in plugins:
+        catalogs.append(find_catalog(os.path.join(plugin.path, 'i18n'),
+                                     'messages', locale))
+    stats = []
+    for catalog in catalogs:
+        if catalog is not None:
+            stat = os.stat(catalog)
+            stats.append((catalog, stat.st_mtime, stat.st_size))
+    if not stats:
+        return RezineNullTranslations(locale=locale)
+
+    folder = os.path.join(app.instance_folder, CATALOG_CACHE_FOLDER)
+    prefix = str(locale) + '-'
+    filename = os.path.join(folder, prefix + md5(repr(
+        (CATALOG_CACHE_VERSION, stats))).hexdigest() + '.cat')
+    try:
+        f = open(filename, 'rb')
+        try:
+            return CompiledTranslations(marshal.load(f), locale)
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    data = compile_catalogs([catalog for catalog, mtime, size in stats],
+                            locale)
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # other processes might load the catalog at the same time
+        tmp_filename = '%s.%d' % (filename, os.getpid())
+        f = open(tmp_filename, 'wb')
+        try:
+            marshal.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp_filename, filename)
+        for name in os.listdir(folder):
+            if name.startswith(prefix) and name.endswith('.cat') and \
+               name != os.path.basename(filename):
+                os.remove(os.path.join(folder, name))
+    except (IOError, OSError):
+        pass
+    return CompiledTranslations(data, locale)
+
+
+def compile_catalogs(catalogs, locale):
+    """Merge the catalogs and return the data of a compiled catalog.  The
+    messages of later catalogs override the messages of earlier ones, the
+    plural forms are taken from the first catalog.
+    """
+    info = None
+    messages = {}
+    client_messages = {}
+    for catalog in catalogs:
+        f = open(catalog, 'rb')
+        try:
+            translations = RezineTranslations(fileobj=f, locale=locale)
+        finally:
+            f.close()
+        if info is None:
+            info = translations._info
+        messages.update(translations._catalog)
+        client_messages.update((k.id, k.string) for k in
+                               translations.client_keys)
+    code = make_js_translations(client_messages, _get_plural_expr(info),
+                                locale)
+    return CATALOG_CACHE_VERSION, info, messages, code
+
+
+def make_js_translations(messages, plural_expr, locale):
+    """Return the JavaScript code that adds the client translations."""
+    return 'Rezine.addTranslations(%s)' % dump_json(dict(
+        messages=messages,
+        plural_expr=plural_expr,
+        locale=str(locale)
+    ))
+
+
+def _get_plural_expr(info):
+    return (info or {}).get('plural-forms', 'nplurals=2; plural=(n != 1)') \
+        .split(';')[1].strip()[len('plural='):]
+
+
 class _CustomAttrsTranslations(object):
     _info = None
     _plural_expr = None
+    _js_code = None
+    _js_hash = None
 
     def _get_plural_expr(self):
         if not self._plural_expr:
-            self._plural_expr = self._info.get(
-                'plural-forms', 'nplurals=2; plural=(n != 1)'
-            ).split(';')[1].strip()[len('plural='):]
+            self._plural_expr = _get_plural_expr(self._info)
         return self._plural_expr
 
     def _set_plural_expr(self, plural_expr):
@@ -114,6 +225,22 @@ class _CustomAttrsTranslations(object):
     plural_expr = property(_get_plural_expr, _set_plural_expr)
     del _get_plural_expr, _set_plural_expr
 
+    @property
+    def js_code(self):
+        """The JavaScript code that adds the client translations."""
+        if self._js_code is None:
+            self._js_code = make_js_translations(dict(
+                (k.id, k.string) for k in self.client_keys),
+                self.plural_expr, self.locale)
+        return self._js_code
+
+    @property
+    def js_hash(self):
+        """A hash of :attr:`js_code` for the URL of the translations."""
+        if self._js_hash is None:
+            self._js_hash = md5(self.js_code).hexdigest()[:12]
+        return self._js_hash
+
 
 class RezineTranslations(TranslationsBase, _CustomAttrsTranslations):
 
@@ -154,6 +281,23 @@ class RezineTranslations(TranslationsBase, _CustomAttrsTranslations):
         return bool(self._catalog)
 
 
+class CompiledTranslations(RezineTranslations):
+    """The merged translations loaded from a catalog compiled by
+    :func:`load_translations`.  The messages used on the client are only
+    available as :attr:`js_code`, `client_keys` is empty.
+    """
+
+    def __init__(self, data, locale=None):
+        RezineTranslations.__init__(self, locale=locale)
+        version, info, messages, code = data
+        if version != CATALOG_CACHE_VERSION:
+            raise ValueError('incompatible catalog')
+        self._info = info or {}
+        self._catalog = messages
+        self._js_code = code
+        self.plural = c2py(self.plural_expr)
+
+
 class RezineNullTranslations(NullTranslations, _CustomAttrsTranslations):
 
     def __init__(self, fileobj=None, locale=None):
@@ -544,18 +688,33 @@ def get_locale():
     return app.locale
 
 
+def get_js_translations(app):
+    """Return the JavaScript code with the client translations of the
+    application.  The code is generated once per application.
+    """
+    return app.translations.js_code
+
+
+def get_js_translations_url(app):
+    """Return the URL of the JavaScript translations.  The URL contains the
+    hash of the code, so browsers may cache it forever.
+    """
+    return rezine.application.url_for('blog/serve_translations',
+                                      v=app.translations.js_hash)
+
+
 def serve_javascript(request):
-    """Serves the JavaScript translations."""
-    code = _js_translations.get(request.app)
-    if code is None:
-        t = request.app.translations
-        code = 'Rezine.addTranslations(%s)' % dump_json(dict(
-            messages=dict((k.id, k.string) for k in t.client_keys),
-            plural_expr=t.plural_expr,
-            locale=str(t.locale)
-        ))
-        _js_translations[request.app] = code
-    response = rezine.application.Response(code, mimetype='application/javascript')
+    """Serves the JavaScript translations.  If the requested version is the
+    current one the response may be cached forever.
+    """
+    translations = request.app.translations
+    response = rezine.application.Response(translations.js_code,
+                                           mimetype='application/javascript')
+    if request.args.get('v') == translations.js_hash:
+        response.cache_control.public = True
+        response.cache_control.max_age = JS_TRANSLATIONS_MAX_AGE
+        response.expires = datetime.utcnow() + \
+            timedelta(seconds=JS_TRANSLATIONS_MAX_AGE)
     response.add_etag()
     response.make_conditional(request)
     return response
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    rezine.identity
+    ~~~~~~~~~~~~~~~
+
+    Every request needs to know who the user is and what they may do, but
+    only few requests need the user model itself.  This module keeps
+    immutable snapshots of users with their privilege bitmasks, so that
+    the request setup does not have to load the user with its groups and
+    privileges from the database every time.
+
+    The snapshot of the current user is available as `request.identity`,
+    `request.user` is loaded on first access.  Snapshots are dropped if
+    users or groups are changed in this process and expire after
+    `identity_cache_timeout` seconds so that changes made by other
+    processes show up as well.
+
+    :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from time import time
+from threading import Lock
+
+from rezine.database import db
+from rezine.privileges import get_privilege_mask, ENTER_ADMIN_PANEL, \
+     BLOG_ADMIN
+from rezine.utils.datastructures import LRUDict
+
+
+#: the maximum number of snapshots per process
+IDENTITY_CACHE_SIZE = 1000
+
+
+class Identity(object):
+    """An immutable snapshot of a user.  It supports the parts of the user
+    interface that are needed for privilege checks and to display who is
+    logged in.
+    """
+    __slots__ = ('id', 'username', 'real_name', 'display_name', 'email',
+                 'www', 'is_author', 'group_ids', 'privileges',
+                 'privilege_mask')
+    is_somebody = True
+
+    def __init__(self, user):
+        self._set(id=user.id, username=user.username,
+                  real_name=user.real_name, display_name=user.display_name,
+                  email=user.email, www=user.www, is_author=user.is_author,
+                  group_ids=frozenset(group.id for group in user.groups),
+                  privileges=user.privileges,
+                  privilege_mask=get_privilege_mask(user.privileges))
+
+    def _set(self, **values):
+        for name, value in values.iteritems():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('identities are immutable')
+
+    def has_privilege(self, privilege):
+        """Check if the user has a given privilege."""
+        if privilege is None:
+            privilege = BLOG_ADMIN
+        return privilege.check_admin(self.privilege_mask)
+
+    @property
+    def is_manager(self):
+        return self.has_privilege(ENTER_ADMIN_PANEL)
+
+    @property
+    def is_admin(self):
+        return self.has_privilege(BLOG_ADMIN)
+
+    def get_url_values(self):
+        if self.is_author:
+            return 'blog/show_author', {
+                'username': self.username
+            }
+        return self.www or '#'
+
+    def __repr__(self):
+        return '<%s %r>' % (
+            self.__class__.__name__,
+            self.username
+        )
+
+
+class AnonymousIdentity(Identity):
+    """The identity of anonymous users.
+
+    >>> ANONYMOUS.is_somebody, ANONYMOUS.has_privilege(ENTER_ADMIN_PANEL)
+    (False, False)
+    >>> ANONYMOUS.id = 1
+    Traceback (most recent call last):
+      ...
+    AttributeError: identities are immutable
+    """
+    __slots__ = ()
+    is_somebody = False
+
+    def __init__(self):
+        self._set(id=-1, username='', real_name='', display_name='Nobody',
+                  email=None, www=None, is_author=False,
+                  group_ids=frozenset(), privileges=frozenset(),
+                  privilege_mask=0)
+
+    def __nonzero__(self):
+        return False
+
+
+#: there is only one anonymous identity
+ANONYMOUS = AnonymousIdentity()
+
+
+def get_identity(user):
+    """Return the identity for a user object."""
+    if not user.is_somebody:
+        return ANONYMOUS
+    return Identity(user)
+
+
+def invalidate_identities(instances, deleted=()):
+    """Drop the snapshots of changed users.  If a group changed all
+    snapshots are dropped.  This is connected to the
+    `after-models-committed` event.
+    """
+    from rezine.application import get_application
+    from rezine.models import User, Group
+    user_ids = []
+    for instance in instances:
+        if isinstance(instance, Group):
+            user_ids = None
+            break
+        elif isinstance(instance, User):
+            user_ids.append(instance.id)
+    if user_ids != []:
+        get_application().identities.invalidate(user_ids)
+
+
+class IdentityCache(object):
+    """A process wide cache of identities by user id."""
+
+    def __init__(self, app):
+        self.app = app
+        self.timeout = app.cfg['identity_cache_timeout']
+        self.hits = self.misses = 0
+        self._cache = LRUDict(IDENTITY_CACHE_SIZE)
+        self._lock = Lock()
+
+    def get(self, user_id):
+        """Return the identity of the user or `None` if there is no user
+        with that id.
+        """
+        now = time()
+        self._lock.acquire()
+        try:
+            item = self._cache.get(user_id)
+        finally:
+            self._lock.release()
+        if item is not None and item[0] > now:
+            self.hits += 1
+            return item[1]
+
+        self.misses += 1
+        from rezine.models import User
+        user = User.query.options(db.eagerload('groups'),
+                                  db.eagerload('groups', '_privileges')) \
+                         .get(user_id)
+        if user is None:
+            return
+        identity = Identity(user)
+        self._lock.acquire()
+        try:
+            self._cache[user_id] = (now + self.timeout, identity)
+        finally:
+            self._lock.release()
+        return identity
+
+    def invalidate(self, user_ids=None):
+        """Drop the identities of the given users or all."""
+        self._lock.acquire()
+        try:
+            if user_ids is None:
+                self._cache.clear()
+            else:
+                for user_id in user_ids:
+                    self._cache.pop(user_id, None)
+        finally:
+            self._lock.release()
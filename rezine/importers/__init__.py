@@ -518,7 +518,3 @@ class Comment(_Element):
             self.author
         )
 
-
-from rezine.importers.wordpress import WordPressImporter
-from rezine.importers.feed import FeedImporter
-importers = [WordPressImporter, FeedImporter]
@@ -123,6 +123,21 @@ def main():
         create_instance(instance, database_uri, admin_username,
                         admin_password, admin_email)
 
+    def action_rebuild_search_index(instance=('I', DEFAULT_INSTANCE_FOLDER)):
+        '''Rebuild the full-text search index from all posts.'''
+        from rezine import setup_rezine
+        from rezine.search import rebuild_search_index
+
+        rebuild_search_index(setup_rezine(instance))
+
+    def action_run_tasks(instance=('I', DEFAULT_INSTANCE_FOLDER)):
+        '''Run the background tasks that are due.'''
+        from rezine import setup_rezine
+
+        app = setup_rezine(instance)
+        while app.tasks.run_next():
+            pass
+
     def action_shell(instance=('I', DEFAULT_INSTANCE_FOLDER)):
         """Start a new interactive python session."""
 
@@ -9,7 +9,7 @@
     :license: BSD, see LICENSE for more details.
 """
 from math import log
-from datetime import date, datetime, timedelta
+from datetime import datetime, timedelta
 from urlparse import urljoin
 
 from werkzeug.exceptions import NotFound
@@ -17,15 +17,16 @@ from werkzeug.exceptions import NotFound
 from rezine.database import users, categories, posts, post_links, \
      post_categories, post_tags, tags, comments, groups, group_users, \
      privileges, user_privileges, group_privileges, texts, \
-     notification_subscriptions, schema_versions, db
+     notification_subscriptions, schema_versions, tasks, db
 from rezine.utils import zeml
 from rezine.utils.text import gen_slug, gen_timestamped_slug, build_tag_uri, \
      increment_string
-from rezine.utils.pagination import Pagination
+from rezine.utils.pagination import Pagination, CurrentTime, \
+     get_keyset_page
 from rezine.utils.crypto import gen_pwhash, check_pwhash
 from rezine.utils.http import make_external_url
 from rezine.privileges import _Privilege, privilege_attribute, \
-     add_admin_privilege, MODERATE_COMMENTS, ENTER_ADMIN_PANEL, BLOG_ADMIN, \
+     get_privilege_mask, MODERATE_COMMENTS, ENTER_ADMIN_PANEL, BLOG_ADMIN, \
      VIEW_DRAFTS, VIEW_PROTECTED, MODERATE_OWN_ENTRIES, MODERATE_OWN_PAGES
 from rezine.application import get_application, get_request, url_for
 
@@ -50,6 +51,10 @@ MODERATE_NONE = 0
 MODERATE_ALL = 1
 MODERATE_UNKNOWN = 2
 
+#: Task Status
+TASK_PENDING = 0
+TASK_FAILED = 1
+
 
 class _ZEMLContainer(object):
     """A mixin for objects that have ZEML markup stored."""
@@ -71,8 +76,9 @@ class _ZEMLContainer(object):
     def touch_parser_data(self):
         """Mark the parser data as modified."""
         # this is enough for sqlalchemy to pick it up as as change.
-        # it will only compare the object's identity.
-        self.parser_data = dict(self.parser_data)
+        # it will only compare the object's identity.  copy() keeps
+        # values of lazily loaded parser data undecoded.
+        self.parser_data = self.parser_data.copy()
 
     def _get_parser(self):
         if self.parser_data is not None:
@@ -87,15 +93,32 @@ class _ZEMLContainer(object):
     parser = property(_get_parser, _set_parser, doc="The name of the parser.")
     del _get_parser, _set_parser
 
+    def _get_tree(self, key):
+        """Return a tree from the parser data with the prerendered HTML
+        attached if it's available and up to date.
+        """
+        if self.parser_data is None:
+            return
+        tree = self.parser_data.get(key)
+        if tree is not None and \
+           self.parser_data.get('html_version') == zeml.PRERENDER_VERSION:
+            tree.prerendered = self.parser_data.get(key + '_html')
+        return tree
+
+    def _set_tree(self, key, tree):
+        """Store a tree and its prerendered HTML in the parser data."""
+        self.parser_data[key] = tree
+        self.parser_data[key + '_html'] = zeml.prerender(tree)
+        self.parser_data['html_version'] = zeml.PRERENDER_VERSION
+
     @property
     def body(self):
         """The body as ZEML element."""
-        if self.parser_data is not None:
-            return self.parser_data.get('body')
+        return self._get_tree('body')
 
     def _parse_text(self, text):
         from rezine.parsers import parse
-        self.parser_data['body'] = parse(text, self.parser, self.parser_reason)
+        self._set_tree('body', parse(text, self.parser, self.parser_reason))
 
     def _get_text(self):
         return self._text
@@ -133,14 +156,15 @@ class _ZEMLDualContainer(_ZEMLContainer):
 
     def _parse_text(self, text):
         from rezine.parsers import parse
-        self.parser_data['intro'], self.parser_data['body'] = \
-            zeml.split_intro(parse(text, self.parser, self.parser_reason))
+        intro, body = zeml.split_intro(parse(text, self.parser,
+                                             self.parser_reason))
+        self._set_tree('intro', intro)
+        self._set_tree('body', body)
 
     @property
     def intro(self):
         """The intro as zeml element."""
-        if self.parser_data is not None:
-            return self.parser_data.get('intro')
+        return self._get_tree('intro')
 
 
 class CommentCounterExtension(db.AttributeExtension):
@@ -245,12 +269,19 @@ class User(object):
             result.update(group.privileges)
         return frozenset(result)
 
+    @property
+    def privilege_mask(self):
+        """The privileges as bitmask."""
+        return get_privilege_mask(self.privileges)
+
     def has_privilege(self, privilege):
         """Check if the user has a given privilege.  If the user has the
         BLOG_ADMIN privilege he automatically has all the other privileges
         as well.
         """
-        return add_admin_privilege(privilege)(self.privileges)
+        if privilege is None:
+            privilege = BLOG_ADMIN
+        return privilege.check_admin(self.privilege_mask)
 
     def set_password(self, password):
         self.pw_hash = gen_pwhash(password)
@@ -290,7 +321,9 @@ class Group(object):
     privileges = privilege_attribute('_privileges')
 
     def has_privilege(self, privilege):
-        return add_admin_privilege(privilege)(self.privileges)
+        if privilege is None:
+            privilege = BLOG_ADMIN
+        return privilege.check_admin(get_privilege_mask(self.privileges))
 
     def get_url_values(self):
         # TODO: a public view is missing!
@@ -310,6 +343,7 @@ class AnonymousUser(User):
     display_name = 'Nobody'
     real_name = description = username = ''
     own_privileges = privileges = property(lambda x: frozenset())
+    privilege_mask = 0
 
     def __init__(self):
         pass
@@ -339,13 +373,13 @@ class _PostQueryBase(db.Query):
         """Return a queryset for only published posts."""
         if not user:
             req = get_request()
-            user = req and req.user
+            user = req and req.identity
 
         if ignore_privileges or not user:
             # Anonymous. Return only public entries.
             return self.filter(
                 (Post.status == STATUS_PUBLISHED) &
-                (Post.pub_date <= datetime.utcnow())
+                (Post.pub_date <= CurrentTime.utcnow())
             )
         elif not user.has_privilege(VIEW_PROTECTED):
             # Authenticated user without protected viewing privilege
@@ -354,7 +388,7 @@ class _PostQueryBase(db.Query):
                 ((Post.status == STATUS_PUBLISHED) |
                  ((Post.status == STATUS_PRIVATE) &
                   (Post.author_id == user.id))) &
-                (Post.pub_date <= datetime.utcnow())
+                (Post.pub_date <= CurrentTime.utcnow())
             )
         else:
             # Authenticated and can view protected.
@@ -364,7 +398,7 @@ class _PostQueryBase(db.Query):
                  (Post.status == STATUS_PROTECTED) |
                  ((Post.status == STATUS_PRIVATE) &
                   (Post.author_id == user.id))) &
-                (Post.pub_date <= datetime.utcnow())
+                (Post.pub_date <= CurrentTime.utcnow())
             )
 
     def drafts(self, ignore_user=False, user=None):
@@ -373,8 +407,8 @@ class _PostQueryBase(db.Query):
         """
         if user is None and not ignore_user:
             req = get_request()
-            if req and req.user:
-                user = req.user
+            if req and req.identity:
+                user = req.identity
         query = self.filter(Post.status == STATUS_DRAFT)
         if user is not None:
             query = query.filter(Post.author_id == user.id)
@@ -390,16 +424,15 @@ class _PostQueryBase(db.Query):
             per_page = app.cfg['posts_per_page']
 
         # send the query
-        offset = per_page * (page - 1)
-        postlist = self.order_by(Post.pub_date.desc()) \
-                       .offset(offset).limit(per_page).all()
+        postlist, total = get_keyset_page(self, [(Post.pub_date, True),
+                                                 (Post.id, True)],
+                                          page, per_page, ['posts'])
 
         # if raising exceptions is wanted, raise it
         if raise_if_empty and (page != 1 and not postlist):
             raise NotFound()
 
-        pagination = Pagination(endpoint, page, per_page,
-                                self.count(), url_args)
+        pagination = Pagination(endpoint, page, per_page, total, url_args)
 
         return {
             'pagination':       pagination,
@@ -410,60 +443,20 @@ class _PostQueryBase(db.Query):
                             ignore_privileges=False):
         """Query function to get the archive of the blog. Usually used
         directly from the templates to add some links to the sidebar.
+        Only the years, months or days with posts are returned, the number
+        of posts is in `counts`.
         """
-        # XXX: currently we also return months without articles in it.
-        # other blog systems do not, but because we use sqlalchemy we have
-        # to go with the functionality provided.  Currently there is no way
-        # to do date truncating in a database agnostic way.  When this is done
-        # ignore_privileges should no longer be a noop
-        last = self.filter(Post.pub_date != None) \
-                   .order_by(Post.pub_date.asc()).first()
-        now = datetime.utcnow()
-
-        there_are_more = False
-        result = []
-
-        if last is not None:
-            now = date(now.year, now.month, now.day)
-            oldest = date(last.pub_date.year, last.pub_date.month,
-                          last.pub_date.day)
-            result = [now]
-
-            there_are_more = False
-            if detail == 'years':
-                now, oldest = [x.replace(month=1, day=1) for x in now, oldest]
-                while True:
-                    now = now.replace(year=now.year - 1)
-                    if now < oldest:
-                        break
-                    result.append(now)
-                else:
-                    there_are_more = True
-            elif detail == 'months':
-                now, oldest = [x.replace(day=1) for x in now, oldest]
-                while limit is None or len(result) < limit:
-                    if not now.month - 1:
-                        now = now.replace(year=now.year - 1, month=12)
-                    else:
-                        now = now.replace(month=now.month - 1)
-                    if now < oldest:
-                        break
-                    result.append(now)
-                else:
-                    there_are_more = True
-            elif detail == 'days':
-                while limit is None or len(result) < limit:
-                    now = now - timedelta(days=1)
-                    if now < oldest:
-                        break
-                    result.append(now)
-                else:
-                    there_are_more = True
-            else:
-                raise ValueError('detail must be years, months, or days')
+        # XXX: the summary comes from the post counts of the application
+        # and is the same for every query.  It contains the published posts
+        # of the index content types.  ignore_privileges is a noop.
+        result = get_application().post_aggregates.get_archive_counts(detail)
+        there_are_more = limit is not None and len(result) > limit
+        if limit is not None:
+            result = result[:limit]
 
         return {
-            detail:     result,
+            detail:     [item for item, count in result],
+            'counts':   dict(result),
             'more':     there_are_more,
             'empty':    not result
         }
@@ -493,16 +486,55 @@ class _PostQueryBase(db.Query):
         )
 
     def search(self, query):
-        """Search for posts by a query."""
-        # XXX: use a sophisticated search
-        q = self
-        for word in query.split():
-            q = q.filter(
-                posts.c.body.like('%%%s%%' % word) |
-                posts.c.intro.like('%%%s%%' % word) |
-                posts.c.title.like('%%%s%%' % word)
-            )
-        return q.all()
+        """Search for posts by a query.  The posts are ordered by relevance,
+        the best match first.
+        """
+        return self._get_search_results(self._search_ids(query))
+
+    def get_search_list(self, query, endpoint=None, page=1, per_page=None,
+                        url_args=None, raise_if_empty=True):
+        """Like :meth:`get_list` but for the posts that match a search
+        query, ordered by relevance.
+        """
+        if per_page is None:
+            app = get_application()
+            per_page = app.cfg['posts_per_page']
+
+        post_ids = self._search_ids(query)
+        offset = per_page * (page - 1)
+        postlist = self._get_search_results(post_ids[offset:offset +
+                                                     per_page])
+
+        if raise_if_empty and (page != 1 and not postlist):
+            raise NotFound()
+
+        pagination = Pagination(endpoint, page, per_page,
+                                len(post_ids), url_args)
+
+        return {
+            'pagination':       pagination,
+            'posts':            postlist
+        }
+
+    def _search_ids(self, query):
+        """The ids of the posts in this query that match the search query,
+        the best match first.
+        """
+        post_ids = get_application().search_index.search(query)
+        visible = set()
+        # the index knows about all posts, the query filters by status
+        # and privileges.  Chunks keep the number of parameters low.
+        for idx in xrange(0, len(post_ids), 500):
+            visible.update(row[0] for row in self.filter(
+                Post.id.in_(post_ids[idx:idx + 500])).values(Post.id))
+        return [post_id for post_id in post_ids if post_id in visible]
+
+    def _get_search_results(self, post_ids):
+        if not post_ids:
+            return []
+        posts = dict((post.id, post) for post in
+                     self.filter(Post.id.in_(post_ids)))
+        return [posts[post_id] for post_id in post_ids if post_id in posts]
 
 
 class _PostBase(object):
@@ -643,11 +675,11 @@ class _PostBase(object):
     def can_edit(self, user=None):
         """Checks if the given user (or current user) can edit this post."""
         if user is None:
-            user = get_request().user
+            user = get_request().identity
 
         return (
             user.has_privilege(self.EDIT_OTHER_PRIVILEGE) or
-            (self.author == user and
+            (self.author_id == user.id and
              user.has_privilege(self.EDIT_OWN_PRIVILEGE))
         )
 
@@ -662,7 +694,7 @@ class _PostBase(object):
             return True
 
         if user is None:
-            user = get_request().user
+            user = get_request().identity
 
         # users that are allowed to look at drafts may pass
         if user.has_privilege(VIEW_DRAFTS):
@@ -938,7 +970,7 @@ class CommentQuery(db.Query):
         elif not ignore_privileges:
             req = get_request()
             if req:
-                user = req.user
+                user = req.identity
                 if not user.has_privilege(MODERATE_COMMENTS |
                                           MODERATE_OWN_ENTRIES |
                                           MODERATE_OWN_PAGES):
@@ -952,7 +984,7 @@ class CommentQuery(db.Query):
 
     def for_user(self, user=None):
         request = get_request()
-        user = user or request.user
+        user = user or request.identity
         if user.has_privilege(MODERATE_COMMENTS):
             return self
         elif user.has_privilege(MODERATE_OWN_ENTRIES | MODERATE_OWN_PAGES):
@@ -973,6 +1005,10 @@ class Comment(_ZEMLContainer):
     query = db.query_property(CommentQuery)
     parser_reason = 'comment'
 
+    #: plugins that decide about a new comment after it was saved set
+    #: this and send the notification about the comment themselves.
+    defer_notification = False
+
     def __init__(self, post, author, text, email=None, www=None, parent=None,
                  pub_date=None, submitter_ip='0.0.0.0', parser=None,
                  is_pingback=False, status=COMMENT_MODERATED):
@@ -1090,8 +1126,8 @@ class Comment(_ZEMLContainer):
         """Check if the current user or the user given can see this comment"""
         request = get_request()
         if user is None:
-            user = request.user
-        if self.post.author is user and \
+            user = request.identity
+        if self.post.author_id == user.id and \
            user.has_privilege(MODERATE_OWN_ENTRIES | MODERATE_OWN_PAGES):
             return True
         elif user.has_privilege(MODERATE_COMMENTS):
@@ -1113,7 +1149,7 @@ class Comment(_ZEMLContainer):
         request = get_request()
         if request is None:
             return True
-        return self.visible_for_user(request.user)
+        return self.visible_for_user(request.identity)
 
     @property
     def visible_children(self):
@@ -1173,39 +1209,18 @@ class TagQuery(db.Query):
         # XXX: ignore_privileges is currently ignored and no privilege
         # checking is performed.  As a matter of fact only published posts
         # appear in the cloud.
-
-        # get a query
-        pt = post_tags.c
-        p = posts.c
-        t = tags.c
-
-        q = ((pt.tag_id == t.tag_id) &
-             (pt.post_id == p.post_id) &
-             (p.status == STATUS_PUBLISHED) &
-             (p.pub_date <= datetime.utcnow()))
-
-        s = db.select(
-            [t.tag_id, t.slug, t.name,
-             db.func.count(p.post_id).label('s_count')],
-            q, group_by=[t.slug, t.name, t.tag_id]).alias('post_count_query').c
-
-        options = {'order_by': [db.asc(s.s_count)]}
-        if max is not None:
-            options['limit'] = max
-
-        # the label statement circumvents a bug for sqlite3 on windows
-        # see #65
-        q = db.select([s.tag_id, s.slug, s.name, s.s_count.label('s_count')],
-                      **options)
-
         items = [{
-            'id':       row.tag_id,
-            'slug':     row.slug,
-            'name':     row.name,
-            'count':    row.s_count,
-            'size':     100 + log(row.s_count or 1) * 20
-        } for row in db.execute(q)]
+            'id':       tag_id,
+            'slug':     slug,
+            'name':     name,
+            'count':    count,
+            'size':     100 + log(count or 1) * 20
+        } for tag_id, slug, name, count in
+            get_application().post_aggregates.get_tag_counts()]
 
+        if max is not None:
+            items.sort(key=lambda x: x['count'])
+            del items[max:]
         items.sort(key=lambda x: x['name'].lower())
         return items
 
@@ -1274,6 +1289,51 @@ class NotificationSubscription(object):
         )
 
 
+class TaskQuery(db.Query):
+    """Adds extra query methods for tasks."""
+
+    def pending(self):
+        """Only the tasks that are waiting to be run."""
+        return self.filter(Task.status == TASK_PENDING)
+
+    def failed(self):
+        """Only the tasks that failed too often and are no longer run."""
+        return self.filter(Task.status == TASK_FAILED)
+
+
+class Task(object):
+    """A task in the queue of background tasks.  Tasks are stored with the
+    next commit and run by :class:`rezine.tasks.TaskQueue`.
+    """
+
+    query = db.query_property(TaskQuery)
+
+    def __init__(self, name, args=(), kwargs=None, run_at=None):
+        self.name = name
+        self.arguments = (tuple(args), kwargs or {})
+        self.status = TASK_PENDING
+        self.attempts = 0
+        self.created = datetime.utcnow()
+        self.run_at = run_at or self.created
+
+    @property
+    def is_failed(self):
+        return self.status == TASK_FAILED
+
+    def retry(self):
+        """Schedule a failed task again."""
+        self.status = TASK_PENDING
+        self.attempts = 0
+        self.run_at = datetime.utcnow()
+        self.locked_until = None
+
+    def __repr__(self):
+        return '<%s %r>' % (
+            self.__class__.__name__,
+            self.name
+        )
+
+
 # connect the tables.
 db.mapper(SchemaVersion, schema_versions)
 db.mapper(User, users, properties={
@@ -1383,3 +1443,6 @@ db.mapper(NotificationSubscription, notification_subscriptions, properties={
                             )
                         )
 })
+db.mapper(Task, tasks, properties={
+    'id':               tasks.c.task_id
+})
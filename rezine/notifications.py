@@ -22,7 +22,8 @@ from rezine.application import get_application, get_request, render_template
 from rezine.privileges import BLOG_ADMIN, ENTER_ACCOUNT_PANEL, MODERATE_COMMENTS,\
      MODERATE_OWN_PAGES, MODERATE_OWN_ENTRIES
 from rezine.utils.zeml import parse_zeml
-from rezine.utils.mail import send_email
+from rezine.utils.mail import EMail, send_email, send_emails
+from rezine.tasks import enqueue
 from rezine.i18n import lazy_gettext
 
 
@@ -115,6 +116,21 @@ def send_notification_template(type, template_name, user=Ellipsis, **context):
     send_notification(type, notification, user)
 
 
+def notify_new_comment(comment, user=Ellipsis):
+    """Send the notification about a new comment.  Nobody is interested
+    in notifications on spam, so nothing is sent for spam.  Blocked
+    comments are announced as waiting for moderation.
+    """
+    if comment.is_spam:
+        return
+    if comment.blocked:
+        type = COMMENT_REQUIRES_MODERATION
+    else:
+        type = NEW_COMMENT
+    send_notification_template(type, 'notifications/on_new_comment.zeml',
+                               user=user, comment=comment)
+
+
 class NotificationType(object):
     """There are different kinds of notifications. E.g. you want to
     send a special type of notification after a comment is saved.
@@ -135,6 +151,7 @@ class Notification(object):
     """
 
     def __init__(self, id, message, user=Ellipsis):
+        self.source = message
         self.message = parse_zeml(message, 'system')
         self.id = id
         self.sent_date = datetime.utcnow()
@@ -177,6 +194,19 @@ class NotificationSystem(object):
     def send(self, user, notification):
         raise NotImplementedError()
 
+    def send_many(self, users, notification):
+        """Send the notification to many users.  Returns a list of the
+        users the notification could not be sent to.  Systems that can
+        deliver many messages at once should override this.
+        """
+        failed = []
+        for user in users:
+            try:
+                self.send(user, notification)
+            except Exception:
+                failed.append(user)
+        return failed
+
 
 class EMailNotificationSystem(NotificationSystem):
     """Sends notifications to user via E-Mail."""
@@ -190,7 +220,19 @@ class EMailNotificationSystem(NotificationSystem):
             notification.title.to_text()
         )
         text = self.mail_from_notification(notification)
-        send_email(title, text, [user.email])
+        send_email(title, text, [user.email], quiet=False)
+
+    def send_many(self, users, notification):
+        # the text is the same for all users and the mails are sent over
+        # one pooled SMTP connection
+        title = u'[%s] %s' % (
+            self.app.cfg['blog_title'],
+            notification.title.to_text()
+        )
+        text = self.mail_from_notification(notification)
+        emails = dict((EMail(title, text, [user.email]), user)
+                      for user in users)
+        return [emails[email] for email, error in send_emails(emails.keys())]
 
     def unquote_link(self, link):
         """Unquotes some kinds of links.  For example mailto:foo links are
@@ -269,6 +311,9 @@ class NotificationManager(object):
         self.notification_types = DEFAULT_NOTIFICATION_TYPES.copy()
 
     def send(self, notification):
+        """Queue the notification for all subscribed users.  The
+        notifications are sent after the next commit.
+        """
         # given the type of the notification, check what users want that
         # notification; via what system and call the according
         # notification system in order to finally deliver the message
@@ -280,10 +325,18 @@ class NotificationManager(object):
                 NotificationSubscription.user!=notification.user
             )
 
+        # the notifications are delivered by the task queue after the
+        # next commit so that requests do not wait for remote servers.
+        # There is one task per system so that systems can send them
+        # in one batch.
+        recipients = {}
         for subscription in subscriptions.all():
-            system = self.systems.get(subscription.notification_system)
-            if system is not None:
-                system.send(subscription.user, notification)
+            if subscription.notification_system in self.systems:
+                recipients.setdefault(subscription.notification_system,
+                                      []).append(subscription.user.id)
+        for system, user_ids in recipients.iteritems():
+            enqueue('send-notification', system, user_ids,
+                    notification.id.name, notification.source)
 
     def types(self, user=None):
         if not user:
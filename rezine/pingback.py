@@ -27,7 +27,10 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
-from xmlrpclib import ServerProxy
+from hashlib import sha1
+from threading import Thread, Semaphore, Lock
+from urlparse import urlsplit
+from xmlrpclib import ServerProxy, Transport, ProtocolError
 
 from werkzeug.routing import RequestRedirect, NotFound
 from werkzeug import unescape
@@ -37,11 +40,20 @@ from rezine.models import Post, Comment
 from rezine.utils.exceptions import UserException
 from rezine.utils.xml import XMLRPC, Fault, strip_tags
 from rezine.utils.net import open_url, NetException
+from rezine.utils import local_manager
 
 
 _title_re = re.compile(r'<title>(.*?)</title>(?i)')
 _pingback_re = re.compile(r'<link rel="pingback" href="([^"]+)" ?/?>(?i)')
 _chunk_re = re.compile(r'\n\n|<(?:p|div|h\d)[^>]*>')
+_head_end_re = re.compile(r'</head>|<body(?i)')
+
+#: only this many bytes of a target page are searched for the pingback
+#: link.  The link has to be in the head of the page anyways.
+HEAD_LIMIT = 32768
+
+#: the number of seconds the pingback server of a page is cached
+ENDPOINT_CACHE_TIMEOUT = 24 * 60 * 60
 
 
 class PingbackError(UserException):
@@ -101,20 +113,8 @@ def pingback(source_uri, target_uri):
     """Try to notify the server behind `target_uri` that `source_uri`
     points to `target_uri`.  If that fails an `PingbackError` is raised.
     """
-    try:
-        response = open_url(target_uri)
-    except:
-        raise PingbackError(32)
-
-    try:
-        pingback_uri = response.headers['X-Pingback']
-    except KeyError:
-        match = _pingback_re.search(response.data)
-        if match is None:
-            raise PingbackError(33)
-        pingback_uri = unescape(match.group(1))
-
-    rpc = ServerProxy(pingback_uri)
+    pingback_uri = find_pingback_server(target_uri)
+    rpc = ServerProxy(pingback_uri, transport=_PooledTransport(pingback_uri))
     try:
         return rpc.pingback.ping(source_uri, target_uri)
     except Fault, e:
@@ -123,6 +123,149 @@ def pingback(source_uri, target_uri):
         raise PingbackError(32)
 
 
+def find_pingback_server(target_uri):
+    """Return the URL of the pingback server for `target_uri` or raise a
+    `PingbackError` if the page does not exist or has no pingback server.
+    Only the head of the page is read and the result is cached.
+    """
+    app = get_application()
+    cache_key = 'pingback_server/' + sha1(target_uri.encode('utf-8')) \
+        .hexdigest()
+    pingback_uri = app.cache.get(cache_key)
+    if pingback_uri is None:
+        try:
+            response = open_url(target_uri)
+        except:
+            raise PingbackError(32)
+        try:
+            pingback_uri = response.headers.get('X-Pingback')
+            if pingback_uri is None:
+                match = _pingback_re.search(_read_head(response))
+                pingback_uri = match and unescape(match.group(1)) or u''
+        finally:
+            response.close()
+        # pages without a pingback server are cached as well
+        app.cache.set(cache_key, pingback_uri, ENDPOINT_CACHE_TIMEOUT)
+    if not pingback_uri:
+        raise PingbackError(33)
+    return pingback_uri
+
+
+def _read_head(response):
+    """Read the response until the end of the HTML head."""
+    buffer = []
+    size = 0
+    try:
+        for chunk in response.response:
+            buffer.append(chunk)
+            size += len(chunk)
+            # the tag could be split between two chunks
+            if size >= HEAD_LIMIT or _head_end_re.search(''.join(buffer[-2:])):
+                break
+    except Exception:
+        if not buffer:
+            raise PingbackError(32)
+    return ''.join(buffer)[:HEAD_LIMIT]
+
+
+class _PooledTransport(Transport):
+    """Sends XML-RPC requests with `open_url` so that the connections to
+    pingback servers are reused.
+    """
+
+    def __init__(self, uri):
+        Transport.__init__(self)
+        self.uri = uri
+
+    def request(self, host, handler, request_body, verbose=0):
+        response = open_url(self.uri, request_body, method='POST',
+                            headers={'Content-Type': 'text/xml'},
+                            allow_internal_requests=False)
+        try:
+            if response.status_code != 200:
+                raise ProtocolError(host + handler, response.status_code,
+                                    response.status, response.headers)
+            parser, unmarshaller = self.getparser()
+            parser.feed(response.data)
+            parser.close()
+            return unmarshaller.close()
+        finally:
+            response.close()
+
+
+def pingback_many(source_uri, target_uris):
+    """Send pingbacks for many targets at once.  The pingbacks are sent by
+    up to `pingback_threads` threads with at most `pingback_host_limit`
+    concurrent requests per host.  Returns a list of ``(target_uri,
+    error)`` tuples for the pingbacks that failed.
+    """
+    app = get_application()
+    by_host = {}
+    for target_uri in target_uris:
+        by_host.setdefault(urlsplit(target_uri).netloc, []).append(target_uri)
+    host_limits = dict((host, Semaphore(app.cfg['pingback_host_limit']))
+                       for host in by_host)
+
+    # interleave the hosts so that the threads do not wait for each other
+    # on the limit of one host while the other hosts are idle
+    jobs = []
+    queues = by_host.values()
+    while queues:
+        for queue in queues:
+            jobs.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    jobs.reverse()
+
+    failed = []
+    lock = Lock()
+    def fail(target_uri, error):
+        lock.acquire()
+        try:
+            failed.append((target_uri, error))
+        finally:
+            lock.release()
+
+    def work():
+        from rezine.database import cleanup_session
+        from rezine.utils import log
+        try:
+            while 1:
+                lock.acquire()
+                try:
+                    if not jobs:
+                        return
+                    target_uri = jobs.pop()
+                finally:
+                    lock.release()
+                limit = host_limits[urlsplit(target_uri).netloc]
+                limit.acquire()
+                try:
+                    try:
+                        pingback(source_uri, target_uri)
+                    except PingbackError, e:
+                        fail(target_uri, e)
+                    except Exception, e:
+                        # an unexpected error must not stop the thread,
+                        # the other targets are still pinged
+                        log.exception('Could not ping %r' % target_uri,
+                                      'pingback')
+                        fail(target_uri, PingbackError(0, str(e)))
+                finally:
+                    limit.release()
+        finally:
+            cleanup_session()
+            local_manager.cleanup()
+
+    threads = [Thread(target=work, name='rezine-pingback') for x in
+               xrange(min(app.cfg['pingback_threads'], len(jobs)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
+
+
 def handle_pingback_request(source_uri, target_uri):
     """This method is exported via XMLRPC as `pingback.ping` by the
     pingback API.
@@ -5,10 +5,16 @@
 
     Do spam checking via Akismet of comments.
 
+    New comments are saved as unmoderated and checked by a background task
+    so that commenters do not wait for Akismet.  The verdicts are cached by
+    a fingerprint of the comment, so reposted spam is blocked right away.
+
     :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 from os.path import dirname, join
+from hashlib import sha1
+from threading import Thread, Lock
 
 from werkzeug import url_encode
 
@@ -16,7 +22,10 @@ import rezine
 from rezine.api import *
 from rezine.widgets import Widget
 from rezine.views.admin import flash, render_admin_response
-from rezine.models import COMMENT_BLOCKED_SPAM, Comment
+from rezine.models import COMMENT_MODERATED, COMMENT_UNMODERATED, \
+     COMMENT_BLOCKED_SPAM, Comment
+from rezine.tasks import enqueue
+from rezine.notifications import notify_new_comment
 from rezine.privileges import BLOG_ADMIN, MODERATE_COMMENTS, require_privilege
 from rezine.utils.validators import ValidationError, check
 from rezine.utils.http import redirect_to
@@ -30,11 +39,15 @@ AKISMET_VERSION = '1.1'
 SHARED = join(dirname(__file__), 'shared')
 TEMPLATES = join(dirname(__file__), 'templates')
 BLOCKED_MSG = _('blocked by akismet')
+PENDING_MSG = _('waiting for the spam check')
 
+#: the number of seconds verified keys and verdicts are cached
+KEY_CACHE_TIMEOUT = 24 * 60 * 60
+VERDICT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
 
-#: because we need the information about verified keys quite often
-#: we store verified keys here.
-_verified_keys = set()
+#: the number of concurrent requests when the moderation queue is
+#: checked again
+RECHECK_THREADS = 4
 
 
 class InvalidKey(ValueError):
@@ -46,7 +59,10 @@ class InvalidKey(ValueError):
 
 
 def send_request(apikey, key_root, data, endpoint):
-    """Send a request to the akismet server and return the response."""
+    """Send a request to the akismet server and return the response.  The
+    key is added here, it is not part of the data stored with a comment.
+    """
+    data = dict(data, key=apikey)
     url = 'http://%s%s/%s/%s' % (
         key_root and apikey + '.' or '',
         AKISMET_URL_BASE,
@@ -69,12 +85,16 @@ def is_valid_key(message=None, memorize=False):
         message = _('The key is invalid.')
 
     def validate(form, apikey):
-        blog_url = get_application().cfg['blog_url']
-        cachekey = (apikey, blog_url)
-        if cachekey in _verified_keys:
+        app = get_application()
+        blog_url = app.cfg['blog_url']
+        # verified keys are stored in the shared cache so that all
+        # processes verify a key only once
+        cachekey = 'akismet_spam_filter/key/' + sha1('%s|%s' % (
+            apikey.encode('utf-8'), blog_url.encode('utf-8'))).hexdigest()
+        if app.cache.get(cachekey):
             return
 
-        data = {'key': apikey, 'blog': blog_url}
+        data = {'blog': blog_url}
         resp = send_request(apikey, False, data, 'verify-key')
         if resp is None:
             raise ValidationError(_('Could not verify key because of a '
@@ -82,7 +102,7 @@ def is_valid_key(message=None, memorize=False):
         elif resp != 'valid':
             raise ValidationError(message)
         if memorize:
-            _verified_keys.add(cachekey)
+            app.cache.set(cachekey, True, KEY_CACHE_TIMEOUT)
     return validate
 
 
@@ -95,19 +115,25 @@ def get_akismet_key():
     if key and check(is_valid_key, key, memorize=True):
         return key
 
+
 class ConfigurationForm(forms.Form):
     """The configuration form."""
     api_key = forms.TextField(validators=[is_valid_key()])
 
 
+class RecheckForm(forms.Form):
+    """Checks the moderation queue again."""
+
+
 def build_akismet_data(req, comment):
-    """build the akismet data dictionary"""
+    """build the akismet data dictionary.  The key is returned separately
+    so that the data can be stored with the spam check task.
+    """
     apikey = get_akismet_key()
     if apikey is None:
         return None, None
 
     data = {
-        'key':                  apikey,
         'blog':                 get_application().cfg['blog_url'],
         'user_ip':              comment.submitter_ip,
         'user_agent':           USER_AGENT,
@@ -129,8 +155,57 @@ def build_akismet_data(req, comment):
     return apikey, data
 
 
+def get_fingerprint(data):
+    """Return the verdict cache key for the akismet data of a comment."""
+    fingerprint = sha1()
+    for key in 'comment_author', 'comment_author_email', \
+               'comment_author_url', 'comment_content', 'user_ip':
+        fingerprint.update((data[key] or u'').encode('utf-8'))
+        fingerprint.update('\0')
+    return 'akismet_spam_filter/verdict/' + fingerprint.hexdigest()
+
+
+def check_spam(apikey, data):
+    """Ask akismet if a comment is spam.  Returns `True` or `False` or
+    `None` if akismet could not be reached.  The verdict is cached.
+    """
+    cache = get_application().cache
+    cachekey = get_fingerprint(data)
+    verdict = cache.get(cachekey)
+    if verdict is None:
+        resp = send_request(apikey, True, data, 'comment-check')
+        if resp not in ('true', 'false'):
+            return
+        verdict = resp == 'true'
+        cache.set(cachekey, verdict, VERDICT_CACHE_TIMEOUT)
+    return verdict
+
+
+def apply_verdict(comment, is_spam):
+    """Block the comment if it is spam, otherwise release it from the
+    spam check.  Comments that were moderated already are left alone.
+    The new comment notification held back by the spam check is sent
+    when the comment is released.
+    """
+    if comment.status != COMMENT_UNMODERATED:
+        return
+    if is_spam:
+        comment.status = COMMENT_BLOCKED_SPAM
+        comment.blocked_msg = BLOCKED_MSG
+    elif comment.blocked_msg == PENDING_MSG:
+        if comment.requires_moderation:
+            comment.blocked_msg = _(u'Comment waiting for approval')
+        else:
+            comment.status = COMMENT_MODERATED
+            comment.blocked_msg = None
+        notify_new_comment(comment, comment.user)
+
+
 def do_spamcheck(req, comment):
-    """Do spamchecking for all new comments."""
+    """Do spamchecking for all new comments.  Comments with a known
+    verdict are handled right away, the others are held back until the
+    background check is done.
+    """
     # something blocked the comment already. no need to check for spam then.
     if comment.blocked:
         return
@@ -139,10 +214,85 @@ def do_spamcheck(req, comment):
     if not (data or apikey):
         return
 
-    resp = send_request(apikey, True, data, 'comment-check')
-    if resp == 'true':
+    verdict = get_application().cache.get(get_fingerprint(data))
+    if verdict:
         comment.status = COMMENT_BLOCKED_SPAM
         comment.blocked_msg = BLOCKED_MSG
+    elif verdict is None:
+        comment.status = COMMENT_UNMODERATED
+        comment.blocked_msg = PENDING_MSG
+        comment._akismet_data = data
+        # the notification is sent by the check once the verdict is known
+        comment.defer_notification = True
+
+
+def queue_spamcheck(req, comment):
+    """Queue the background check for a comment held back by
+    `do_spamcheck`.
+    """
+    data = getattr(comment, '_akismet_data', None)
+    if data is not None:
+        # the task needs the id of the comment
+        db.flush()
+        enqueue('akismet_spam_filter/check', comment.id, data)
+        del comment._akismet_data
+
+
+def run_spamcheck(comment_id, data):
+    """The task that checks a comment held back by `do_spamcheck`."""
+    comment = Comment.query.get(comment_id)
+    if comment is None:
+        return
+    apikey = get_application().cfg['akismet_spam_filter/apikey']
+    if not apikey:
+        # the key was removed since, there is nothing to check against
+        is_spam = False
+    else:
+        is_spam = check_spam(apikey, data)
+        if is_spam is None:
+            # the task queue tries again later
+            raise RuntimeError('akismet could not be reached')
+    apply_verdict(comment, is_spam)
+    db.commit()
+
+
+def recheck_comments(comments):
+    """Check the comments again with a pool of threads.  Returns the
+    number of comments that were blocked as spam.
+    """
+    jobs = []
+    for comment in comments:
+        apikey, data = build_akismet_data(None, comment)
+        if data is None:
+            return 0
+        jobs.append((comment, apikey, data))
+    results = []
+    lock = Lock()
+
+    def work():
+        while 1:
+            lock.acquire()
+            try:
+                if not jobs:
+                    return
+                comment, apikey, data = jobs.pop()
+            finally:
+                lock.release()
+            results.append((comment, check_spam(apikey, data)))
+
+    threads = [Thread(target=work) for x in
+               xrange(min(RECHECK_THREADS, len(jobs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    blocked = 0
+    for comment, is_spam in results:
+        if is_spam is not None:
+            apply_verdict(comment, is_spam)
+            blocked += bool(is_spam)
+    return blocked
 
 
 def do_submit_spam(comment):
@@ -197,8 +347,19 @@ def show_akismet_config(req):
     form = ConfigurationForm(initial=dict(
         api_key=req.app.cfg['akismet_spam_filter/apikey']
     ))
+    recheck_form = RecheckForm()
+
+    if req.method == 'POST' and 'recheck' in req.form and \
+       recheck_form.validate(req.form):
+        comments = Comment.query.unmoderated().all()
+        blocked = recheck_comments(comments)
+        db.commit()
+        flash(_('%d of %d comments in the moderation queue were blocked '
+                'as spam.') % (blocked, len(comments)), 'ok')
+        return redirect_to('akismet_spam_filter/config')
 
-    if req.method == 'POST' and form.validate(req.form):
+    if req.method == 'POST' and 'recheck' not in req.form and \
+       form.validate(req.form):
         if form.has_changed:
             req.app.cfg.change_single('akismet_spam_filter/apikey',
                                       form['api_key'])
@@ -209,7 +370,8 @@ def show_akismet_config(req):
         return redirect_to('akismet_spam_filter/config')
     return render_admin_response('admin/akismet_spam_filter.html',
                                  'options.akismet_spam_filter',
-                                 form=form.as_widget())
+                                 form=form.as_widget(),
+                                 recheck_form=recheck_form.as_widget())
 
 @require_privilege(MODERATE_COMMENTS)
 def show_akismet_stats(req):
@@ -253,6 +415,8 @@ def setup(app, plugin):
                      endpoint='akismet_spam_filter/stats',
                      view=show_akismet_stats)
     app.connect_event('before-comment-saved', do_spamcheck)
+    app.connect_event('after-comment-saved', queue_spamcheck)
+    app.tasks.register('akismet_spam_filter/check', run_spamcheck)
     app.connect_event('before-comment-mark-spam', do_submit_spam)
     app.connect_event('before-comment-mark-ham', do_submit_ham)
     app.connect_event('modify-admin-navigation-bar', add_akismet_links)
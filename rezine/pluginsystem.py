@@ -82,12 +82,12 @@ import __builtin__
 import re
 import sys
 import inspect
-from os import path, listdir, walk, makedirs
+from os import path, listdir, walk, makedirs, rename, getpid
 from types import ModuleType
 from shutil import rmtree
 from time import localtime, time
+from pickle import dump, load, HIGHEST_PROTOCOL
 
-import pkg_resources
 from urllib import quote
 from werkzeug import cached_property, escape
 
@@ -109,6 +109,13 @@ _managed_applications = {}
 
 PACKAGE_VERSION = 1
 
+#: the file in the instance folder that remembers the plugins found by
+#: :func:`find_plugins`
+PLUGIN_MANIFEST = '.plugin_manifest'
+
+#: the version of the manifest format
+MANIFEST_VERSION = 1
+
 
 def get_object_name(obj):
     """Return a human readable name for the object."""
@@ -126,15 +133,70 @@ def get_object_name(obj):
 
 
 def find_plugins(app):
-    """Return an iterator over all plugins available."""
+    """Return a sorted list of all plugins available.  The plugins found
+    are remembered in a manifest in the instance folder, the plugin folders
+    and the installed distributions are only searched again if one of the
+    folders or the metadata of a plugin changed.
+    """
     enabled_plugins = set()
-    found_plugins = set()
-    plugins = []
     for plugin in app.cfg['plugins']:
         plugin = plugin.strip()
         if plugin:
             enabled_plugins.add(plugin)
 
+    manifest = load_plugin_manifest(app)
+    if manifest is None:
+        manifest = build_plugin_manifest(app)
+        save_plugin_manifest(app, manifest)
+
+    plugins = []
+    for item in manifest['plugins']:
+        if item[0] == 'filesystem':
+            name, folder, metadata = item[1:]
+            plugin = FilesystemPlugin(app, name, folder,
+                                      name in enabled_plugins, metadata)
+        else:
+            name, module_name, location, dist_version, metadata = item[1:]
+            plugin = EntryPointPlugin(app, name, module_name, location,
+                                      dist_version, name in enabled_plugins,
+                                      metadata)
+        plugins.append(plugin)
+    return sorted(plugins)
+
+
+def _get_mtime(filename):
+    """Return the modification time of a file or `None` if it is missing."""
+    try:
+        return path.getmtime(filename)
+    except OSError:
+        return None
+
+
+def load_metadata(folder):
+    """Load the metadata of the plugin in the folder.  If the plugin has no
+    metadata an empty dict is returned.
+    """
+    try:
+        f = file(path.join(folder, 'metadata.txt'))
+    except IOError:
+        return {}
+    try:
+        return parse_metadata(f)
+    finally:
+        f.close()
+
+
+def build_plugin_manifest(app):
+    """Search the plugin searchpath and the entry points of the installed
+    distributions for plugins.  The manifest lists the plugins found with
+    their metadata and the modification times of the folders and files
+    that were looked at.
+    """
+    import pkg_resources
+    found_plugins = set()
+    items = []
+    folders = list(app.plugin_searchpath) + list(sys.path)
+
     for folder in app.plugin_searchpath:
         if not path.isdir(folder):
             continue
@@ -144,24 +206,87 @@ def find_plugins(app):
                 path.isdir(full_name) and
                 path.isfile(path.join(full_name, 'metadata.txt'))):
                 found_plugins.add(filename)
-                plugins.append(FilesystemPlugin(app, str(filename),
-                                                path.abspath(full_name),
-                                                filename in enabled_plugins))
+                full_name = path.abspath(full_name)
+                items.append(('filesystem', str(filename), full_name,
+                              load_metadata(full_name)))
+                folders.append(path.join(full_name, 'metadata.txt'))
                 log.info('added filesystem plugin "%s" - %s'
                          % (filename, full_name))
 
     for ep in pkg_resources.iter_entry_points('rezine_plugins'):
         if ep.name not in found_plugins:
             found_plugins.add(ep.name)
-            plugins.append(EntryPointPlugin(app, ep,
-                                            ep.name in enabled_plugins))
+            folder = get_entry_point_path(ep.module_name, ep.dist.location)
+            items.append(('entry_point', ep.name, ep.module_name,
+                          ep.dist.location, ep.dist.version,
+                          load_metadata(folder)))
+            folders.append(path.join(folder, 'metadata.txt'))
             log.info('added entry point plugin "%s" - %s'
                      % (ep.name, str(ep)))
         else:
             log.info('skipped entry point plugin "%s" - %s'
                      % (ep.name, str(ep)))
 
-    return sorted(plugins)
+    return {
+        'version':      MANIFEST_VERSION,
+        'searchpath':   list(app.plugin_searchpath),
+        'sys_path':     list(sys.path),
+        'mtimes':       [(x, _get_mtime(x)) for x in folders],
+        'plugins':      items
+    }
+
+
+def load_plugin_manifest(app):
+    """Load the plugin manifest from the instance folder.  If there is no
+    manifest or if something changed since it was built `None` is returned.
+    """
+    try:
+        f = file(path.join(app.instance_folder, PLUGIN_MANIFEST), 'rb')
+    except IOError:
+        return
+    try:
+        try:
+            manifest = load(f)
+        except Exception:
+            return
+    finally:
+        f.close()
+    if not isinstance(manifest, dict) or \
+       manifest.get('version') != MANIFEST_VERSION or \
+       manifest['searchpath'] != app.plugin_searchpath or \
+       manifest['sys_path'] != sys.path:
+        return
+    for filename, mtime in manifest['mtimes']:
+        if _get_mtime(filename) != mtime:
+            return
+    return manifest
+
+
+def save_plugin_manifest(app, manifest):
+    """Save the plugin manifest in the instance folder.  Other processes
+    load it at the same time, so it is written to a temporary file first.
+    """
+    filename = path.join(app.instance_folder, PLUGIN_MANIFEST)
+    tmp_filename = '%s.%d' % (filename, getpid())
+    try:
+        f = file(tmp_filename, 'wb')
+        try:
+            dump(manifest, f, HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        rename(tmp_filename, filename)
+    except (IOError, OSError):
+        # the plugins are searched again next time
+        pass
+
+
+def get_entry_point_path(module_name, location):
+    """Return the folder of a plugin loaded from an entry point."""
+    rel = module_name.replace('.', path.sep)
+    full = path.join(location, rel)
+    if path.isdir(full):
+        return full
+    return path.dirname(full)
 
 
 def install_package(app, package):
@@ -403,7 +528,7 @@ class Plugin(object):
 class FilesystemPlugin(Plugin):
     """Wraps a plugin module."""
 
-    def __init__(self, app, name, path_, active):
+    def __init__(self, app, name, path_, active, metadata=None):
         self.app = app
         self.name = name
         self.path = path_
@@ -412,6 +537,8 @@ class FilesystemPlugin(Plugin):
             path.realpath(path_), path.realpath(app.plugin_folder)]) == \
             app.plugin_folder
         self.setup_error = None
+        if metadata is not None:
+            self.metadata = metadata
 
     def remove(self):
         """Remove the plugin from the instance folder."""
@@ -453,14 +580,7 @@ class FilesystemPlugin(Plugin):
 
     @cached_property
     def metadata(self):
-        try:
-            f = file(path.join(self.path, 'metadata.txt'))
-        except IOError:
-            return {}
-        try:
-            return parse_metadata(f)
-        finally:
-            f.close()
+        return load_metadata(self.path)
 
     @cached_property
     def translations(self):
@@ -626,15 +746,17 @@ class FilesystemPlugin(Plugin):
 class EntryPointPlugin(FilesystemPlugin):
     """Wraps a plugin module."""
 
-    def __init__(self, app, entry_point, active):
+    def __init__(self, app, name, module_name, location, dist_version,
+                 active, metadata=None):
         self.app = app
-        self.entry_point = entry_point
+        self.name = name
+        self.module_name = module_name
+        self.location = location
+        self.dist_version = dist_version
         self.active = active
         self.setup_error = None
-
-    @cached_property
-    def name(self):
-        return self.entry_point.name
+        if metadata is not None:
+            self.metadata = metadata
 
     def remove(self):
         """Remove the plugin from the instance folder."""
@@ -646,18 +768,13 @@ class EntryPointPlugin(FilesystemPlugin):
 
     @cached_property
     def path(self):
-        rel = self.entry_point.module_name.replace('.', path.sep)
-        full = path.join(self.entry_point.dist.location, rel)
-        if path.isdir(full):
-            return full
-        return path.dirname(full)
+        return get_entry_point_path(self.module_name, self.location)
 
     @cached_property
     def module(self):
         """The module of the plugin. The first access imports it."""
         try:
-            return __import__(self.entry_point.module_name, None, None,
-                              ['setup'])
+            return __import__(self.module_name, None, None, ['setup'])
         except:
             if not self.app.cfg['plugin_guard']:
                 raise
@@ -671,7 +788,7 @@ class EntryPointPlugin(FilesystemPlugin):
     @property
     def version(self):
         """The version of the plugin."""
-        return self.metadata.get('version', self.entry_point.dist.version)
+        return self.metadata.get('version', self.dist_version)
 
     @property
     def depends(self):
@@ -5,31 +5,134 @@
 
     This module contains a list of builtin privileges.
 
+    Every privilege name gets a bit and the privileges of a user are kept
+    as bitmask.  Privilege expressions are compiled into a list of masks
+    the first time they are checked, a user has the privileges of the
+    expression if one of the masks is completely set:
+
+    >>> expr = BLOG_ADMIN | (CREATE_ENTRIES & VIEW_DRAFTS)
+    >>> expr.check(get_privilege_mask([CREATE_ENTRIES, VIEW_DRAFTS]))
+    True
+    >>> expr.check(get_privilege_mask([CREATE_ENTRIES]))
+    False
+
+    Combining the same expressions again returns the same compiled
+    expression, as long as it's one of the `COMBINED_CACHE_SIZE` recently
+    combined ones:
+
+    >>> expr is BLOG_ADMIN | (CREATE_ENTRIES & VIEW_DRAFTS)
+    True
+
     :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+from threading import Lock
+
 from werkzeug.exceptions import Forbidden
 
 from rezine.database import db
 from rezine.application import get_application, get_request
 from rezine.i18n import lazy_gettext
+from rezine.utils.datastructures import LRUDict
 
 
 __all__ = ['DEFAULT_PRIVILEGES', 'Privilege']
 
 DEFAULT_PRIVILEGES = {}
 
+#: the bits of the privilege names.  The bits are assigned once per
+#: process so that privileges of different applications and plugins
+#: that are set up again share them.
+_privilege_bits = {}
+_bits_lock = Lock()
+
+#: the number of combined expressions that are kept
+COMBINED_CACHE_SIZE = 1000
+
+#: the combined expressions, so that expressions built again and again
+#: in functions are compiled only once.  Expressions can be combined at
+#: runtime by plugins, so only the recently used ones are kept.
+_combined = LRUDict(COMBINED_CACHE_SIZE)
+_combined_lock = Lock()
+
+
+def get_privilege_bit(name):
+    """Return the bit for the privilege with the given name."""
+    bit = _privilege_bits.get(name)
+    if bit is None:
+        _bits_lock.acquire()
+        try:
+            bit = _privilege_bits.get(name)
+            if bit is None:
+                bit = _privilege_bits[name] = 1 << len(_privilege_bits)
+        finally:
+            _bits_lock.release()
+    return bit
+
+
+def get_privilege_mask(privileges):
+    """Return the bitmask for an iterable of privileges.  Privileges that
+    are `None` because the plugin that provides them is not active are
+    ignored.
+    """
+    mask = 0
+    for privilege in privileges:
+        if privilege is not None:
+            mask |= privilege.bit
+    return mask
+
+
+def _combine(cls, a, b):
+    key = (cls, a, b)
+    _combined_lock.acquire()
+    try:
+        rv = _combined.get(key)
+        if rv is None:
+            rv = _combined[key] = cls(a, b)
+    finally:
+        _combined_lock.release()
+    return rv
+
 
 class _Expr(object):
+    _masks = _admin_masks = None
 
     def iter_privileges(self, cache=None):
         raise NotImplementedError()
 
+    def compile(self):
+        """Return a list of masks, the expression is true if all bits of
+        one of the masks are set.
+        """
+        raise NotImplementedError()
+
+    def check(self, mask):
+        """Check the expression against a privilege bitmask."""
+        masks = self._masks
+        if masks is None:
+            masks = self._masks = self.compile()
+        for required in masks:
+            if mask & required == required:
+                return True
+        return False
+
+    def check_admin(self, mask):
+        """Like `check` but BLOG_ADMIN passes as well, this is what
+        `has_privilege` of users does.
+        """
+        masks = self._admin_masks
+        if masks is None:
+            masks = self._admin_masks = add_admin_privilege(self).compile()
+        for required in masks:
+            if mask & required == required:
+                return True
+        return False
+
     def __and__(self, other):
-        return _And(self, other)
+        return _combine(_And, self, other)
 
     def __or__(self, other):
-        return _Or(self, other)
+        return _combine(_Or, self, other)
 
     def __call__(self, privileges):
         return False
@@ -53,9 +156,25 @@ class _Bin(_Expr):
         return '(%r %s %r)' % (self.a, self.joiner, self.b)
 
 
+def _simplify(masks):
+    """Drop masks that require more than other masks."""
+    result = []
+    for mask in sorted(set(masks)):
+        for other in result:
+            if mask & other == other:
+                break
+        else:
+            result.append(mask)
+    return result
+
+
 class _And(_Bin):
     joiner = '&'
 
+    def compile(self):
+        return _simplify([a | b for a in self.a.compile()
+                          for b in self.b.compile()])
+
     def __call__(self, privileges):
         return self.a(privileges) and self.b(privileges)
 
@@ -63,6 +182,9 @@ class _And(_Bin):
 class _Or(_Bin):
     joiner = '|'
 
+    def compile(self):
+        return _simplify(self.a.compile() + self.b.compile())
+
     def __call__(self, privileges):
         return self.a(privileges) or self.b(privileges)
 
@@ -84,6 +206,10 @@ class Privilege(_Expr):
         self.name = name
         self.explanation = explanation
         self.dependencies = privilege_dependencies
+        self.bit = get_privilege_bit(name)
+
+    def compile(self):
+        return [self.bit]
 
     def iter_privileges(self, cache=None):
         if cache is None:
@@ -160,9 +286,11 @@ def bind_privileges(container, privileges, user=None):
 
 def require_privilege(expr):
     """Requires BLOG_ADMIN privilege or one of the given."""
+    if expr is None:
+        expr = BLOG_ADMIN
     def wrapped(f):
         def decorated(request, *args, **kwargs):
-            if request.user.has_privilege(expr):
+            if expr.check_admin(request.identity.privilege_mask):
                 return f(request, *args, **kwargs)
             raise Forbidden()
         decorated.__name__ = f.__name__
@@ -174,7 +302,7 @@ def require_privilege(expr):
 
 def assert_privilege(expr):
     """Like the `require_privilege` decorator but for asserting."""
-    if not get_request().user.has_privilege(expr):
+    if not get_request().identity.has_privilege(expr):
         raise Forbidden()
 
 
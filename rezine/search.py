@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+    rezine.search
+    ~~~~~~~~~~~~~
+
+    The full-text search index for posts.  Which system is used depends on
+    the `search_system` configuration value:
+
+    `python`
+        An inverted index in a file in the instance folder.  Works with
+        every database.
+
+    `sqlite`
+        An FTS5 table in the blog database.  Requires SQLite with FTS5.
+
+    `postgres`
+        A table with a `tsvector` column and a GIN index in the blog
+        database.
+
+    The index is built from all posts the first time it's used, updated
+    after posts are committed and can be rebuilt with ``rezine-manage
+    rebuild_search_index``.
+
+    :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import re
+import math
+from threading import Lock
+from cPickle import load, dump, HIGHEST_PROTOCOL
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy.exceptions import SQLAlchemyError
+
+from rezine.database import db
+
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+#: the BM25 parameters used by the python index
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    """Split a text into lowercase words.
+
+    >>> tokenize(u'Hello World, hello Gr\\xfc\\xdfe!')
+    [u'hello', u'world', u'hello', u'gr\\xfc\\xdfe']
+    """
+    return [word.lower() for word in _word_re.findall(text)]
+
+
+def get_search_index(app):
+    """Return the search index for the application.  This is called during
+    the application setup by the application itself.
+    """
+    return systems[app.cfg['search_system']](app)
+
+
+def get_document(post):
+    """Return the ``(post_id, title, text)`` tuple indexed for a post."""
+    return post.id, post.title, u'%s\n%s' % (
+        post.intro.to_text(simple=True),
+        post.body.to_text(simple=True)
+    )
+
+
+def get_documents():
+    """Return an iterator over the documents of all posts."""
+    from rezine.models import Post
+    return (get_document(post) for post in Post.query.all())
+
+
+def update_search_index(instances, deleted=()):
+    """Update the search index for the committed posts.  This is connected
+    to the `after-models-committed` event.  The changes of a commit are
+    applied to the index at once.
+    """
+    from rezine.application import get_application
+    from rezine.models import Post
+    deleted = set(map(id, deleted))
+    documents = []
+    removed = []
+    for instance in instances:
+        if not isinstance(instance, Post):
+            continue
+        if id(instance) in deleted:
+            removed.append(instance.id)
+        else:
+            documents.append(get_document(instance))
+    if not documents and not removed:
+        return
+    try:
+        get_application().search_index.update_many(documents, removed)
+    except Exception:
+        from rezine.utils import log
+        # the transaction is committed already, an index that is out of
+        # date must not turn that into an error page.
+        log.exception('Could not update the search index.  Rebuild it '
+                      'with "rezine-manage rebuild_search_index".', 'search')
+
+
+def rebuild_search_index(app):
+    """Rebuild the search index from all posts."""
+    app.search_index.rebuild(get_documents())
+
+
+class SearchIndex(object):
+    """Interface for search index systems.  Documents are posts in the form
+    ``(post_id, title, text)``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def search(self, query):
+        """Return the ids of the posts that contain all words of the query,
+        the best match first.
+        """
+        raise NotImplementedError()
+
+    def update(self, post_id, title, text):
+        """Add a post to the index or replace it."""
+        self.update_many([(post_id, title, text)])
+
+    def remove(self, post_id):
+        """Remove a post from the index."""
+        self.update_many((), [post_id])
+
+    def update_many(self, documents, removed=()):
+        """Add or replace the documents and remove the posts with the ids
+        in `removed` in one go.
+        """
+        raise NotImplementedError()
+
+    def rebuild(self, documents):
+        """Replace the index with the documents from the iterable."""
+        raise NotImplementedError()
+
+
+class PythonSearchIndex(SearchIndex):
+    """An inverted index that is stored as pickle in the instance folder.
+    If another process changes the file the index is loaded again.  The
+    results are ranked with BM25, words in the title count twice.
+
+    Changes are done while holding a lock on a second file so that
+    processes do not overwrite the changes of each other, the index file
+    itself is replaced atomically so that readers need no lock.  Where
+    `fcntl` is not available only the threads of a process are
+    synchronized.
+    """
+
+    def __init__(self, app):
+        SearchIndex.__init__(self, app)
+        self.filename = os.path.join(app.instance_folder,
+                                     app.cfg['search_index_path'])
+        self._lock = Lock()
+        self._lockfile = None
+        self._data = None
+        self._stamp = None
+
+    def _get_stamp(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        # the file is replaced on every change, so the inode changes even
+        # if the modification time and size stay the same
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def _lock_file(self):
+        """Lock the index for changes by other processes.  The caller
+        holds the thread lock.
+        """
+        if fcntl is None:
+            return
+        f = open(self.filename + '.lock', 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except:
+            f.close()
+            raise
+        self._lockfile = f
+
+    def _unlock_file(self):
+        if self._lockfile is not None:
+            try:
+                fcntl.flock(self._lockfile.fileno(), fcntl.LOCK_UN)
+            finally:
+                self._lockfile.close()
+                self._lockfile = None
+
+    def _load(self):
+        stamp = self._get_stamp()
+        if stamp is None and fcntl is not None and self._lockfile is None:
+            # another process might be building the index right now
+            self._lock_file()
+            try:
+                return self._load()
+            finally:
+                self._unlock_file()
+        if self._data is None or stamp != self._stamp:
+            if stamp is None:
+                # there is no index yet, for example after an upgrade from
+                # a version without search.  Build it from all posts.
+                self._save(self._make_data(get_documents()))
+                return self._data
+            else:
+                f = open(self.filename, 'rb')
+                try:
+                    self._data = load(f)
+                finally:
+                    f.close()
+            self._stamp = stamp
+        return self._data
+
+    def _save(self, data):
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            dump(data, f, HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp, self.filename)
+        self._data = data
+        self._stamp = self._get_stamp()
+
+    def _make_data(self, documents):
+        data = {'documents': {}, 'words': {}, 'length': 0}
+        for document in documents:
+            self._add(data, *document)
+        return data
+
+    def _add(self, data, post_id, title, text):
+        frequencies = {}
+        words = tokenize(title) * 2 + tokenize(text)
+        for word in words:
+            frequencies[word] = frequencies.get(word, 0) + 1
+        data['documents'][post_id] = (len(words), frequencies)
+        data['length'] += len(words)
+        for word, frequency in frequencies.iteritems():
+            data['words'].setdefault(word, {})[post_id] = frequency
+
+    def _remove(self, data, post_id):
+        document = data['documents'].pop(post_id, None)
+        if document is None:
+            return
+        data['length'] -= document[0]
+        for word in document[1]:
+            postings = data['words'][word]
+            del postings[post_id]
+            if not postings:
+                del data['words'][word]
+
+    def search(self, query):
+        words = set(tokenize(query))
+        if not words:
+            return []
+        self._lock.acquire()
+        try:
+            data = self._load()
+            postings = [data['words'].get(word) for word in words]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            documents = data['documents']
+            total = float(len(documents))
+            average_length = data['length'] / total
+            scores = dict.fromkeys(candidates, 0.0)
+            for posting in postings:
+                idf = math.log(1 + (total - len(posting) + 0.5) /
+                               (len(posting) + 0.5))
+                for post_id in candidates:
+                    frequency = posting[post_id]
+                    scores[post_id] += idf * frequency * (BM25_K1 + 1) / (
+                        frequency + BM25_K1 * (1 - BM25_B + BM25_B *
+                        documents[post_id][0] / average_length))
+        finally:
+            self._lock.release()
+        return sorted(candidates, key=lambda x: (-scores[x], -x))
+
+    def update_many(self, documents, removed=()):
+        self._lock.acquire()
+        try:
+            self._lock_file()
+            try:
+                data = self._load()
+                changed = False
+                for post_id in removed:
+                    if post_id in data['documents']:
+                        self._remove(data, post_id)
+                        changed = True
+                for post_id, title, text in documents:
+                    self._remove(data, post_id)
+                    self._add(data, post_id, title, text)
+                    changed = True
+                # the whole file is written, so only once per call
+                if changed:
+                    self._save(data)
+            finally:
+                self._unlock_file()
+        finally:
+            self._lock.release()
+
+    def rebuild(self, documents):
+        data = self._make_data(documents)
+        self._lock.acquire()
+        try:
+            self._lock_file()
+            try:
+                self._save(data)
+            finally:
+                self._unlock_file()
+        finally:
+            self._lock.release()
+
+
+class _DatabaseSearchIndex(SearchIndex):
+    """Base class for indexes that live in the blog database.  The table is
+    created and filled with all posts on first use.
+    """
+    table_name = 'search_index'
+    create_statements = ()
+    update_statements = ()
+    remove_statement = 'delete from search_index where post_id = :post_id'
+    clear_statement = 'delete from search_index'
+    search_statement = None
+
+    def __init__(self, app):
+        SearchIndex.__init__(self, app)
+        self._created = False
+
+    def _create(self, engine):
+        """Create the table.  Returns `False` if another process or thread
+        created it in the meantime, that one fills it with the posts.
+        """
+        connection = engine.connect()
+        try:
+            transaction = connection.begin()
+            try:
+                for statement in self.create_statements:
+                    connection.execute(db.text(statement))
+                transaction.commit()
+            except SQLAlchemyError:
+                transaction.rollback()
+                if not engine.has_table(self.table_name):
+                    raise
+                return False
+        finally:
+            connection.close()
+        return True
+
+    def _execute(self, func):
+        engine = self.app.database_engine
+        if not self._created:
+            if not engine.has_table(self.table_name) and \
+               self._create(engine):
+                self._created = True
+                self.rebuild(get_documents())
+            self._created = True
+        connection = engine.connect()
+        try:
+            transaction = connection.begin()
+            try:
+                rv = func(connection)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            return rv
+        finally:
+            connection.close()
+
+    def _update(self, connection, post_id, title, text):
+        connection.execute(db.text(self.remove_statement), post_id=post_id)
+        for statement in self.update_statements:
+            connection.execute(db.text(statement), post_id=post_id,
+                               title=title, text=text)
+
+    def make_query(self, words):
+        """Convert the words into the query parameter."""
+        return u' '.join(words)
+
+    def search(self, query):
+        words = tokenize(query)
+        if not words:
+            return []
+        return self._execute(lambda c: [row[0] for row in c.execute(
+            db.text(self.search_statement), query=self.make_query(words))])
+
+    def update_many(self, documents, removed=()):
+        def update_many(connection):
+            for post_id in removed:
+                connection.execute(db.text(self.remove_statement),
+                                   post_id=post_id)
+            for document in documents:
+                self._update(connection, *document)
+        self._execute(update_many)
+
+    def rebuild(self, documents):
+        def rebuild(connection):
+            connection.execute(db.text(self.clear_statement))
+            for document in documents:
+                self._update(connection, *document)
+        self._execute(rebuild)
+
+
+class SQLiteSearchIndex(_DatabaseSearchIndex):
+    """Uses an SQLite FTS5 table.  The results are ranked with the BM25
+    function of FTS5, words in the title count twice.
+    """
+    create_statements = [
+        'create virtual table search_index using fts5(title, text)'
+    ]
+    update_statements = [
+        'insert into search_index (rowid, title, text) '
+        'values (:post_id, :title, :text)'
+    ]
+    remove_statement = 'delete from search_index where rowid = :post_id'
+    search_statement = (
+        'select rowid from search_index where search_index match :query '
+        'order by bm25(search_index, 2.0, 1.0), rowid desc'
+    )
+
+    def make_query(self, words):
+        # quoted words are never treated as FTS operators
+        return u' '.join(u'"%s"' % word.replace('"', '""') for word in words)
+
+
+class PostgresSearchIndex(_DatabaseSearchIndex):
+    """Uses a `tsvector` column with a GIN index.  The results are ranked
+    with `ts_rank_cd`, words in the title have a higher weight.
+    """
+    create_statements = [
+        'create table search_index (post_id integer primary key, '
+        'document tsvector not null)',
+        'create index search_index_document on search_index '
+        'using gin(document)'
+    ]
+    update_statements = [
+        "insert into search_index (post_id, document) values (:post_id, "
+        "setweight(to_tsvector('simple', :title), 'A') || "
+        "setweight(to_tsvector('simple', :text), 'D'))"
+    ]
+    search_statement = (
+        "select post_id from search_index, plainto_tsquery('simple', :query) "
+        "query where document @@ query "
+        "order by ts_rank_cd(document, query) desc, post_id desc"
+    )
+
+
+systems = {
+    'python':       PythonSearchIndex,
+    'sqlite':       SQLiteSearchIndex,
+    'postgres':     PostgresSearchIndex
+}
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+    rezine.tasks
+    ~~~~~~~~~~~~
+
+    A durable queue for work that should not happen inside a request, like
+    sending notifications or pinging other blogs.  Tasks are rows in the
+    `tasks` table, so they are stored with the commit of the request that
+    created them and survive restarts.  A pool of worker threads runs the
+    tasks and retries failed ones with an exponential backoff.
+
+    Plugins can register their own tasks::
+
+        def setup(app, plugin):
+            app.tasks.register('myplugin/do-something', do_something)
+
+    and queue them with :func:`enqueue`.
+
+    :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import datetime, timedelta
+from time import time
+from threading import Thread, Event, Lock
+from traceback import format_exception
+import sys
+
+from rezine.database import db, tasks, cleanup_session
+from rezine.utils import local_manager
+
+
+#: the number of seconds a worker may run a task before other workers
+#: consider it crashed and run the task again.
+TASK_LEASE = 600
+
+#: the delay before the first retry, doubled for every further attempt
+RETRY_DELAY = 30
+
+#: the maximum delay between two attempts
+MAX_RETRY_DELAY = 6 * 60 * 60
+
+#: how often idle workers look for tasks that became due
+POLL_INTERVAL = 30
+
+
+DEFAULT_TASKS = {}
+
+
+def enqueue(name, *args, **kwargs):
+    """Queue a task.  The task is stored with the next commit of the
+    database session and the workers are woken up after that commit.
+    """
+    from rezine.models import Task
+    return Task(name, args, kwargs)
+
+
+def wake_workers(instances, deleted=()):
+    """Wake up the workers if tasks were committed.  This is connected to
+    the `after-models-committed` event.
+    """
+    from rezine.application import get_application
+    from rezine.models import Task
+    for instance in instances:
+        if isinstance(instance, Task):
+            get_application().tasks.wake()
+            break
+
+
+def get_retry_delay(attempts):
+    """Return the delay before the next attempt in seconds.
+
+    >>> [get_retry_delay(x) for x in 1, 2, 3]
+    [30, 60, 120]
+    >>> get_retry_delay(20) == MAX_RETRY_DELAY
+    True
+    """
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+class TaskQueue(object):
+    """Runs the queued tasks of an application.  The workers are started
+    by the WSGI dispatcher once the application serves requests, scripts
+    and the test suite do not start them.  If `task_workers` is set to zero
+    no workers are started and the tasks have to be run with
+    ``rezine-manage run_tasks``.  When the application is unloaded or
+    replaced by a reload the workers are stopped with :meth:`shutdown`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.handlers = DEFAULT_TASKS.copy()
+        self.max_attempts = app.cfg['task_max_attempts']
+        self.worker_count = app.cfg['task_workers']
+        self.workers = []
+        self._wakeup = Event()
+        self._lock = Lock()
+        self._started = False
+        self._stopped = False
+
+    def register(self, name, handler):
+        """Register a function that runs the tasks with the given name."""
+        self.handlers[name] = handler
+
+    def start(self):
+        """Start the workers.  They look for due tasks right away, so tasks
+        left over from an earlier run do not wait for the next commit.
+        """
+        self._started = True
+        self.wake()
+
+    def wake(self):
+        """Tell the workers that there are new tasks.  Queues that were not
+        started have no workers to wake up:
+
+        >>> queue = TaskQueue(app)
+        >>> queue.wake()
+        >>> queue.workers
+        []
+        """
+        if not self._started or self._stopped:
+            return
+        if len(self.workers) < self.worker_count:
+            self._lock.acquire()
+            try:
+                while not self._stopped and \
+                      len(self.workers) < self.worker_count:
+                    worker = Thread(target=self._work,
+                                    name='rezine-task-worker')
+                    worker.setDaemon(True)
+                    worker.start()
+                    self.workers.append(worker)
+            finally:
+                self._lock.release()
+        self._wakeup.set()
+
+    def shutdown(self, timeout=10):
+        """Stop the workers and wait up to `timeout` seconds for them to
+        finish the tasks they are running.  Tasks that are still running
+        after that are run again by other workers once their lease
+        expires.
+
+        >>> queue = TaskQueue(app)
+        >>> queue.start()
+        >>> workers = queue.workers
+        >>> len(workers) == app.cfg['task_workers']
+        True
+        >>> queue.shutdown()
+        >>> [worker for worker in workers if worker.isAlive()]
+        []
+        >>> queue.wake()
+        >>> queue.workers
+        []
+        """
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            workers = self.workers
+            self.workers = []
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+        deadline = time() + timeout
+        for worker in workers:
+            worker.join(max(deadline - time(), 0))
+
+    def _work(self):
+        while not self._stopped:
+            try:
+                while not self._stopped and self.run_next():
+                    pass
+            except Exception:
+                from rezine.utils import log
+                log.exception('Error in the task worker', 'tasks')
+            if self._stopped:
+                break
+            self._wakeup.wait(POLL_INTERVAL)
+            if not self._stopped:
+                self._wakeup.clear()
+
+    def claim(self):
+        """Claim the next due task.  Returns the row of the task or `None`.
+        A claimed task is not run by other workers until its lease expires.
+        """
+        from rezine.models import TASK_PENDING
+        engine = self.app.database_engine
+        now = datetime.utcnow()
+        available = (tasks.c.locked_until == None) | \
+                    (tasks.c.locked_until < now)
+        candidates = engine.execute(db.select([tasks.c.task_id],
+            (tasks.c.status == TASK_PENDING) & (tasks.c.run_at <= now) &
+            available).order_by(tasks.c.run_at).limit(10)).fetchall()
+        for candidate in candidates:
+            # another worker might have claimed the task in the meantime
+            result = engine.execute(tasks.update(
+                (tasks.c.task_id == candidate.task_id) & available),
+                locked_until=now + timedelta(seconds=TASK_LEASE),
+                attempts=tasks.c.attempts + 1)
+            if result.rowcount == 1:
+                return engine.execute(tasks.select(
+                    tasks.c.task_id == candidate.task_id)).fetchone()
+
+    def run_next(self):
+        """Run the next due task.  Returns `False` if there was none."""
+        task = self.claim()
+        if task is None:
+            return False
+        self.run(task)
+        return True
+
+    def run(self, task):
+        """Run a claimed task and remove it from the queue or schedule the
+        next attempt.
+        """
+        from rezine.models import TASK_FAILED
+        engine = self.app.database_engine
+        try:
+            try:
+                handler = self.handlers.get(task.name)
+                if handler is None:
+                    raise LookupError('no handler for task %r' % task.name)
+                args, kwargs = task.arguments
+                handler(*args, **kwargs)
+            finally:
+                cleanup_session()
+                local_manager.cleanup()
+        except Exception:
+            error = ''.join(format_exception(*sys.exc_info())) \
+                      .decode('utf-8', 'ignore')
+            if task.attempts >= self.max_attempts:
+                from rezine.utils import log
+                log.error('Task %r failed %d times and was stopped:\n%s' %
+                          (task.name, task.attempts, error), 'tasks')
+                values = dict(status=TASK_FAILED)
+            else:
+                values = dict(run_at=datetime.utcnow() + timedelta(
+                    seconds=get_retry_delay(task.attempts)))
+            engine.execute(tasks.update(tasks.c.task_id == task.task_id),
+                           locked_until=None, last_error=error, **values)
+        else:
+            engine.execute(tasks.delete(tasks.c.task_id == task.task_id))
+
+
+def _register(name):
+    """Register a builtin task."""
+    def decorator(f):
+        DEFAULT_TASKS[name] = f
+        return f
+    return decorator
+
+
+@_register('send-notification')
+def _send_notification(system, user_ids, type_name, message):
+    from rezine.application import get_application
+    from rezine.models import User
+    from rezine.notifications import Notification
+    manager = get_application().notification_manager
+    if isinstance(user_ids, (int, long)):
+        user_ids = [user_ids]
+    users = User.query.filter(User.id.in_(user_ids)).all()
+    if not users:
+        return
+    notification = Notification(manager.notification_types[type_name],
+                                message, None)
+    failed = manager.systems[system].send_many(users, notification)
+    if len(users) == 1 and failed:
+        raise RuntimeError('could not send the notification')
+    # the other users were notified, only the failed ones are tried again
+    for user in failed:
+        enqueue('send-notification', system, [user.id], type_name, message)
+    if failed:
+        db.commit()
+
+
+@_register('ping-links')
+def _ping_links(source_uri, target_uris):
+    from rezine.pingback import pingback_many
+    failed = [(target_uri, error) for target_uri, error in
+              pingback_many(source_uri, target_uris)
+              if not error.ignore_silently]
+    if len(target_uris) == 1 and failed:
+        raise failed[0][1]
+    # only the failed links are tried again
+    for target_uri, error in failed:
+        enqueue('pingback', source_uri, target_uri)
+    if failed:
+        db.commit()
+
+
+@_register('pingback')
+def _pingback(source_uri, target_uri):
+    from rezine.pingback import pingback, PingbackError
+    try:
+        pingback(source_uri, target_uri)
+    except PingbackError, e:
+        # targets that do not support pingbacks are not tried again
+        if not e.ignore_silently:
+            raise
+
+
+del _register
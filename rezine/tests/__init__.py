@@ -81,7 +81,7 @@ def test_suite(modnames=[]):
                 raise
 
         suites = [DocTestSuite(mod, extraglobs={'app': app})]
-        filename = modname[5:] + '.txt'
+        filename = modname.split('.')[-1] + '.txt'
         if filename in test_files:
             globs = {'app': app}
             globs.update(mod.__dict__)
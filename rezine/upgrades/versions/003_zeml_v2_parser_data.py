@@ -0,0 +1,78 @@
+"""Store the parser data in the ZEML version 2 format"""
+from rezine.upgrades.versions import *
+from rezine.utils.zeml import load_parser_data, dump_parser_data, \
+     Element, RootElement, BrokenElement
+
+metadata = db.MetaData()
+
+#: the number of texts that are loaded and converted at once
+BATCH_SIZE = 500
+
+# The parser data is defined as plain binary column so that the values
+# are converted here and not by the column type
+texts = db.Table('texts', metadata,
+    db.Column('text_id', db.Integer, primary_key=True),
+    db.Column('parser_data', db.LargeBinary)
+)
+
+
+def _is_broken(value):
+    if isinstance(value, list):
+        return any(map(_is_broken, value))
+    if isinstance(value, (Element, RootElement)):
+        return any(isinstance(x, BrokenElement) for x in value.walk())
+    return isinstance(value, BrokenElement)
+
+
+def _iter_texts(migrate_engine):
+    """Iterate over the texts in batches ordered by their id, so that a big
+    table is never loaded at once.
+    """
+    last_id = None
+    while 1:
+        query = texts.select().order_by(texts.c.text_id).limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(texts.c.text_id > last_id)
+        rows = migrate_engine.execute(query).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield row
+        last_id = rows[-1].text_id
+
+
+def _convert(migrate_engine, version):
+    converted = 0
+    for row in _iter_texts(migrate_engine):
+        if row.parser_data is None:
+            continue
+        data = load_parser_data(row.parser_data, lazy=True)
+        if data.version == version:
+            continue
+        # dynamic elements that cannot be loaded (for example because
+        # their plugin is disabled) would be lost, keep those texts in
+        # the old format.  They can be loaded in both formats.
+        if any(map(_is_broken, data.values())):
+            continue
+        migrate_engine.execute(texts.update(
+            texts.c.text_id == row.text_id),
+            parser_data=dump_parser_data(data, version=version))
+        converted += 1
+    return converted
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine
+    # bind migrate_engine to your metadata
+    yield '<ul>'
+    yield '  <li>Convert parser data to the ZEML version 2 format</li>\n'
+    yield '  <li>Converted %d texts</li>\n' % _convert(migrate_engine, 2)
+    yield '</ul>'
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    yield '<ul>'
+    yield '  <li>Convert parser data to the ZEML version 1 format</li>\n'
+    yield '  <li>Converted %d texts</li>\n' % _convert(migrate_engine, 1)
+    yield '</ul>'
@@ -0,0 +1,33 @@
+"""Background task queue"""
+from rezine.upgrades.versions import *
+
+metadata = db.MetaData()
+
+# Define tables here
+tasks = db.Table('tasks', metadata,
+    db.Column('task_id', db.Integer, primary_key=True),
+    db.Column('name', db.String(100)),
+    db.Column('arguments', db.PickleType),
+    db.Column('status', db.Integer, nullable=False),
+    db.Column('attempts', db.Integer, nullable=False),
+    db.Column('created', db.DateTime),
+    db.Column('run_at', db.DateTime, index=True),
+    db.Column('locked_until', db.DateTime),
+    db.Column('last_error', db.Text)
+)
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine
+    # bind migrate_engine to your metadata
+    yield '<ul>'
+    yield '  <li>Create the tasks table</li>\n'
+    yield '</ul>'
+    tasks.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    yield '<ul>'
+    yield '  <li>Drop the tasks table</li>\n'
+    yield '</ul>'
+    tasks.drop(migrate_engine)
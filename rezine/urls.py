@@ -137,6 +137,7 @@ def make_urls(app):
         Rule('/options/configuration', endpoint='admin/configuration'),
         Rule('/system/', endpoint='admin/information'),
         Rule('/system/maintenance', endpoint='admin/maintenance'),
+        Rule('/system/tasks', endpoint='admin/tasks'),
         Rule('/system/log', defaults={'page': 1}, endpoint='admin/log'),
         Rule('/system/log/page/<int:page>', endpoint='admin/log'),
         Rule('/system/import/', endpoint='admin/import'),
@@ -288,3 +288,129 @@ class OrderedDict(dict):
 
     __copy__ = copy
     __iter__ = iterkeys
+
+
+class LRUDict(object):
+    """A mapping that holds at most `max_size` worth of items and drops the
+    least recently used ones if more are added.  The size of an item is
+    calculated by calling `sizeof` with the value, by default every item
+    has the size one.  This class is not thread safe, callers have to lock
+    themselves.
+
+    >>> d = LRUDict(3)
+    >>> d['a'] = 1
+    >>> d['b'] = 2
+    >>> d['c'] = 3
+    >>> d['a']
+    1
+    >>> d['d'] = 4
+    >>> sorted(d.keys())
+    ['a', 'c', 'd']
+    >>> d.evictions
+    1
+
+    Items bigger than the limit are not stored at all:
+
+    >>> d = LRUDict(10, sizeof=len)
+    >>> d['a'] = 'x' * 6
+    >>> d['b'] = 'x' * 11
+    >>> d.keys(), d.size
+    (['a'], 6)
+    >>> d['c'] = 'x' * 5
+    >>> d.keys(), d.size
+    (['c'], 5)
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.evictions = 0
+        self._mapping = {}
+        # the items are kept in a circular doubly linked list of
+        # [prev, next, key, value, size] lists.  The most recently used
+        # item is the one right after the root.
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_front(self, link):
+        root = self._root
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def __getitem__(self, key):
+        link = self._mapping[key]
+        self._unlink(link)
+        self._link_front(link)
+        return link[3]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.pop(key, None)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            oldest = self._root[0]
+            self.pop(oldest[2])
+            self.evictions += 1
+        link = [None, None, key, value, size]
+        self._link_front(link)
+        self._mapping[key] = link
+        self.size += size
+
+    def __delitem__(self, key):
+        link = self._mapping.pop(key)
+        self._unlink(link)
+        self.size -= link[4]
+
+    def pop(self, key, default=missing):
+        try:
+            link = self._mapping[key]
+        except KeyError:
+            if default is missing:
+                raise
+            return default
+        del self[key]
+        return link[3]
+
+    def clear(self):
+        self._mapping.clear()
+        root = self._root
+        root[:] = [root, root, None, None, 0]
+        self.size = 0
+
+    def keys(self):
+        """Return the keys, most recently used first."""
+        result = []
+        link = self._root[1]
+        while link is not self._root:
+            result.append(link[2])
+            link = link[1]
+        return result
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def __repr__(self):
+        return '<%s %d items, size %d/%d>' % (
+            type(self).__name__,
+            len(self),
+            self.size,
+            self.max_size
+        )
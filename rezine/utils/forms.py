@@ -1874,8 +1874,8 @@ class Form(object):
                                  'to request')
         path = self.request.path
         user_id = -1
-        if self.request.user.is_somebody:
-            user_id = self.request.user.id
+        if self.request.identity.is_somebody:
+            user_id = self.request.identity.id
         login_time = self.request.session.get('lt', -1)
         key = self.request.app.cfg['secret_key']
         return sha1(('%s|%s|%s|%s' % (path, login_time, user_id, key))
@@ -9,11 +9,14 @@
 """
 import os
 import re
+import socket
+from time import time
+from threading import Lock
 try:
     from email.mime.text import MIMEText
 except ImportError:
     from email.MIMEText import MIMEText
-from smtplib import SMTP, SMTPException
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
 from urlparse import urlparse
 
 from rezine.utils.validators import is_valid_email, check
@@ -52,6 +55,208 @@ def send_email(subject, text, to_addrs, quiet=True):
     return e.send()
 
 
+def send_emails(emails):
+    """Send many `EMail` objects over one pooled SMTP session, or log them
+    if the application configuration wants to log email.  Returns a list
+    of ``(email, error)`` tuples for the mails that could not be sent.
+    """
+    if not emails:
+        return []
+    app = emails[0].app
+    if app.cfg['log_email_only']:
+        for email in emails:
+            email.log()
+        return []
+    return get_smtp_pool(app).send(emails)
+
+
+def get_smtp_pool(app):
+    """Return the SMTP connection pool of the application."""
+    pool = getattr(app, '_smtp_pool', None)
+    if pool is None:
+        _pool_lock.acquire()
+        try:
+            pool = getattr(app, '_smtp_pool', None)
+            if pool is None:
+                pool = app._smtp_pool = SMTPPool(
+                    app.cfg['smtp_host'], app.cfg['smtp_port'],
+                    app.cfg['smtp_user'], app.cfg['smtp_password'],
+                    app.cfg['smtp_use_tls'], app.cfg['smtp_pool_size'])
+        finally:
+            _pool_lock.release()
+    return pool
+
+_pool_lock = Lock()
+
+
+def _close_smtp(smtp):
+    try:
+        smtp.quit()
+    except (SMTPException, socket.error):
+        # avoid false failure detection when the server closes
+        # the SMTP connection with TLS enabled
+        smtp.close()
+
+
+class SMTPPool(object):
+    """Keeps up to `size` authenticated SMTP connections open and reuses
+    them for further mails, so that the handshake, TLS negotiation and
+    login happen once per connection and not once per mail.  Connections
+    that were idle for more than `max_idle` seconds are closed because
+    most servers drop them anyways.
+
+    The pool counts the connections it opened, how often connections were
+    reused and the messages it sent or failed to send.
+    """
+
+    def __init__(self, host, port, user=None, password=None, use_tls=False,
+                 size=2, max_idle=30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_tls = use_tls
+        self.size = size
+        self.max_idle = max_idle
+        self.connects = self.reuses = self.sent = self.failed = 0
+        self._idle = []
+        self._lock = Lock()
+
+    def connect(self):
+        """Open a new connection."""
+        try:
+            smtp = SMTP(self.host, self.port)
+        except (SMTPException, socket.error), e:
+            raise RuntimeError(str(e))
+        try:
+            if self.use_tls:
+                smtp.ehlo()
+                if not smtp.has_extn('starttls'):
+                    # XXX: untranslated because python exceptions do not
+                    # support unicode messages.
+                    raise RuntimeError('TLS enabled but server does not '
+                                       'support TLS')
+                smtp.starttls()
+                smtp.ehlo()
+            if self.user:
+                smtp.login(self.user, self.password)
+        except (SMTPException, socket.error), e:
+            smtp.close()
+            raise RuntimeError(str(e))
+        except:
+            smtp.close()
+            raise
+        self.connects += 1
+        return smtp
+
+    def acquire(self):
+        """Return an idle connection or a new one."""
+        now = time()
+        expired = []
+        self._lock.acquire()
+        try:
+            while self._idle:
+                smtp, last_used = self._idle.pop()
+                if now - last_used < self.max_idle:
+                    self.reuses += 1
+                    break
+                expired.append(smtp)
+            else:
+                smtp = None
+        finally:
+            self._lock.release()
+        for item in expired:
+            _close_smtp(item)
+        if smtp is None:
+            smtp = self.connect()
+        return smtp
+
+    def release(self, smtp):
+        """Give a connection back to the pool."""
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append((smtp, time()))
+                return
+        finally:
+            self._lock.release()
+        _close_smtp(smtp)
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for smtp, last_used in idle:
+            _close_smtp(smtp)
+
+    def send(self, emails):
+        """Send the mails one after another over one connection.  Returns a
+        list of ``(email, error)`` tuples for the mails that failed.
+        """
+        failed = []
+        emails = list(emails)
+        smtp = None
+        reconnected = False
+        while emails:
+            email = emails[0]
+            if smtp is None:
+                try:
+                    smtp = self.acquire()
+                except RuntimeError, e:
+                    failed.extend((email, e) for email in emails)
+                    break
+            try:
+                smtp.sendmail(email.from_addr, email.to_addrs, email.format())
+            except SMTPServerDisconnected, e:
+                # a pooled connection might have been closed by the
+                # server, the mail gets one more try on a new connection
+                smtp.close()
+                smtp = None
+                if not reconnected:
+                    reconnected = True
+                    continue
+                failed.append((email, e))
+            except socket.error, e:
+                # the connection is broken and must not go back to the pool
+                smtp.close()
+                smtp = None
+                failed.append((email, e))
+            except SMTPException, e:
+                # the server refused the mail.  Reset the session so that
+                # the connection can be used for the next mail.
+                failed.append((email, e))
+                try:
+                    smtp.rset()
+                except (SMTPException, socket.error):
+                    smtp.close()
+                    smtp = None
+            else:
+                self.sent += 1
+            reconnected = False
+            emails.pop(0)
+        if smtp is not None:
+            self.release(smtp)
+        self.failed += len(failed)
+        return failed
+
+    def get_stats(self):
+        """Return a list of ``(label, value)`` tuples with the counters
+        of this process.
+        """
+        from rezine.i18n import _
+        return [
+            (_(u'Connections opened'), self.connects),
+            (_(u'Connections reused'), self.reuses),
+            (_(u'Messages sent'), self.sent),
+            (_(u'Messages failed'), self.failed),
+            (_(u'Idle connections'), len(self._idle))
+        ]
+
+
 class EMail(object):
     """Represents one E-Mail message that can be sent."""
 
@@ -115,46 +320,9 @@ class EMail(object):
 
     def send(self):
         """Send the message."""
-        try:
-            smtp = SMTP(self.app.cfg['smtp_host'], self.app.cfg['smtp_port'])
-        except SMTPException, e:
-            raise RuntimeError(str(e))
-
-        if self.app.cfg['smtp_use_tls']:
-            #smtp.set_debuglevel(1)
-            smtp.ehlo()
-            if not smtp.esmtp_features.has_key('starttls'):
-                # XXX: untranslated because python exceptions do not support
-                # unicode messages.
-                raise RuntimeError('TLS enabled but server does not '
-                                   'support TLS')
-            smtp.starttls()
-            smtp.ehlo()
-
-        if self.app.cfg['smtp_user']:
-            try:
-                smtp.login(self.app.cfg['smtp_user'],
-                           self.app.cfg['smtp_password'])
-            except SMTPException, e:
-                raise RuntimeError(str(e))
-
-        msgtext = self.format()
-        try:
-            try:
-                return smtp.sendmail(self.from_addr, self.to_addrs, msgtext)
-            except SMTPException, e:
-                raise RuntimeError(str(e))
-        finally:
-            if self.app.cfg['smtp_use_tls']:
-                # avoid false failure detection when the server closes
-                # the SMTP connection with TLS enabled
-                import socket
-                try:
-                    smtp.quit()
-                except socket.sslerror:
-                    pass
-            else:
-                smtp.quit()
+        failed = get_smtp_pool(self.app).send([self])
+        if failed:
+            raise RuntimeError(str(failed[0][1]))
 
     def send_quiet(self):
         """Send the message, swallowing exceptions."""
@@ -14,6 +14,8 @@ import os
 import urlparse
 import socket
 import httplib
+from time import time
+from threading import Lock
 
 from werkzeug import Headers, url_decode, cached_property
 from werkzeug.contrib.iterio import IterO
@@ -32,6 +34,9 @@ def open_url(url, data=None, timeout=None,
 
     Per default requests to Rezine itself trigger an internal request.  This
     can be disabled by setting `allow_internal_requests` to False.
+
+    HTTP connections are kept open after the response was read completely
+    and are reused for the next request to the same host.
     """
     app = get_application()
     if timeout is None:
@@ -58,6 +63,8 @@ def open_url(url, data=None, timeout=None,
         raise URLError('unsupported URL schema %r' % parts.scheme)
     if isinstance(data, basestring):
         data = StringIO(data)
+    if app is not None:
+        kwargs.setdefault('pool', get_connection_pool(app))
     try:
         obj = handler(parts, timeout, **kwargs)
         return obj.open(data)
@@ -67,6 +74,24 @@ def open_url(url, data=None, timeout=None,
         raise e
 
 
+def get_connection_pool(app):
+    """Return the HTTP connection pool of the application."""
+    pool = getattr(app, '_http_pool', None)
+    if pool is None:
+        _pool_lock.acquire()
+        try:
+            pool = getattr(app, '_http_pool', None)
+            if pool is None:
+                pool = app._http_pool = ConnectionPool(
+                    app.cfg['http_pool_size'],
+                    app.cfg['http_pool_idle_timeout'])
+        finally:
+            _pool_lock.release()
+    return pool
+
+_pool_lock = Lock()
+
+
 def create_connection(address, timeout=30):
     """Connect to address and return the socket object."""
     msg = "getaddrinfo returns an empty list"
@@ -104,6 +129,114 @@ def get_content_length(data_or_fp):
             pass
 
 
+class ConnectionPool(object):
+    """Keeps the sockets of HTTP/1.1 responses that were read completely
+    open and hands them out again for the next request to the same host.
+    At most `max_per_host` idle sockets are kept for every host, if it is
+    zero connections are not kept alive at all.  Sockets that were idle
+    for more than `max_idle` seconds are closed because most servers drop
+    them anyways.
+    """
+
+    def __init__(self, max_per_host=4, max_idle=30):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.connects = self.reuses = 0
+        self._idle = {}
+        self._last_eviction = time()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return an idle socket for the key or `None`.  The key is a
+        ``(scheme, host, port)`` tuple.
+        """
+        now = time()
+        expired = []
+        sock = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            while idle:
+                item, last_used = idle.pop()
+                if now - last_used < self.max_idle:
+                    sock = item
+                    self.reuses += 1
+                    break
+                expired.append(item)
+            if not idle:
+                self._idle.pop(key, None)
+        finally:
+            self._lock.release()
+        for item in expired:
+            item.close()
+        return sock
+
+    def put(self, key, sock):
+        """Give a socket back to the pool."""
+        now = time()
+        if now - self._last_eviction > self.max_idle:
+            self.evict()
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append((sock, now))
+                return
+        finally:
+            self._lock.release()
+        sock.close()
+
+    def evict(self):
+        """Close the sockets of all hosts that were idle for too long."""
+        now = self._last_eviction = time()
+        expired = []
+        self._lock.acquire()
+        try:
+            for key, idle in self._idle.items():
+                keep = []
+                for item in idle:
+                    if now - item[1] < self.max_idle:
+                        keep.append(item)
+                    else:
+                        expired.append(item[0])
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        finally:
+            self._lock.release()
+        for sock in expired:
+            sock.close()
+
+    def close(self):
+        """Close all idle sockets."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for items in idle.itervalues():
+            for sock, last_used in items:
+                sock.close()
+
+    @property
+    def keep_alive(self):
+        """`True` if connections are kept open after a request."""
+        return self.max_per_host > 0
+
+    def get_stats(self):
+        """Return a list of ``(label, value)`` tuples with the counters
+        of this process.
+        """
+        from rezine.i18n import _
+        return [
+            (_(u'Connections opened'), self.connects),
+            (_(u'Connections reused'), self.reuses),
+            (_(u'Idle connections'), sum(map(len, self._idle.values())))
+        ]
+
+
 class NetException(RezineException):
     pass
 
@@ -128,10 +261,12 @@ class URLHandler(object):
 
     default_port = 0
 
-    def __init__(self, parsed_url, timeout=30):
+    def __init__(self, parsed_url, timeout=30, pool=None):
         self.parsed_url = parsed_url
         self.timeout = timeout
+        self.pool = pool
         self.closed = False
+        self.reused = False
         self._socket = None
         self._buffer = []
 
@@ -184,14 +319,36 @@ class URLHandler(object):
     def url(self):
         return urlparse.urlunsplit(self.parsed_url)
 
+    @property
+    def pool_key(self):
+        return (self.parsed_url.scheme,) + self.addr
+
     @property
     def socket(self):
         if self._socket is None:
             if self.closed:
                 raise TypeError('handler closed')
-            self._socket = self.connect()
+            if self.pool is not None:
+                self._socket = self.pool.get(self.pool_key)
+            self.reused = self._socket is not None
+            if self._socket is None:
+                self._socket = self.connect()
+                if self.pool is not None:
+                    self.pool.connects += 1
         return self._socket
 
+    def release(self):
+        """Give the socket back to the pool after the response was read
+        completely.
+        """
+        if self._socket is not None:
+            if self.pool is None:
+                self._socket.close()
+            else:
+                self.pool.put(self.pool_key, self._socket)
+            self._socket = None
+            self.closed = True
+
     def connect(self):
         return create_connection(self.addr, self.timeout)
 
@@ -242,9 +399,10 @@ class HTTPHandler(URLHandler):
 
     STATE_IDLE, STATE_SENDING, STATE_SENT = range(3)
 
-    def __init__(self, parsed_url, timeout=30, method=None):
-        URLHandler.__init__(self, parsed_url, timeout)
-        self.headers = Headers()
+    def __init__(self, parsed_url, timeout=30, method=None, pool=None,
+                 headers=None):
+        URLHandler.__init__(self, parsed_url, timeout, pool)
+        self.headers = Headers(headers or ())
         self._state = self.STATE_IDLE
         self._method = method
 
@@ -289,24 +447,42 @@ class HTTPHandler(URLHandler):
                 self.headers['Host'] = self.host_string
             if 'accept-encoding' not in self.headers:
                 self.headers['Accept-Encoding'] = 'identity'
+            if self.pool is None or not self.pool.keep_alive:
+                self.headers.setdefault('Connection', 'close')
 
         if 'content-length' not in self.headers:
             content_length = get_content_length(data)
             if content_length is not None:
                 self.headers['Content-Length'] = content_length
 
-        self.send_request(data)
-        return HTTPResponse(self)
+        start = None
+        if hasattr(data, 'tell'):
+            start = data.tell()
+        try:
+            self.send_request(data)
+            return HTTPResponse(self)
+        except (socket.error, httplib.BadStatusLine):
+            # the server closed the pooled connection in the meantime.
+            # Try again with a new one if the data can be sent again.
+            if not self.reused or (data is not None and start is None):
+                raise
+            self._socket.close()
+            self._socket = None
+            self._state = self.STATE_IDLE
+            if start is not None:
+                data.seek(start)
+            self.send_request(data)
+            return HTTPResponse(self)
 
 
 class HTTPSHandler(HTTPHandler):
     """Opens HTTPS connections."""
     default_port = 443
 
-    def __init__(self, parsed_url, timeout=30,
-                 default_method=None, key_file=None,
-                 cert_file=None):
-        HTTPHandler.__init__(self, parsed_url, timeout, default_method)
+    def __init__(self, parsed_url, timeout=30, method=None, pool=None,
+                 headers=None, key_file=None, cert_file=None):
+        HTTPHandler.__init__(self, parsed_url, timeout, method, pool,
+                             headers)
         self.key_file = key_file
         self.cert_file = cert_file
 
@@ -336,6 +512,19 @@ class URLResponse(Response):
 
 
 class HTTPResponse(URLResponse):
+    """The response of a remote server.  The body is read from the socket
+    while it is iterated over or read from `stream`, it is only kept in
+    memory as a whole if `data` is accessed.  If the body was read
+    completely the connection goes back to the pool.
+    """
+
+    #: the size of the chunks the body is read in
+    chunk_size = 8192
+
+    # werkzeug must not buffer the body behind our back.  Werkzeug 0.6
+    # spells the flag implicit_seqence_conversion, later versions
+    # implicit_sequence_conversion.
+    implicit_seqence_conversion = implicit_sequence_conversion = False
 
     def __init__(self, http_handler):
         self._socket = http_handler.socket
@@ -345,14 +534,25 @@ class HTTPResponse(URLResponse):
         headers = resp.getheaders()
         def make_iterable():
             while 1:
-                data = resp.read(8092)
+                data = resp.read(self.chunk_size)
                 if not data:
                     break
                 yield data
+            # the whole response was read, the connection can be used
+            # for the next request if the server keeps it open.
+            if not resp.will_close and self._socket is not None:
+                http_handler.release()
+                self._socket = None
         URLResponse.__init__(self, http_handler.url, make_iterable(),
                              resp.status, headers)
         self._httplib_resp = resp
 
+    @property
+    def data(self):
+        """The whole body as string."""
+        self.make_sequence()
+        return URLResponse.data.fget(self)
+
     def close(self):
         Response.close(self)
         if self._socket is not None:
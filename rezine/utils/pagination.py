@@ -5,14 +5,109 @@
 
     Pagination helpers.
 
+    Long lists ordered by date are paginated with keyset pagination:
+    instead of skipping ``per_page * (page - 1)`` rows the database seeks
+    directly to the items after the last item of the previous page.  The
+    last item of every page that was shown and the total count are kept in
+    a cursor index in the cache, so the page numbers in the URLs keep
+    working.
+
     :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 import math
+from datetime import datetime
 
 from rezine.i18n import _
 
 
+#: the number of seconds a cursor index is kept.  Posts that become visible
+#: because their publication date was reached shift the following pages,
+#: at most for this long they are missing from the page they belong to.
+CURSOR_INDEX_TIMEOUT = 120
+
+
+class CurrentTime(datetime):
+    """The current time in filters of queries that are paginated with
+    :func:`get_keyset_page`.  Other dates, like the bounds of an archive
+    period, are part of the key of the cursor index.  The current time is
+    left out, otherwise a filter like ``Post.pub_date <=
+    CurrentTime.utcnow()`` would create a new index for every request.
+    """
+
+
+def get_keyset_page(query, order, page, per_page, tags):
+    """Return the items of a page and the total number of items as tuple.
+    `order` is a list of ``(attribute, descending)`` tuples of model
+    attributes that are unique together and must not be NULL, for
+    example ``[(Post.pub_date, True), (Post.id, True)]``.  The cursor index
+    is dropped if one of the cache `tags` is invalidated (see
+    :mod:`rezine.cache`).
+
+    Without a cache system the pages are loaded with an offset.
+    """
+    from werkzeug.contrib.cache import NullCache
+    from rezine.application import get_application
+    from rezine.cache import get_tag_versions, make_arguments_key
+    from rezine.database import db
+    app = get_application()
+    ordered = query.order_by(None)
+    for attr, descending in order:
+        if descending:
+            ordered = ordered.order_by(attr.desc())
+        else:
+            ordered = ordered.order_by(attr.asc())
+
+    index = index_key = None
+    if not isinstance(app.cache, NullCache):
+        statement = query.statement
+        params = dict((key, value) for key, value in
+                      statement.compile().params.iteritems()
+                      if not isinstance(value, CurrentTime))
+        try:
+            index_key = 'cursor_index/' + make_arguments_key(app,
+                (str(statement), params, per_page), {})
+        except TypeError:
+            pass
+        else:
+            index = app.cache.get(index_key)
+            if index is not None and \
+               get_tag_versions(app, tags) != index['versions']:
+                index = None
+    if index is None:
+        index = {
+            'versions':     index_key and get_tag_versions(app, tags, True),
+            'total':        query.count(),
+            'bounds':       {}
+        }
+
+    # continue after the closest page before this one that was shown
+    bounds = index['bounds']
+    start = page - 1
+    while start > 0 and start not in bounds:
+        start -= 1
+    if start:
+        values = bounds[start]
+        after = []
+        for idx, (attr, descending) in enumerate(order):
+            if descending:
+                clause = attr < values[idx]
+            else:
+                clause = attr > values[idx]
+            for (prev_attr, _descending), value in zip(order[:idx], values):
+                clause &= prev_attr == value
+            after.append(clause)
+        ordered = ordered.filter(db.or_(*after))
+    items = ordered.offset((page - 1 - start) * per_page) \
+                   .limit(per_page).all()
+
+    if items and index_key is not None and page not in bounds:
+        bounds[page] = tuple(getattr(items[-1], attr.key)
+                             for attr, descending in order)
+        app.cache.set(index_key, index, CURSOR_INDEX_TIMEOUT)
+    return items, index['total']
+
+
 class Pagination(object):
     """Pagination helper."""
 
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    rezine.utils.profiling
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Every worker and every reload of the configuration sets up a new
+    application, so the time this takes matters.  The application records
+    how long the phases of its setup and the setup functions of the
+    plugins take in a :class:`StartupProfile`.  If `profile_startup` is
+    enabled the number of objects created in every phase is counted as
+    well and the report is written to the log.
+
+    :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import gc
+from time import time
+
+
+class StartupProfile(object):
+    """The phases of the application setup.  A phase lasts until the next
+    one is started or :meth:`finish` is called.  `phases` is a list of
+    ``(name, seconds, objects)`` tuples, `objects` is the number of objects
+    the garbage collector tracks in addition after the phase or `None` if
+    objects are not counted.
+
+    >>> profile = StartupProfile()
+    >>> profile.phase('config')
+    >>> profile.phase('database')
+    >>> profile.finish()
+    >>> [name for name, seconds, objects in profile.phases]
+    ['config', 'database']
+    >>> profile.total >= sum(seconds for name, seconds, objects
+    ...                      in profile.phases)
+    True
+    """
+
+    def __init__(self, count_objects=False):
+        self.count_objects = count_objects
+        self.phases = []
+        self.total = None
+        self.started = self._phase_started = time()
+        self._phase = None
+        self._objects = None
+
+    def _get_object_count(self):
+        if self.count_objects:
+            return len(gc.get_objects())
+
+    def phase(self, name):
+        """End the current phase and start a new one."""
+        now = time()
+        objects = self._get_object_count()
+        if self._phase is not None:
+            if objects is None or self._objects is None:
+                created = None
+            else:
+                created = objects - self._objects
+            self.phases.append((self._phase, now - self._phase_started,
+                                created))
+        self._phase = name
+        self._objects = objects
+        # counting the objects is not part of the next phase
+        self._phase_started = time()
+
+    def finish(self):
+        """End the last phase."""
+        self.phase(None)
+        self.total = time() - self.started
+
+    def get_report(self):
+        """Return the profile as text, one line per phase."""
+        lines = ['Application setup took %.1f ms' % (self.total * 1000)]
+        for name, seconds, objects in self.phases:
+            line = '  %-32s %8.1f ms' % (name, seconds * 1000)
+            if objects is not None:
+                line += ' %+9d objects' % objects
+            lines.append(line)
+        return '\n'.join(lines)
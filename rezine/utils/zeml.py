@@ -15,6 +15,7 @@ import re
 import struct
 import cPickle as pickle
 from copy import deepcopy
+from UserDict import DictMixin
 from StringIO import StringIO as UniStringIO
 from cStringIO import StringIO
 from urlparse import urlparse
@@ -24,7 +25,7 @@ from werkzeug import escape
 from rezine.i18n import _
 from rezine.utils import log
 from rezine.utils.text import wrap as wraptext
-from rezine.utils.datastructures import OrderedDict
+from rezine.utils.datastructures import OrderedDict, missing
 
 
 _tag_name_re = re.compile(r'([\w.-]+)\b(?u)')
@@ -193,20 +194,49 @@ del _struct
 _empty_set = frozenset()
 
 
-def dumps(obj):
-    """Dump an element into a string."""
-    stream = StringIO()
-    dump(obj, stream)
-    return stream.getvalue()
+def dumps(obj, version=2):
+    """Dump an element into a string.  By default the compact version 2
+    format is used, pass ``version=1`` for the old format.
+    """
+    if version == 1:
+        stream = StringIO()
+        _dump_v1(obj, stream)
+        return stream.getvalue()
+    writer = _Writer()
+    parts = writer.encode(obj)
+    return writer.header() + ''.join(parts)
 
 
 def loads(string):
-    """Load an element from a string."""
-    return load(StringIO(string))
+    """Load an element from a string.  Both formats are supported.
+
+    >>> tree = parse_zeml(u'<p>Hello <em class="x">World</em>', 'system')
+    >>> loads(dumps(tree)) == loads(dumps(tree, version=1)) == tree
+    True
+    >>> len(dumps(tree)) < len(dumps(tree, version=1))
+    True
+    """
+    if string[:len(_v2_magic)] == _v2_magic:
+        strings, pos = _read_string_table(string, len(_v2_magic))
+        rv, pos = _decode_v2(string, pos, strings)
+        if pos != len(string):
+            raise ValueError('format error')
+        return rv
+    return _load_v1(StringIO(str(string)))
 
 
 def dump(obj, stream):
     """Dump an element into a stream."""
+    stream.write(dumps(obj))
+
+
+def load(stream):
+    """Load an element from a stream.  The stream is read to the end."""
+    return loads(stream.read())
+
+
+def _dump_v1(obj, stream):
+    """Dump an element into a stream in the version 1 format."""
     def _serialize(obj):
         if obj is None:
             stream.write('N')
@@ -259,10 +289,8 @@ def dump(obj, stream):
     return _serialize(obj)
 
 
-def load(stream):
-    """Load an element from a stream.  This function is optimized for
-    performance so that no further caching is needed.
-    """
+def _load_v1(stream):
+    """Load an element in the version 1 format from a stream."""
     def _load(parent=None, _get=stream.read, _read_struct=lambda s,
               _get=stream.read: s.unpack(_get(s.size))[0]):
         char = _get(1)
@@ -307,29 +335,501 @@ def load(stream):
     return _load()
 
 
-def dump_parser_data(parser_data):
-    out = StringIO()
-    dump(len(parser_data), out)
-    for key, value in parser_data.iteritems():
+# The version 2 format starts with a magic header, followed by a table
+# of the element, attribute and dynamic element class names used so that
+# repeated names are stored only once.  All lengths and counts are
+# varints.  Dumped parser data has an index with the length of each value
+# so that values can be decoded lazily.  Version 1 data starts with an
+# opcode instead.
+_v2_magic = 'Z\x02'
+
+
+def _varint(number):
+    """Encode a non-negative integer as varint."""
+    if number < 0x80:
+        return chr(number)
+    rv = []
+    while number > 0x7f:
+        rv.append(chr(number & 0x7f | 0x80))
+        number >>= 7
+    rv.append(chr(number))
+    return ''.join(rv)
+
+
+def _read_varint(data, pos):
+    """Read a varint.  Returns the number and the new position."""
+    byte = ord(data[pos])
+    if byte < 0x80:
+        return byte, pos + 1
+    rv = byte & 0x7f
+    shift = 7
+    while 1:
+        pos += 1
+        byte = ord(data[pos])
+        rv |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return rv, pos + 1
+        shift += 7
+
+
+def _dump_text(string):
+    string = unicode(string).encode('utf-8')
+    return _varint(len(string)) + string
+
+
+def _read_text(data, pos):
+    length, pos = _read_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise ValueError('format error')
+    return unicode(data[pos:end], 'utf-8'), end
+
+
+def _read_string_table(data, pos):
+    count, pos = _read_varint(data, pos)
+    strings = []
+    for x in xrange(count):
+        string, pos = _read_text(data, pos)
+        strings.append(string)
+    return strings, pos
+
+
+def _read_attributes(data, pos, strings):
+    count, pos = _read_varint(data, pos)
+    items = []
+    for x in xrange(count):
+        index, pos = _read_varint(data, pos)
+        length, pos = _read_varint(data, pos)
+        # values are stored with their length plus one, zero means None
+        if length:
+            end = pos + length - 1
+            items.append((strings[index], unicode(data[pos:end], 'utf-8')))
+            pos = end
+        else:
+            items.append((strings[index], None))
+    return Attributes(items), pos
+
+
+class _Writer(object):
+    """Encodes objects in the version 2 format.  The writer collects the
+    names for the string table, so the header has to be generated after
+    all objects are encoded.
+    """
+
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self._string_ids = dict((string, idx) for idx, string
+                                in enumerate(self.strings))
+
+    def header(self):
+        """The magic and the string table."""
+        return _v2_magic + _varint(len(self.strings)) + \
+               ''.join(map(_dump_text, self.strings))
+
+    def encode(self, obj):
+        """Encode an object.  Returns a list of strings."""
+        parts = []
+        self._encode(obj, parts)
+        return parts
+
+    def _name(self, string):
+        try:
+            idx = self._string_ids[string]
+        except KeyError:
+            idx = self._string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return _varint(idx)
+
+    def _attributes(self, attributes):
+        rv = [_varint(len(attributes))]
+        for key, value in attributes.iteritems():
+            rv.append(self._name(key))
+            if value is None:
+                rv.append('\x00')
+            else:
+                value = unicode(value).encode('utf-8')
+                rv.append(_varint(len(value) + 1) + value)
+        return ''.join(rv)
+
+    def _children(self, element):
+        parts = []
+        for child in element.children:
+            self._encode(child, parts)
+        return _varint(len(element.children)), parts
+
+    def _encode(self, obj, parts):
+        if obj is None:
+            parts.append('N')
+        elif isinstance(obj, (int, long)):
+            # zigzag encoding so that small negative numbers stay short
+            parts.append('I' + _varint(obj < 0 and (-obj << 1) - 1
+                                       or obj << 1))
+        elif isinstance(obj, basestring):
+            parts.append('S' + _dump_text(obj))
+        elif type(obj) is list:
+            parts.append('L' + _varint(len(obj)))
+            for item in obj:
+                self._encode(item, parts)
+        elif type(obj) is Attributes:
+            parts.append('M' + self._attributes(obj))
+        elif type(obj) is RootElement:
+            header, children = self._children(obj)
+            parts.append('R' + _dump_text(obj.text or u'') + header)
+            parts.extend(children)
+        elif type(obj) is Element:
+            header, children = self._children(obj)
+            parts.append('E' + self._name(obj.name) +
+                         self._attributes(obj.attributes) +
+                         _dump_text(obj.text or u'') +
+                         _dump_text(obj.tail or u'') + header)
+            parts.extend(children)
+        elif isinstance(obj, DynamicElement):
+            # like in version 1 the class name is stored next to the
+            # pickle so that broken elements can be reported.
+            pickled = pickle.dumps(obj, 2)
+            parts.append('D' + self._name('%s.%s' % (
+                obj.__class__.__module__,
+                obj.__class__.__name__
+            )) + _varint(len(pickled)))
+            parts.append(pickled)
+        else:
+            raise TypeError('unsupported object %r' % type(obj).__name__)
+
+
+def _decode_v2(data, pos, strings):
+    """Decode the object at `pos` with the given string table.  Returns
+    the object and the position after it.  Nested lists and elements are
+    handled with an explicit stack so deeply nested trees do not hit the
+    recursion limit.
+    """
+    result = []
+    # each frame is the list to fill, the number of missing items and
+    # the parent for elements in that list
+    stack = [[result, 1, None]]
+    try:
+        while stack:
+            frame = stack[-1]
+            if not frame[1]:
+                stack.pop()
+                continue
+            frame[1] -= 1
+            char = data[pos]
+            pos += 1
+            push = None
+            if char == 'E':
+                rv = object.__new__(Element)
+                idx, pos = _read_varint(data, pos)
+                rv.name = strings[idx]
+                rv.attributes, pos = _read_attributes(data, pos, strings)
+                rv.text, pos = _read_text(data, pos)
+                rv.tail, pos = _read_text(data, pos)
+                count, pos = _read_varint(data, pos)
+                rv.children = []
+                rv.parent = frame[2]
+                if count:
+                    push = [rv.children, count, rv]
+            elif char == 'S':
+                rv, pos = _read_text(data, pos)
+            elif char == 'N':
+                rv = None
+            elif char == 'I':
+                rv, pos = _read_varint(data, pos)
+                rv = (rv >> 1) ^ -(rv & 1)
+            elif char == 'L':
+                count, pos = _read_varint(data, pos)
+                rv = []
+                if count:
+                    push = [rv, count, frame[2]]
+            elif char == 'M':
+                rv, pos = _read_attributes(data, pos, strings)
+            elif char == 'R':
+                rv = object.__new__(RootElement)
+                rv.text, pos = _read_text(data, pos)
+                rv.prerendered = None
+                count, pos = _read_varint(data, pos)
+                rv.children = []
+                if count:
+                    push = [rv.children, count, rv]
+            elif char == 'D':
+                idx, pos = _read_varint(data, pos)
+                length, pos = _read_varint(data, pos)
+                pickled = data[pos:pos + length]
+                pos += length
+                try:
+                    rv = pickle.loads(str(pickled))
+                except Exception, e:
+                    log.exception(_(u'Error when loading dynamic ZEML '
+                                    u'element. The system ignored the '
+                                    u'element.  Maybe a disabled plugin '
+                                    u'caused the problem.'))
+                    rv = BrokenElement(strings[idx], e)
+                else:
+                    rv.parent = frame[2]
+            else:
+                raise ValueError('format error')
+            frame[0].append(rv)
+            if push is not None:
+                stack.append(push)
+    except IndexError:
+        raise ValueError('format error')
+    if pos > len(data):
+        raise ValueError('format error')
+    return result[0], pos
+
+
+def dump_parser_data(parser_data, version=2):
+    """Dump parser data.  Values of lazily loaded parser data that were
+    not decoded are copied without decoding them if the format matches.
+    """
+    lazy = isinstance(parser_data, LazyParserData)
+    if lazy and parser_data.version == version:
+        items = list(parser_data.iterrawitems())
+    else:
+        items = parser_data.items()
+
+    if version == 1:
+        out = StringIO()
+        _dump_v1(len(items), out)
+        for key, value in items:
+            assert isinstance(key, basestring), 'keys must be strings'
+            _dump_v1(key, out)
+            if isinstance(value, buffer):
+                out.write(value)
+            else:
+                _dump_v1(value, out)
+        return out.getvalue()
+
+    # copied values refer to the string table of the loaded data, so
+    # new names have to be appended to that table
+    for key, value in items:
+        if isinstance(value, buffer):
+            writer = _Writer(parser_data.strings)
+            break
+    else:
+        writer = _Writer()
+    index = [_varint(len(items))]
+    values = []
+    for key, value in items:
         assert isinstance(key, basestring), 'keys must be strings'
-        dump(key, out)
-        dump(value, out)
-    return out.getvalue()
+        if isinstance(value, buffer):
+            value = str(value)
+        else:
+            value = ''.join(writer.encode(value))
+        index.append(_dump_text(key) + _varint(len(value)))
+        values.append(value)
+    return writer.header() + ''.join(index) + ''.join(values)
 
 
-def load_parser_data(value):
+def load_parser_data(value, lazy=False):
+    """Load parser data.  If `lazy` is true a :class:`LazyParserData` object
+    is returned that decodes the values on first access.
+    """
     if value is None:
-        return {}
+        return lazy and LazyParserData() or {}
+    if value[:len(_v2_magic)] == _v2_magic:
+        strings, raw = _index_parser_data(value)
+        if lazy:
+            return LazyParserData(raw, strings)
+        return dict((key, _decode_v2(data, 0, strings)[0])
+                    for key, data in raw.iteritems())
+    if lazy:
+        return LazyParserData(_index_parser_data_v1(value))
     # the extra str() call is for databases like postgres that
     # insist on using buffers for binary data.
     in_ = StringIO(str(value))
     result = {}
-    for x in xrange(load(in_)):
-        key = load(in_)
-        result[key] = load(in_)
+    for x in xrange(_load_v1(in_)):
+        key = _load_v1(in_)
+        result[key] = _load_v1(in_)
     return result
 
 
+def _index_parser_data(value):
+    """Return the string table and a dict that maps the keys of dumped
+    parser data to buffers with the dumped values.
+    """
+    try:
+        strings, pos = _read_string_table(value, len(_v2_magic))
+        count, pos = _read_varint(value, pos)
+        index = []
+        for x in xrange(count):
+            key, pos = _read_text(value, pos)
+            length, pos = _read_varint(value, pos)
+            index.append((key, length))
+    except IndexError:
+        raise ValueError('format error')
+    raw = {}
+    for key, length in index:
+        raw[key] = buffer(value, pos, length)
+        pos += length
+    if pos != len(value):
+        raise ValueError('format error')
+    return strings, raw
+
+
+def _index_parser_data_v1(value):
+    """Return a dict that maps the keys of dumped parser data to buffers
+    with the dumped values.  The values are skipped, not decoded.
+    """
+    try:
+        if value[0] != 'I':
+            raise ValueError('format error')
+        pos = 1 + _long_struct.size
+        result = {}
+        for x in xrange(_long_struct.unpack(value[1:pos])[0]):
+            end = _skip_v1(value, pos)
+            key = _load_v1(StringIO(str(value[pos:end])))
+            pos = _skip_v1(value, end)
+            result[key] = buffer(value, end, pos - end)
+        return result
+    except (IndexError, struct.error):
+        raise ValueError('format error')
+
+
+def _skip_v1(data, pos):
+    """Return the position after the dumped value that starts at `pos`
+    without decoding it.
+    """
+    pending = 1
+    while pending:
+        pending -= 1
+        char = data[pos]
+        pos += 1
+        if char == 'N':
+            pass
+        elif char == 'I':
+            pos += _long_struct.size
+        elif char == 'S':
+            pos += _long_struct.size + struct.unpack_from('!l', data, pos)[0]
+        elif char in 'LM':
+            count = struct.unpack_from('!H', data, pos)[0]
+            pos += _short_struct.size
+            pending += char == 'M' and count * 2 or count
+        elif char == 'R':
+            pending += 2
+        elif char == 'E':
+            pending += 5
+        elif char == 'D':
+            # the class name followed by the length of the pickle
+            pos = _skip_v1(data, pos)
+            pos += _long_struct.size + struct.unpack_from('!l', data, pos)[0]
+        else:
+            raise ValueError('format error')
+    if pos > len(data):
+        raise ValueError('format error')
+    return pos
+
+
+class LazyParserData(DictMixin):
+    """A dict-like object for parser data that keeps the dumped values as
+    buffers of the original data and decodes them on first access.  This
+    way pages that do not use the body of a post do not pay for loading it.
+
+    >>> data = dump_parser_data({'parser': u'zeml',
+    ...                          'body': parse_zeml(u'<b>1</b>', 'system')})
+    >>> lazy = load_parser_data(data, lazy=True)
+    >>> sorted(lazy.keys())
+    [u'body', u'parser']
+    >>> lazy.is_loaded('body')
+    False
+    >>> lazy['body'].to_html()
+    u'<b>1</b>'
+    >>> lazy.is_loaded('body'), lazy.is_loaded('parser')
+    (True, False)
+    >>> lazy.copy().is_loaded('parser')
+    False
+    >>> load_parser_data(dump_parser_data(lazy)) == dict(lazy)
+    True
+    """
+
+    def __init__(self, raw=None, strings=None):
+        self._raw = raw or {}
+        self._values = {}
+        #: the string table for values in the version 2 format or `None`
+        #: if the values are in the version 1 format.
+        self.strings = strings
+
+    @property
+    def version(self):
+        """The format version of the values that are not decoded yet."""
+        return self.strings is None and 1 or 2
+
+    def is_loaded(self, key):
+        """True if the value for the key is decoded already."""
+        return key in self._values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            raw = self._raw[key]
+        try:
+            if self.strings is None:
+                value = _load_v1(StringIO(str(raw)))
+            else:
+                value = _decode_v2(raw, 0, self.strings)[0]
+        except ValueError:
+            log.exception(_(u'Error when loading parsed data from database. '
+                            u'Maybe the database was manually edited and got '
+                            u'corrupted? The system returned an empty value.'))
+            value = None
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._raw.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        found = self._raw.pop(key, missing) is not missing
+        found = self._values.pop(key, missing) is not missing or found
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._values or key in self._raw
+
+    def __iter__(self):
+        for key in self._values:
+            yield key
+        for key in self._raw:
+            if key not in self._values:
+                yield key
+
+    def keys(self):
+        return list(self.__iter__())
+
+    def __len__(self):
+        return len(self._values) + len([key for key in self._raw
+                                        if key not in self._values])
+
+    def iterrawitems(self):
+        """Iterate over the items without decoding them.  Values that were
+        not decoded yet are returned as buffers with the dumped value.
+        """
+        for key in self:
+            if key in self._values:
+                yield key, self._values[key]
+            else:
+                yield key, self._raw[key]
+
+    def copy(self):
+        rv = LazyParserData(dict(self._raw), self.strings)
+        rv._values = self._values.copy()
+        return rv
+
+    def __deepcopy__(self, memo):
+        rv = LazyParserData(dict((key, raw) for key, raw in
+                                 self._raw.iteritems()
+                                 if key not in self._values),
+                            self.strings)
+        rv._values = deepcopy(self._values, memo)
+        return rv
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.keys())
+
+
 def attach_parents(element):
     """Attach all parents to a tree of elements."""
     def _walk(element):
@@ -631,8 +1131,19 @@ class Element(_BaseElement):
 
 
 class RootElement(_BaseElement):
-    """Wraps all elements."""
-    __slots__ = ('text', 'children')
+    """Wraps all elements.  If `prerendered` is set to the result of
+    :func:`prerender` for this tree, the HTML serializer uses it instead of
+    walking the tree.  Copies keep the prerendered HTML, the dynamic
+    elements in it are the copied ones:
+
+    >>> tree = parse_zeml("<p>1</p>", 'system')
+    >>> tree.children.append(HTMLElement(u'<hr>'))
+    >>> tree.prerendered = prerender(tree)
+    >>> copied = deepcopy(tree)
+    >>> copied.prerendered[0], copied.prerendered[1] is copied.children[-1]
+    (u'<p>1</p>', True)
+    """
+    __slots__ = ('text', 'children', 'prerendered')
     is_root = True
     is_dynamic = True
     name = '#root'
@@ -640,11 +1151,13 @@ class RootElement(_BaseElement):
     def __init__(self):
         self.text = u''
         self.children = []
+        self.prerendered = None
 
     def __deepcopy__(self, memo):
         rv = RootElement()
         rv.text = self.text
         rv.children = deepcopy(self.children, memo)
+        rv.prerendered = deepcopy(self.prerendered, memo)
         return rv
 
 
@@ -787,7 +1300,15 @@ class _HTMLSerializer(object):
 
     def serialize(self, element, write):
         if element.is_root:
-            self.serialize_body(element, write)
+            parts = getattr(element, 'prerendered', None)
+            if parts is None:
+                self.serialize_body(element, write)
+            else:
+                for part in parts:
+                    if isinstance(part, basestring):
+                        write(part)
+                    else:
+                        write(part.to_html())
         elif element.is_dynamic:
             write(element.to_html())
         else:
@@ -814,7 +1335,60 @@ class _HTMLSerializer(object):
                 write(escape(element.tail))
 
 
+class _StaticHTMLSerializer(_HTMLSerializer):
+    """Like the HTML serializer but passes dynamic elements to the write
+    function instead of rendering them.
+    """
+
+    def serialize(self, element, write):
+        if element.is_dynamic and not element.is_root:
+            write(element)
+        else:
+            _HTMLSerializer.serialize(self, element, write)
+
+
 html_serializer = _HTMLSerializer()
+static_html_serializer = _StaticHTMLSerializer()
+
+#: stored together with prerendered HTML.  Prerendered HTML of another
+#: version is ignored, so this has to be increased if the HTML serializer
+#: changes its output.
+PRERENDER_VERSION = 1
+
+
+def prerender(tree):
+    """Render the static parts of a tree to HTML.  The return value is a list
+    of HTML strings with the dynamic elements of the tree in between.  It
+    can be stored together with the tree and assigned to the `prerendered`
+    attribute of the root element, then only the dynamic elements are
+    rendered when the tree is converted to HTML:
+
+    >>> tree = parse_zeml("<p>1 <b>2</b></p>", 'system')
+    >>> tree.children.append(HTMLElement(u'<hr>'))
+    >>> tree.children[-1].tail = u'3'
+    >>> parts = prerender(tree)
+    >>> parts                                   # doctest: +ELLIPSIS
+    [u'<p>1 <b>2</b></p>', <rezine.utils.zeml.HTMLElement object at ...>]
+    >>> tree.prerendered = parts
+    >>> tree.to_html()
+    u'<p>1 <b>2</b></p><hr>3'
+    """
+    if getattr(tree, 'prerendered', None) is not None:
+        return list(tree.prerendered)
+    parts = []
+    buffer = []
+    def write(item):
+        if isinstance(item, basestring):
+            buffer.append(item)
+        else:
+            if buffer:
+                parts.append(u''.join(buffer))
+                del buffer[:]
+            parts.append(item)
+    static_html_serializer.serialize(tree, write)
+    if buffer:
+        parts.append(u''.join(buffer))
+    return parts
 
 
 def parse_html(string):
@@ -91,6 +91,7 @@ all_views = {
     'admin/export':             admin.export,
     'admin/information':        admin.information,
     'admin/log':                admin.log,
+    'admin/tasks':              admin.tasks,
     'admin/help':               admin.help,
 }
 
@@ -46,7 +46,7 @@ def render_account_response(template_name, _active_menu_item=None, **values):
     system_items = [
         ('about', url_for('account/about_rezine'), _(u'About'))
     ]
-    if request.user.is_admin:
+    if request.identity.is_admin:
         # Current documentation is addressed for admins
         system_items.append(('help', url_for('account/help'), _(u'Help')))
 
@@ -81,7 +81,7 @@ def render_account_response(template_name, _active_menu_item=None, **values):
     # after the current request.
     values['account'] = {
         'user_can_enter_admin_panel':
-                        request.user.has_privilege(ENTER_ADMIN_PANEL),
+                        request.identity.has_privilege(ENTER_ADMIN_PANEL),
         'navbar': [{
             'id':       id,
             'url':      url,
@@ -157,7 +157,7 @@ def help(req, page=''):
 @require_account_privilege()
 def index(request):
     """Show account details page"""
-    your_comments = Comment.query.filter(Comment.user_id==request.user.id)
+    your_comments = Comment.query.filter(Comment.user_id==request.identity.id)
     return render_account_response('account/index.html', 'dashboard',
                                    your_comments=your_comments.count())
 
@@ -10,8 +10,6 @@
     :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from urlparse import urlparse
-
 from werkzeug import escape
 from werkzeug.exceptions import NotFound, BadRequest, Forbidden
 
@@ -22,16 +20,17 @@ from rezine.privileges import assert_privilege, \
 from rezine.i18n import _, ngettext
 from rezine.application import get_request, url_for, emit_event, \
      render_response
-from rezine.models import User, Group, Post, Category, Comment
+from rezine.models import User, Group, Post, Category, Comment, Task
 from rezine.database import db, secure_database_uri
 from rezine.utils.admin import flash, require_admin_privilege
-from rezine.utils.pagination import AdminPagination
+from rezine.utils.pagination import AdminPagination, get_keyset_page
 from rezine.utils.http import redirect_to, redirect
+from rezine.utils.mail import get_smtp_pool
 from rezine.importers import list_import_queue, load_import_dump, \
      delete_import_dump
 from rezine.pluginsystem import install_package, InstallationError, \
      get_object_name
-from rezine.pingback import pingback, PingbackError
+from rezine.tasks import enqueue
 from rezine.forms import ChangePasswordForm, PluginForm, \
      LogOptionsForm, EntryForm, PageForm, BasicOptionsForm, URLOptionsForm, \
      PostDeleteForm, EditCommentForm, DeleteCommentForm, \
@@ -40,7 +39,7 @@ from rezine.forms import ChangePasswordForm, PluginForm, \
      CommentMassModerateForm, CacheOptionsForm, EditGroupForm, \
      DeleteGroupForm, ThemeOptionsForm, DeleteImportForm, ExportForm, \
      MaintenanceModeForm, MarkCommentForm, RemovePluginForm, \
-     make_config_form, make_import_form
+     TaskQueueForm, make_config_form, make_import_form
 
 #: how many posts / comments should be displayed per page?
 PER_PAGE = 20
@@ -67,47 +66,47 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
     ]
 
     write_nav = []
-    if request.user.has_privilege(CREATE_ENTRIES):
+    if request.identity.has_privilege(CREATE_ENTRIES):
         write_nav.append(('entry', url_for('admin/new_entry'), _(u'Entry')))
-    if request.user.has_privilege(CREATE_PAGES):
+    if request.identity.has_privilege(CREATE_PAGES):
         write_nav.append(('page', url_for('admin/new_page'), _(u'Page')))
-    if request.user.has_privilege(CREATE_ENTRIES | CREATE_PAGES):
+    if request.identity.has_privilege(CREATE_ENTRIES | CREATE_PAGES):
         navigation_bar.append(
             ('write', url_for('admin/new_entry'), _(u'Write'), write_nav)
         )
 
     manage_items = []
-    if request.user.has_privilege(EDIT_OWN_ENTRIES):
+    if request.identity.has_privilege(EDIT_OWN_ENTRIES):
         manage_items.append(
             ('entries', url_for('admin/manage_entries'), _(u'Entries'))
         )
-    if request.user.has_privilege(EDIT_OWN_PAGES):
+    if request.identity.has_privilege(EDIT_OWN_PAGES):
         manage_items.append(
             ('pages', url_for('admin/manage_pages'), _(u'Pages')),
         )
-    if request.user.has_privilege(MANAGE_CATEGORIES):
+    if request.identity.has_privilege(MANAGE_CATEGORIES):
         manage_items.append(
             ('categories', url_for('admin/manage_categories'), _(u'Categories'))
         )
-    if request.user.has_privilege(EDIT_OWN_ENTRIES | EDIT_OWN_PAGES |
+    if request.identity.has_privilege(EDIT_OWN_ENTRIES | EDIT_OWN_PAGES |
                                   MANAGE_CATEGORIES):
         navigation_bar.append(
             ('manage', url_for('admin/manage_entries'), _(u'Manage'),
              manage_items)
         )
-    if request.user.has_privilege(MODERATE_COMMENTS | MODERATE_OWN_ENTRIES |
+    if request.identity.has_privilege(MODERATE_COMMENTS | MODERATE_OWN_ENTRIES |
                                   MODERATE_OWN_PAGES):
         unmoderated = Comment.query.unmoderated()
         approved = Comment.query.approved()
         blocked = Comment.query.blocked()
         spam = Comment.query.spam()
 
-        if request.user.has_privilege(MODERATE_OWN_ENTRIES |
+        if request.identity.has_privilege(MODERATE_OWN_ENTRIES |
                                       MODERATE_OWN_PAGES):
-            unmoderated = unmoderated.for_user(request.user)
-            approved = approved.for_user(request.user)
-            blocked = blocked.for_user(request.user)
-            spam = spam.for_user(request.user)
+            unmoderated = unmoderated.for_user(request.identity)
+            approved = approved.for_user(request.identity)
+            blocked = blocked.for_user(request.identity)
+            spam = spam.for_user(request.identity)
 
         navigation_bar.append(
             ('comments', url_for('admin/manage_comments'), _(u'Comments'), [
@@ -124,7 +123,7 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
         )
 
     # set up the administration menu bar
-    if request.user.has_privilege(BLOG_ADMIN):
+    if request.identity.has_privilege(BLOG_ADMIN):
         navigation_bar.extend([
             ('options', url_for('admin/options'), _(u'Options'), [
                 ('basic', url_for('admin/basic_options'), _(u'Basic')),
@@ -143,7 +142,7 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
     # add the help item to the navigation bar
     system_items = [('help', url_for('admin/help'), _(u'Help'))]
 
-    if request.user.has_privilege(BLOG_ADMIN):
+    if request.identity.has_privilege(BLOG_ADMIN):
         system_items[0:0] = [
             ('information', url_for('admin/information'),
              _(u'Information')),
@@ -152,6 +151,7 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
             ('plugins', url_for('admin/plugins'), _(u'Plugins')),
             ('import', url_for('admin/import'), _(u'Import')),
             ('export', url_for('admin/export'), _(u'Export')),
+            ('tasks', url_for('admin/tasks'), _(u'Tasks')),
             ('log', url_for('admin/log'), _(u'Log'))
         ]
 
@@ -178,7 +178,7 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
     # if we are in maintenance_mode the user should know that, no matter
     # on which page he is.
     if request.app.cfg['maintenance_mode'] and \
-                                        request.user.has_privilege(BLOG_ADMIN):
+       request.identity.has_privilege(BLOG_ADMIN):
         flash(_(u'Rezine is in maintenance mode. Don\'t forget to '
                 u'turn it off again once you finish your changes. You '
                 u'can do that under System -&gt; Maintenance'))
@@ -237,8 +237,7 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
 
 
 def ping_post_links(form):
-    """A helper that pings the links in a post."""
-    pinged_successfully = []
+    """A helper that queues pingbacks for the links in a post."""
     if form.request.app.cfg['maintenance_mode'] or \
        not form.post.is_published:
         flash(_(u'No URLs pinged so far because the post is not '
@@ -248,23 +247,13 @@ def ping_post_links(form):
                 u'post is not available any longer.'), 'error')
     else:
         this_url = url_for(form.post, _external=True)
-        for url in form.find_new_links():
-            host = urlparse(url)[1].decode('utf-8', 'ignore')
-            try:
-                pingback(this_url, url)
-            except PingbackError, e:
-                if not e.ignore_silently:
-                    flash(_(u'Could not ping %(url)s: %(error)s') % {
-                        'url':   escape(host),
-                        'error': e.message
-                    }, 'error')
-            else:
-                pinged_successfully.append(html_url)
-    if pinged_successfully:
-        flash(ngettext(u'The following link was pinged successfully: %s',
-                       u'The following links where pinged successfully: %s',
-                       len(pinged_successfully)) %
-              u', '.join(pinged_successfully))
+        links = list(form.find_new_links())
+        if links:
+            enqueue('ping-links', this_url, links)
+            db.commit()
+            flash(ngettext(u'%d link will be pinged in the background.',
+                           u'%d links will be pinged in the background.',
+                           len(links)) % len(links))
 
 
 @require_admin_privilege()
@@ -502,11 +491,11 @@ def _handle_comments(identifier, title, query, page, per_page, post_id=None,
     if request.user.has_privilege(MODERATE_OWN_ENTRIES | MODERATE_OWN_PAGES):
         query = query.for_user(request.user)
 
-    comments = query.post_lightweight().limit(per_page) \
-                    .offset(per_page * (page - 1))
-
-
-    pagination = AdminPagination(endpoint, page, per_page, query.count(),
+    comments, total = get_keyset_page(query.post_lightweight(),
+                                      [(Comment.pub_date, True),
+                                       (Comment.id, True)],
+                                      page, per_page, ['comments'])
+    pagination = AdminPagination(endpoint, page, per_page, total,
                                  post_id=post_id)
 
     if not comments and page > 1:
@@ -1163,8 +1152,10 @@ def cache(request):
             flash(_(u'Cache settings were changed successfully.'), 'configure')
             return redirect_to('admin/cache')
 
+    get_stats = getattr(request.app.cache, 'get_stats', None)
     return render_admin_response('admin/cache.html', 'options.cache',
-                                 form=form.as_widget())
+                                 form=form.as_widget(),
+                                 stats=get_stats and get_stats() or None)
 
 
 @require_admin_privilege(BLOG_ADMIN)
@@ -1398,6 +1389,40 @@ def log(request, page):
                                  page=page, form=form.as_widget())
 
 
+@require_admin_privilege(BLOG_ADMIN)
+def tasks(request):
+    """Show the queued background tasks and retry or delete failed ones."""
+    form = TaskQueueForm()
+    if request.method == 'POST' and form.validate(request.form):
+        if 'retry_all' in request.form:
+            for task in Task.query.failed():
+                task.retry()
+            flash(_(u'All failed tasks will be tried again.'), 'configure')
+        else:
+            task_id = request.form.get('retry', type=int) or \
+                      request.form.get('delete', type=int)
+            task = task_id and Task.query.get(task_id)
+            if task is None:
+                raise NotFound()
+            if 'retry' in request.form:
+                task.retry()
+                flash(_(u'The task will be tried again.'), 'configure')
+            else:
+                db.delete(task)
+                flash(_(u'The task was deleted.'), 'remove')
+        db.commit()
+        return redirect_to('admin/tasks')
+
+    return render_admin_response('admin/tasks.html', 'system.tasks',
+        pending=Task.query.pending().order_by(Task.run_at).limit(PER_PAGE)
+                    .all(),
+        pending_count=Task.query.pending().count(),
+        failed=Task.query.failed().order_by(Task.created.desc()).all(),
+        smtp_stats=get_smtp_pool(request.app).get_stats(),
+        form=form.as_widget()
+    )
+
+
 @require_admin_privilege()
 def change_password(request):
     """Allow the current user to change his password."""
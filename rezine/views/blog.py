@@ -14,7 +14,7 @@ from datetime import date
 from rezine import cache, pingback
 from rezine.i18n import _
 from rezine.application import add_link, url_for, render_response, \
-     iter_listeners, Response
+     iter_listeners, Response, get_stream_buffer_size
 from rezine.models import Post, Category, User, Tag
 from rezine.utils import dump_json, log
 from rezine.utils.text import build_tag_uri
@@ -41,13 +41,15 @@ def index(req, page=1):
     :Template name: ``index.html``
     :URL endpoint: ``blog/index``
     """
+    cache.tag('posts')
     data = Post.query.theme_lightweight('index').published() \
                .for_index().get_list(endpoint='blog/index',
                                      page=page)
 
     add_link('alternate', url_for('blog/atom_feed'), 'application/atom+xml',
              _(u'Recent Posts Feed'))
-    return render_response('index.html', **data)
+    return render_response('index.html', _stream=get_stream_buffer_size(),
+                           **data)
 
 
 def archive(req, year=None, month=None, day=None, page=1):
@@ -84,7 +86,8 @@ def archive(req, year=None, month=None, day=None, page=1):
 
     return render_response('archive.html', year=year, month=month, day=day,
                            date=date(year, month or 1, day or 1),
-                           month_list=False, **data)
+                           month_list=False,
+                           _stream=get_stream_buffer_size(), **data)
 
 
 def show_category(req, slug, page=1):
@@ -113,7 +116,8 @@ def show_category(req, slug, page=1):
 
     add_link('alternate', url_for('blog/atom_feed', category=slug),
              'application/atom+xml', _(u'All posts in category %s') % category.name)
-    return render_response('show_category.html', category=category, **data)
+    return render_response('show_category.html', category=category,
+                           _stream=get_stream_buffer_size(), **data)
 
 
 def show_tag(req, slug, page=1):
@@ -142,7 +146,8 @@ def show_tag(req, slug, page=1):
 
     add_link('alternate', url_for('blog/atom_feed', tag=slug),
              'application/atom+xml', _(u'All posts tagged %s') % tag.name)
-    return render_response('show_tag.html', tag=tag, **data)
+    return render_response('show_tag.html', tag=tag,
+                           _stream=get_stream_buffer_size(), **data)
 
 
 def tags(req):
@@ -194,7 +199,8 @@ def show_author(req, username, page=1):
              'application/atom+xml', _(u'All posts written by %s') %
              user.display_name)
 
-    return render_response('show_author.html', user=user, **data)
+    return render_response('show_author.html', user=user,
+                           _stream=get_stream_buffer_size(), **data)
 
 
 def authors(req):
@@ -211,7 +217,6 @@ def authors(req):
     return render_response('authors.html', authors=User.query.authors().all())
 
 
-@cache.response(vary=('user',))
 @pingback.inject_header
 def show_entry(req, post, comment_form):
     """Show as post and give users the possibility to comment to this
@@ -247,7 +252,8 @@ def show_entry(req, post, comment_form):
             executed right after comment was saved to the database. Can be
             used to send mail notifications and stuff like that.
 
-    This view supports pingbacks via `rezine.pingback.pingback_post`
+    This view supports pingbacks via `rezine.pingback.pingback_post`.  The
+    response is cached by `dispatch_content_type`.
 
     :Template name: ``show_entry.html``
     """
@@ -255,6 +261,8 @@ def show_entry(req, post, comment_form):
     if response is not None:
         return response
 
+    cache.tag(*cache.get_post_tags(post))
+
     return render_response('show_entry.html',
         entry=post,
         form=comment_form.as_widget()
@@ -267,6 +275,8 @@ def show_page(req, post, comment_form):
     if response is not None:
         return response
 
+    cache.tag(*cache.get_post_tags(post))
+
     cfg = req.app.cfg
     return render_response(['pages/%s.html' % post.slug.strip('/'),
                             post.extra.get('page_template'), 'page.html'],
@@ -391,35 +401,55 @@ def populate_feed(req, feed, author=None, year=None, month=None, day=None,
     # provided and pass them to the feed builder.  This will only return
     # a feed for posts with a content type listed in `index_content_types`
     if post is None:
-        for post in query.for_index().order_by(Post.pub_date.desc()) \
-                         .limit(15).all():
-            alt_title = '%s @ %s' % (post.author.display_name, post.pub_date)
-            feed.add_item(post.title or alt_title,
-                          url_for(post, _external=True), unicode(post.body),
-                          author_name=post.author.display_name,
-                          pubdate=post.pub_date, unique_id=post.uid)
+        cache.tag('posts')
+        posts = query.for_index().order_by(Post.pub_date.desc()) \
+                     .limit(15).all()
+
+        def make_items():
+            for post in posts:
+                alt_title = '%s @ %s' % (post.author.display_name,
+                                         post.pub_date)
+                yield (post.title or alt_title, url_for(post, _external=True),
+                       unicode(post.body)), {
+                    'author_name':  post.author.display_name,
+                    'pubdate':      post.pub_date,
+                    'unique_id':    post.uid
+                }
+        items = posts
 
     # otherwise we create a feed for all the comments of a post.
     # the function is called this way by `dispatch_content_type`.
     else:
-        comment_num = 1
-        for comment in post.comments:
-            if not comment.visible:
-                continue
-            uid = build_tag_uri(req.app, comment.pub_date, 'comment',
-                                comment.id)
-            title = _(u'Comment %(num)d on %(post)s') % {
-                'num':  comment_num,
-                'post': post.title
-            }
-            author = {'name': comment.author}
-            if comment.www:
-                author['uri'] = comment.www
-            feed.add_item(title, url_for(comment, _external=True),
-                          unicode(comment.body), author_name=author,
-                          pubdate=comment.pub_date, unique_id=uid)
-            comment_num += 1
-
+        cache.tag(*cache.get_post_tags(post))
+        comments = [comment for comment in post.comments if comment.visible]
+
+        def make_items():
+            for comment_num, comment in enumerate(comments):
+                uid = build_tag_uri(req.app, comment.pub_date, 'comment',
+                                    comment.id)
+                title = _(u'Comment %(num)d on %(post)s') % {
+                    'num':  comment_num + 1,
+                    'post': post.title
+                }
+                author = {'name': comment.author}
+                if comment.www:
+                    author['uri'] = comment.www
+                yield (title, url_for(comment, _external=True),
+                       unicode(comment.body)), {
+                    'author_name':  author,
+                    'pubdate':      comment.pub_date,
+                    'unique_id':    uid
+                }
+        items = comments
+
+    # the items are only rendered while the feed is written.  The feed
+    # date is written before them, so it is passed on here.
+    feed.add_items(make_items(), max([item.pub_date for item in items] or
+                                     [None]))
+
+    buffer_size = get_stream_buffer_size()
+    if buffer_size:
+        return feed.generate('utf-8', buffer_size)
     return feed.writeString('utf-8')
 
 
@@ -13,13 +13,138 @@
     Additionally widgets could be moved around from the admin panel in the
     future.
 
+    The data of most widgets is the same for every visitor, so it is kept
+    by the :class:`WidgetDataStore` of the application and only loaded
+    from the database again if the models it depends on change.
+
     :copyright: (c) 2010 by the Rezine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from rezine.application import render_template
+from time import time
+
+from werkzeug.contrib.cache import NullCache
+
+from rezine import cache
+from rezine.application import render_template, get_request
 from rezine.models import Post, SummarizedPost, Category, Tag, Comment
 
 
+#: the number of seconds the store trusts its data before it checks the
+#: tag versions in the shared cache for changes made by other processes.
+WIDGET_DATA_CHECK_INTERVAL = 5
+
+
+class WidgetItem(object):
+    """A copy of the attributes of a model instance that a widget template
+    needs.  Widget data is shared between requests, so it must not contain
+    the instances themselves.  The item links to the same URL as the
+    instance it was created from.
+    """
+
+    def __init__(self, obj, attributes):
+        for name in attributes:
+            setattr(self, name, getattr(obj, name))
+        self.url_values = obj.get_url_values()
+
+    def get_url_values(self):
+        return self.url_values
+
+    def __repr__(self):
+        return '<%s %r>' % (
+            self.__class__.__name__,
+            self.url_values
+        )
+
+
+def make_items(objects, *attributes):
+    """Return a list of widget items with the given attributes."""
+    return [WidgetItem(obj, attributes) for obj in objects]
+
+
+def invalidate_widget_data(instances, deleted=()):
+    """Drop the widget data that depends on the committed models.  This is
+    connected to the `after-models-committed` event.
+    """
+    from rezine.application import get_application
+    tags = set()
+    for instance in instances:
+        tags.update(cache.get_model_tags(instance))
+    if tags:
+        get_application().widget_data.invalidate(tags)
+
+
+class WidgetDataStore(object):
+    """Keeps the data of the widgets in the process and in the shared
+    cache.  The data is stored with the versions of the cache tags the
+    widget depends on (see :attr:`Widget.depends_on`), commits in this
+    process drop it right away, commits in other processes after at most
+    `WIDGET_DATA_CHECK_INTERVAL` seconds.  Because some widgets depend on
+    the current date, the data is loaded again after `widget_data_timeout`
+    seconds in any case.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.timeout = app.cfg['widget_data_timeout']
+        # without a shared cache there are no tag versions, only the
+        # commits of this process are noticed then.
+        self.shared = not isinstance(app.cache, NullCache)
+        self.hits = self.misses = 0
+        # key -> (expires, checked, tags, versions, data).  Items are only
+        # replaced as a whole, so no lock is needed.
+        self._items = {}
+
+    def _get_versions(self, tags, create=False):
+        if self.shared:
+            return cache.get_tag_versions(self.app, tags, create)
+
+    def get(self, widget, options):
+        """Return the data of the widget for the given options.  If nothing
+        current is stored it's loaded with :meth:`Widget.load_data`.
+        """
+        key = 'widget_data/%s/%s' % (widget.name, cache.make_arguments_key(
+            self.app, (), options))
+        now = time()
+        item = self._items.get(key)
+        if item is None and self.shared:
+            # data stored by other processes is always checked
+            shared_item = self.app.cache.get(key)
+            if shared_item is not None:
+                item = (shared_item[0], 0) + tuple(shared_item[1:])
+        if item is not None and item[0] > now:
+            expires, checked, tags, versions, data = item
+            if checked + WIDGET_DATA_CHECK_INTERVAL > now:
+                self.hits += 1
+                return data
+            if self._get_versions(tags) == versions:
+                self._items[key] = (expires, now, tags, versions, data)
+                self.hits += 1
+                return data
+
+        # the versions are looked up first, if the models change while
+        # the data is loaded it's out of date already.
+        self.misses += 1
+        tags = widget.depends_on
+        versions = self._get_versions(tags, create=True)
+        data = widget.load_data(**options)
+        self._items[key] = (now + self.timeout, now, tags, versions, data)
+        if self.shared:
+            self.app.cache.set(key, (now + self.timeout, tags, versions,
+                                     data), self.timeout)
+        return data
+
+    def invalidate(self, tags):
+        """Drop the data of the widgets that depend on one of the tags."""
+        tags = set(tags)
+        for key, item in self._items.items():
+            if tags.intersection(item[2]):
+                self._items.pop(key, None)
+
+    def clear(self):
+        """Drop the data of all widgets in this process."""
+        self._items.clear()
+
+
 class Widget(object):
     """Baseclass for all the widgets out there!"""
 
@@ -33,6 +158,34 @@ class Widget(object):
     #: in the template as `widget`.
     template = None
 
+    #: the cache tags of the models the data of the widget depends on (see
+    #: :func:`rezine.cache.get_model_tags`).
+    depends_on = ()
+
+    #: `True` if logged in users may see other data than anonymous users.
+    #: The data is then loaded from the database for them.
+    user_dependent = False
+
+    def load_data(self, **options):
+        """Load the data of the widget and return it as dict.  The data is
+        shared between requests, so it must be picklable and must not
+        contain model instances (see :func:`make_items`).
+        """
+        raise NotImplementedError()
+
+    def update_data(self, **options):
+        """Set the data of the widget as attributes.  It comes from the
+        widget data store of the application unless it depends on the
+        user and somebody is logged in.
+        """
+        cache.tag(*self.depends_on)
+        request = get_request()
+        if request is None or (self.user_dependent and request.identity):
+            data = self.load_data(**options)
+        else:
+            data = request.app.widget_data.get(self, options)
+        self.__dict__.update(data)
+
     def __unicode__(self):
         """Render the template."""
         return render_template(self.template, widget=self)
@@ -46,27 +199,37 @@ class PostArchiveSummary(Widget):
 
     name = 'post_archive_summary'
     template = 'widgets/post_archive_summary.html'
+    depends_on = ('posts',)
 
     def __init__(self, detail='months', limit=6, show_title=False):
-        self.__dict__.update(SummarizedPost.query
-            .get_archive_summary(detail, limit))
+        self.update_data(detail=detail, limit=limit)
         self.show_title = show_title
 
+    def load_data(self, detail, limit):
+        return SummarizedPost.query.get_archive_summary(detail, limit)
+
 
 class LatestPosts(Widget):
     """Show the latest n posts."""
 
     name = 'latest_posts'
     template = 'widgets/latest_posts.html'
+    depends_on = ('posts',)
+    user_dependent = True
 
     def __init__(self, limit=5, show_title=False, content_types=None):
+        self.update_data(limit=limit, content_types=content_types)
+        self.show_title = show_title
+
+    def load_data(self, limit, content_types):
         if content_types is None:
             query = SummarizedPost.query.for_index()
         else:
             query = SummarizedPost.query.filter(SummarizedPost
                 .content_type.in_(content_types))
-        self.posts = query.latest().limit(limit).all()
-        self.show_title = show_title
+        return {'posts': make_items(query.latest().limit(limit).all(),
+                                    'id', 'title', 'slug', 'pub_date',
+                                    'content_type')}
 
 
 class LatestComments(Widget):
@@ -74,34 +237,51 @@ class LatestComments(Widget):
 
     name = 'latest_comments'
     template = 'widgets/latest_comments.html'
+    depends_on = ('comments',)
 
     def __init__(self, limit=5, show_title=False, ignore_blocked=False):
-        self.comments = Comment.query. \
-            latest(ignore_blocked=ignore_blocked).limit(limit).all()
+        # moderators see the blocked comments too
+        self.user_dependent = not ignore_blocked
+        self.update_data(limit=limit, ignore_blocked=ignore_blocked)
         self.show_title = show_title
 
+    def load_data(self, limit, ignore_blocked):
+        comments = Comment.query.latest(ignore_blocked=ignore_blocked) \
+                                .limit(limit).all()
+        return {'comments': make_items(comments, 'id', 'author', 'pub_date',
+                                       'post_id')}
+
 
 class TagCloud(Widget):
     """Show a tagcloud."""
 
     name = 'tag_cloud'
     template = 'widgets/tag_cloud.html'
+    depends_on = ('tags', 'posts')
 
     def __init__(self, max=None, show_title=False):
-        self.tags = Tag.query.get_cloud(max)
+        self.update_data(max=max)
         self.show_title = show_title
 
+    def load_data(self, max):
+        return {'tags': Tag.query.get_cloud(max)}
+
 
 class CategoryList(Widget):
     """Show a list of all categories."""
 
     name = 'category_list'
     template = 'widgets/category_list.html'
+    depends_on = ('categories',)
 
     def __init__(self, show_title=False):
-        self.categories = Category.query.all()
+        self.update_data()
         self.show_title = show_title
 
+    def load_data(self):
+        return {'categories': make_items(Category.query.all(), 'id', 'name',
+                                         'slug', 'description')}
+
 
 class IncludePage(Widget):
     """Includes a page."""
@@ -112,6 +292,7 @@ class IncludePage(Widget):
     def __init__(self, page_name, show_title=False):
         self.page_name = page_name
         self.page = Post.query.type('page').filter_by(slug=page_name).first()
+        cache.tag('posts')
 
     @property
     def exists(self):
@@ -123,13 +304,20 @@ class PagesNavigation(Widget):
 
     name = 'pages_navigation'
     template = 'widgets/pages_navigation.html'
+    depends_on = ('posts',)
+    user_dependent = True
 
     def __init__(self, show_title=False, show_drafts=False):
-        self.pages = Post.query.type('page').published().all()
-        if show_drafts:
-            self.pages += Post.query.type('page').drafts().all()
+        self.update_data(show_drafts=show_drafts)
         self.show_title = show_title
 
+    def load_data(self, show_drafts):
+        pages = Post.query.type('page').published().all()
+        if show_drafts:
+            pages += Post.query.type('page').drafts().all()
+        return {'pages': make_items(pages, 'id', 'title', 'slug',
+                                    'pub_date', 'content_type')}
+
 #: list of all core widgets
 all_widgets = [PostArchiveSummary, LatestPosts, LatestComments, TagCloud,
                CategoryList, IncludePage, PagesNavigation]